@@ -0,0 +1,204 @@
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+
+# 構造化ログ（1行1件のJSON）
+# ログの書き出しはバックグラウンドのスレッドで行い、イベントループを止めない
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# イベント種別ごとの記録割合（例: "http.request=0.01,location.recorded=0.1"）。WARNING以上は常に記録する
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "http.request=0.01,location.recorded=0.1")
+# リクエストボディ（座標・セッションID）をログに含めるか（既定では含めない）
+LOG_REQUEST_BODIES = os.getenv("LOG_REQUEST_BODIES", "").lower() in ("1", "true", "yes")
+
+LOGGER_NAME = "namecard"
+REQUEST_ID_HEADER = b"x-request-id"
+# クライアントから受け取る X-Request-ID の形式（それ以外は新しく採番する）
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# LogRecord の標準属性（これ以外を追加フィールドとして出力する）
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def parse_sample_rates(value):
+    """ "event=rate,..." をイベント種別 -> 割合 の辞書にする"""
+    rates = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        event, rate = item.split("=", 1)
+        try:
+            rates[event.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    """ログを1行のJSONにする（extra で渡した値はそのままフィールドになる）"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc)
+                    .isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ContextFilter(logging.Filter):
+    """ログを出したスレッドのコンテキストからリクエストIDを付ける"""
+
+    def filter(self, record):
+        if getattr(record, "request_id", None) is None:
+            record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """イベント種別ごとに一定の割合だけ記録する（WARNING以上は常に記録する）
+
+    乱数ではなく件数で間引く（割合 0.1 なら10件に1件）。
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, "event", None))
+        if rate is None or rate >= 1.0:
+            return True
+        if rate <= 0.0:
+            return False
+        with self._lock:
+            count = self._counts.get(record.event, 0)
+            self._counts[record.event] = count + 1
+        return count % round(1 / rate) == 0
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """キューに入れる前に本文と例外を文字列にする（例外は本文に混ぜず exc_text に残す）"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# バックグラウンドで書き出すリスナー（configure_logging で開始）
+listener = None
+_configure_lock = threading.Lock()
+
+
+def configure_logging(level=LOG_LEVEL, sample_rates=LOG_SAMPLE_RATES, stream=None):
+    """アプリのロガーを QueueHandler 経由でJSONを書き出すように設定する（2回目以降は何もしない）"""
+    global listener
+    with _configure_lock:
+        if listener is not None:
+            return listener
+        log_queue = queue.Queue(-1)
+        output = logging.StreamHandler(stream)
+        output.setFormatter(JsonFormatter())
+        queue_handler = StructuredQueueHandler(log_queue)
+        # フィルタは呼び出し側のスレッドで動くので、リクエストIDのコンテキストを参照できる
+        queue_handler.addFilter(ContextFilter())
+        queue_handler.addFilter(SamplingFilter(parse_sample_rates(sample_rates)))
+
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.setLevel(level)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+        listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+        listener.start()
+        return listener
+
+
+def flush():
+    """キューに溜まっているログを書き出し終えるまで待つ"""
+    if listener is not None:
+        listener.queue.join()
+
+
+def get_logger(name=None):
+    return logging.getLogger(f"{LOGGER_NAME}.{name}" if name else LOGGER_NAME)
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+class RequestContextMiddleware:
+    """リクエストごとにIDを決めてコンテキストに入れ、レスポンスの X-Request-ID で返すASGIミドルウェア
+
+    クライアントが X-Request-ID を送ってきた場合は（形式が正しければ）それを使う。
+    完了したリクエストは "http.request" イベントとして記録する（クエリ文字列・ボディは含めない）。
+    """
+
+    def __init__(self, app, logger=None):
+        self.app = app
+        self.logger = logger or get_logger("http")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == REQUEST_ID_HEADER:
+                candidate = value.decode("latin-1")
+                if REQUEST_ID_PATTERN.match(candidate):
+                    request_id = candidate
+                break
+        request_id = request_id or new_request_id()
+        token = request_id_var.set(request_id)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [
+                    (REQUEST_ID_HEADER, request_id.encode("latin-1"))]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.logger.info("%s %s %s", scope["method"], scope["path"], status, extra={
+                "event": "http.request",
+                "method": scope["method"],
+                "path": scope["path"],
+                "status": status,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 3),
+            })
+            request_id_var.reset(token)
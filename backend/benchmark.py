@@ -0,0 +1,255 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import numpy as np
+
+import main
+from latency import summarize_latencies
+
+# 合成データと負荷試験のベンチマーク
+# 使い方: cd backend && python benchmark.py --rows 10000,100000 --concurrency 20 --output bench.json
+# 結果はJSONで出力する（コミット間の比較用）。アプリのログは標準エラーに流す
+
+DEFAULT_ROWS = "10000"
+DEFAULT_REQUESTS = 200
+DEFAULT_CONCURRENCY = 10
+DEFAULT_SEED = 42
+LOAD_CHUNK_SIZE = 10000
+
+# 合成データの分布（イベント会場のまわりに集まり、夜の数時間に偏る）
+VENUE_COUNT = 20
+VENUE_SPREAD_DEG = 0.01
+JAPAN_BBOX = (129.5, 31.0, 145.5, 45.5)
+DATA_SPAN_DAYS = 365
+DATA_END = datetime.datetime(2025, 1, 1, tzinfo=main.JST_OFFSET)
+
+
+def generate_locations(count, seed=DEFAULT_SEED):
+    """シード固定の合成データ [(緯度, 経度, timestamp, timestamp_ms, session_id, user_agent, ip), ...] を作る"""
+    rng = np.random.default_rng(seed)
+    west, south, east, north = JAPAN_BBOX
+    venue_lats = rng.uniform(south, north, VENUE_COUNT)
+    venue_lons = rng.uniform(west, east, VENUE_COUNT)
+    venues = rng.integers(0, VENUE_COUNT, count)
+    lats = np.clip(venue_lats[venues] + rng.normal(0, VENUE_SPREAD_DEG, count), -90, 90)
+    lons = np.clip(venue_lons[venues] + rng.normal(0, VENUE_SPREAD_DEG, count), -180, 180)
+
+    # 日付はランダム（DATA_END は JST の0時なので日単位でずらしても0時のまま）、時刻は 18〜22時に集中させる
+    end_ms = main.datetime_to_ms(DATA_END)
+    day_starts = end_ms - rng.integers(1, DATA_SPAN_DAYS + 1, count) * 86400000
+    offsets = np.clip(rng.normal(20.0, 1.0, count), 18.0, 22.999) * 3600000
+    timestamps_ms = np.sort(day_starts + offsets.astype(np.int64))
+
+    return [
+        (float(lat), float(lon), main.format_timestamp_ms(int(ts)), int(ts), f"bench-{seed}-{index}",
+         "benchmark", "127.0.0.1")
+        for index, (lat, lon, ts) in enumerate(zip(lats, lons, timestamps_ms))
+    ]
+
+
+def use_database(path):
+    """アプリの接続先を切り替え、メモリ上のキャッシュを捨てる"""
+    main.DB_PATH = path
+    main.db_pool.close()
+    main.session_cache.invalidate()
+    main.config_cache.invalidate()
+    main.locations_cache.invalidate()
+    main.heatmap_tiles.clear()
+    main.location_snapshot.invalidate()
+
+
+def bulk_load(rows, chunk_size=LOAD_CHUNK_SIZE):
+    """合成データを locations に一括登録する（R*Tree・件数表はトリガー、グリッドは最後に作り直す）"""
+    for start in range(0, len(rows), chunk_size):
+        with main.db_pool.writer() as conn:
+            conn.executemany(main.SQL_INSERT_LOCATION, rows[start:start + chunk_size])
+    main.rebuild_location_grid()
+    main.resource_versions.bump("locations")
+
+
+def prepare_database(directory, count, seed, fresh=False):
+    """件数・シードごとのDBファイルを用意し、(パス, 登録にかかった秒数) を返す
+
+    同じ件数・シードのファイルが既にあれば再利用する（100万件の登録は時間がかかるため）。
+    """
+    path = os.path.join(directory, f"bench-{count}-{seed}.db")
+    if fresh:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    use_database(path)
+    if main.fetch_location_count() == count:
+        return path, 0.0
+    if main.fetch_location_count():
+        raise RuntimeError(f"{path} has a different number of rows; rerun with --fresh")
+    started = time.perf_counter()
+    bulk_load(generate_locations(count, seed))
+    return path, time.perf_counter() - started
+
+
+# ベンチマーク中に記録した行のセッションID（終了後に削除してDBを再利用できるようにする）
+RECORDED_SESSION_PREFIX = "bench-run-"
+
+
+def scenario_requests(name):
+    """エンドポイントごとのリクエストを作る関数を返す（引数は通し番号）"""
+    admin = {"admin_password": main.ADMIN_PASSWORD}
+    scenarios = {
+        "recording_status": lambda i: ("GET", "/api/recording-status", {}),
+        "get_locations": lambda i: ("GET", "/api/locations", {}),
+        "get_locations_page": lambda i: ("GET", "/api/locations", {"params": {"limit": 100}}),
+        "get_all_locations_admin": lambda i: ("GET", "/api/admin/locations", {"params": admin}),
+        "get_admin_locations_page": lambda i: ("GET", "/api/admin/locations",
+                                               {"params": {**admin, "limit": 100}}),
+        "record_location": lambda i: ("POST", "/api/record-location", {"json": {
+            "latitude": 35.0 + (i % 1000) / 10000, "longitude": 139.0 + (i % 997) / 10000,
+            "session_id": f"{RECORDED_SESSION_PREFIX}{time.time_ns()}-{i}"}}),
+    }
+    return scenarios[name]
+
+
+def remove_recorded_locations():
+    """record_location の測定で追加した行を削除する
+
+    管理者の削除と同じ処理を通し、変更履歴・集計・スナップショット・タイルとレスポンスのキャッシュも揃える。
+    """
+    with main.db_pool.reader() as conn:
+        ids = [row[0] for row in conn.execute("SELECT id FROM locations WHERE session_id LIKE ?",
+                                              (RECORDED_SESSION_PREFIX + "%",))]
+    deleted = 0
+    for start in range(0, len(ids), main.MAX_BATCH_SIZE):
+        deleted += main.delete_locations_by_ids(ids[start:start + main.MAX_BATCH_SIZE])
+    return deleted
+
+
+# 書き込みは一覧のキャッシュを無効にするので最後に測る
+ENDPOINTS = ["recording_status", "get_locations", "get_locations_page",
+             "get_all_locations_admin", "get_admin_locations_page", "record_location"]
+
+
+async def run_endpoint(client, name, requests, concurrency):
+    """1つのエンドポイントに concurrency 並列で requests 回リクエストを送る"""
+    build = scenario_requests(name)
+    indexes = iter(range(requests))
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for index in indexes:
+            method, path, kwargs = build(index)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, **kwargs)
+                ok = response.status_code < 400
+            except Exception:
+                ok = False
+            latencies.append((time.perf_counter() - started) * 1000)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return summarize_latencies(latencies, errors, time.perf_counter() - started)
+
+
+async def run_endpoints(endpoints, requests, concurrency, warmup=1):
+    """アプリを lifespan ごと起動し、ASGI経由（ネットワークなし）で各エンドポイントを測る"""
+    await main.run_blocking(main.update_recording_session, True, None, "benchmark")
+    results = {}
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            for name in endpoints:
+                # 初回のキャッシュ作成などを測定から外す
+                await run_endpoint(client, name, warmup, 1)
+                results[name] = await run_endpoint(client, name, requests, concurrency)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(row_counts, endpoints=ENDPOINTS, requests=DEFAULT_REQUESTS,
+                  concurrency=DEFAULT_CONCURRENCY, seed=DEFAULT_SEED, directory=None, fresh=False):
+    """件数ごとにDBを用意して測定し、結果をまとめた辞書を返す"""
+    original_path = main.DB_PATH
+    directory = directory or os.path.join(tempfile.gettempdir(), "namecard-places-bench")
+    os.makedirs(directory, exist_ok=True)
+    runs = []
+    try:
+        for count in row_counts:
+            path, load_seconds = prepare_database(directory, count, seed, fresh)
+            runs.append({
+                "rows": count,
+                "database": path,
+                "load_seconds": round(load_seconds, 3),
+                "endpoints": asyncio.run(run_endpoints(endpoints, requests, concurrency)),
+            })
+            remove_recorded_locations()
+    finally:
+        use_database(original_path)
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "created_at": main.get_jst_now().isoformat(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "seed": seed,
+            "requests": requests,
+            "concurrency": concurrency,
+        },
+        "runs": runs,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the API with a synthetic dataset")
+    parser.add_argument("--rows", default=DEFAULT_ROWS,
+                        help="comma separated row counts (e.g. 10000,100000,1000000)")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS),
+                        help=f"comma separated endpoints: {', '.join(ENDPOINTS)}")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--db-dir", default=None, help="directory for the generated databases")
+    parser.add_argument("--fresh", action="store_true", help="regenerate the databases")
+    parser.add_argument("--output", default=None, help="write the JSON result to this file")
+    args = parser.parse_args(argv)
+    endpoints = [name.strip() for name in args.endpoints.split(",") if name.strip()]
+    unknown = set(endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+    args.endpoints = endpoints
+    args.rows = [int(value) for value in args.rows.split(",")]
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # アプリの出力が結果のJSONに混ざらないようにする
+    with contextlib.redirect_stdout(sys.stderr):
+        result = run_benchmark(args.rows, args.endpoints, args.requests, args.concurrency,
+                               args.seed, args.db_dir, args.fresh)
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
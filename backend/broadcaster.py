@@ -0,0 +1,95 @@
+import asyncio
+import json
+import os
+
+from applog import get_logger
+
+logger = get_logger("broadcaster")
+
+# クライアントごとの未送信イベントの上限（超えたクライアントは切断する）
+SSE_QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE", "256"))
+
+
+def format_sse(event, data, event_id=None):
+    """Server-Sent Events 形式のメッセージを作る"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    lines.append(f"data: {payload}")
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+class Subscription:
+    """1クライアント分の配信キュー"""
+
+    def __init__(self, queue_size):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.evicted = False
+
+
+class Broadcaster:
+    """プロセス内のイベント配信
+
+    publish() はどのスレッドからでも呼べる。メッセージは1回だけエンコードして
+    全クライアントのキューに入れ、キューが溢れた（読み出しが遅い）クライアントは切断する。
+    """
+
+    def __init__(self, queue_size=SSE_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._loop = None
+
+    def attach(self, loop):
+        """配信に使うイベントループを設定する（lifespan開始時）"""
+        self._loop = loop
+
+    def detach(self):
+        """全クライアントを切断してループから外す（lifespan終了時）"""
+        for subscription in list(self._subscribers):
+            self._evict(subscription)
+        self._loop = None
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def subscribe(self):
+        subscription = Subscription(self.queue_size)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self._subscribers.discard(subscription)
+
+    def publish(self, event, data, event_id=None):
+        """イベントを全クライアントに配信する"""
+        loop = self._loop
+        if loop is None or loop.is_closed() or not self._subscribers:
+            return
+        message = format_sse(event, data, event_id)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._deliver(message)
+        else:
+            loop.call_soon_threadsafe(self._deliver, message)
+
+    def _deliver(self, message):
+        for subscription in list(self._subscribers):
+            try:
+                subscription.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                logger.warning("Evicting slow event stream consumer", extra={"event": "sse.evicted"})
+                self._evict(subscription)
+
+    def _evict(self, subscription):
+        """キューを空にして終了の合図（None）を入れる"""
+        self._subscribers.discard(subscription)
+        subscription.evicted = True
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
@@ -0,0 +1,192 @@
+import asyncio
+import contextvars
+import functools
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# プール設定（環境変数で調整可能）
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+# 接続ごとのプリペアドステートメントキャッシュ数
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+# DB・ファイルI/Oを同時に実行するスレッド数の上限（読み取りプール + 書き込み1本）
+DB_MAX_CONCURRENCY = int(os.getenv("DB_MAX_CONCURRENCY", str(DB_READ_POOL_SIZE + 1)))
+
+# ブロッキング処理専用のスレッドプール（イベントループを止めないため）
+_executor = ThreadPoolExecutor(max_workers=max(1, DB_MAX_CONCURRENCY), thread_name_prefix="db")
+
+
+async def run_blocking(func, *args, **kwargs):
+    """SQLiteや設定ファイルなどのブロッキング処理を専用スレッドプールで実行する"""
+    loop = asyncio.get_running_loop()
+    # 呼び出し元のコンテキスト（リクエストIDなど）をワーカースレッドに引き継ぐ
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, functools.partial(context.run, func, *args, **kwargs))
+
+
+class ObservedConnection(sqlite3.Connection):
+    """execute / executemany の実行時間を observer(sql, 秒) に通知する接続"""
+
+    observer = None
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            if self.observer is not None:
+                self.observer(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            if self.observer is not None:
+                self.observer(sql, time.perf_counter() - started)
+
+
+class ConnectionPool:
+    """読み取り用接続プールと単一の書き込み用接続を管理する
+
+    - WALジャーナルで読み取りと書き込みを並行させる
+    - 書き込みは1本の接続をロックで直列化し "database is locked" を避ける
+    - 接続を使い回すことで sqlite3 のステートメントキャッシュが効く
+    """
+
+    def __init__(self, db_path, read_pool_size=DB_READ_POOL_SIZE, initializer=None, observer=None):
+        # パス文字列、またはパスを返す関数（設定変更に追従させたい場合）
+        self.db_path = db_path
+        self._opened_path = None
+        self.read_pool_size = max(1, read_pool_size)
+        # 書き込み接続の初回オープン時に呼ばれる（スキーマ作成など）
+        self.initializer = initializer
+        # SQLの実行時間を受け取る関数（計測用。None なら通常の接続を使う）
+        self.observer = observer
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        # close() のたびに進め、貸し出し中だった古い接続をプールに戻さない
+        self._generation = 0
+
+    def _resolve_path(self):
+        return self.db_path() if callable(self.db_path) else self.db_path
+
+    def _check_path(self):
+        """DBパスが変わっていれば既存の接続を捨てる"""
+        path = self._resolve_path()
+        if path != self._opened_path:
+            self.close()
+            self._opened_path = path
+
+    def _connect(self, read_only=False):
+        conn = sqlite3.connect(
+            self._opened_path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+            factory=ObservedConnection if self.observer else sqlite3.Connection,
+        )
+        if self.observer:
+            conn.observer = self.observer
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        if read_only:
+            conn.execute("PRAGMA query_only = 1")
+        return conn
+
+    def _ensure_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                conn = self._connect()
+                try:
+                    # WALはデータベースファイルに永続化されるので書き込み接続で一度設定すればよい
+                    conn.execute("PRAGMA journal_mode = WAL")
+                    if self.initializer:
+                        self.initializer(conn)
+                        conn.commit()
+                except BaseException:
+                    # 移行に失敗した場合は途中の変更を残さない
+                    conn.rollback()
+                    conn.close()
+                    raise
+                self._writer = conn
+            return self._writer
+
+    @contextmanager
+    def writer(self):
+        """書き込み用接続を取得する（ブロック終了時にコミット、例外時にロールバック）"""
+        with self._writer_lock:
+            self._check_path()
+            conn = self._ensure_writer()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    @contextmanager
+    def reader(self):
+        """読み取り用接続をプールから借りる"""
+        self._check_path()
+        generation = self._generation
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            if generation != self._generation:
+                conn.close()
+            else:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._readers.put(conn)
+
+    def _acquire_reader(self):
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._reader_lock:
+            can_open = self._reader_count < self.read_pool_size
+            if can_open:
+                self._reader_count += 1
+
+        if not can_open:
+            # 上限に達している場合は返却を待つ
+            return self._readers.get()
+
+        try:
+            # スキーマが作られてから読み取り接続を開く
+            self._ensure_writer()
+            return self._connect(read_only=True)
+        except BaseException:
+            with self._reader_lock:
+                self._reader_count -= 1
+            raise
+
+    def close(self):
+        """全ての接続を閉じる（次回利用時に再接続される）"""
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._reader_lock:
+            self._generation += 1
+            while True:
+                try:
+                    self._readers.get_nowait().close()
+                except queue.Empty:
+                    break
+            self._reader_count = 0
@@ -0,0 +1,60 @@
+import math
+import os
+
+# クラスタリング用の多段グリッド（Webメルカトル座標を 2^level x 2^level に分割）
+# level L の1セルはズーム L - CLUSTER_LEVEL_OFFSET の地図タイル（256px）の 1/4 x 1/4（64px）に相当する
+GRID_MAX_LEVEL = int(os.getenv("GRID_MAX_LEVEL", "20"))
+CLUSTER_LEVEL_OFFSET = 2
+
+# Webメルカトルで表せる緯度の範囲
+MAX_MERCATOR_LAT = 85.0511287798
+
+
+def lonlat_to_unit(lon, lat):
+    """経度・緯度を [0, 1) のメルカトル座標（x は東向き、y は南向き）に変換する"""
+    lat = max(-MAX_MERCATOR_LAT, min(MAX_MERCATOR_LAT, lat))
+    x = (lon + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x, y
+
+
+def unit_to_lat(y):
+    """メルカトル座標の y を緯度に戻す"""
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+
+
+def cell_index(value, level):
+    """[0, 1] の座標をセル番号にする（端の値は最後のセルに含める）"""
+    size = 1 << level
+    return min(size - 1, max(0, int(value * size)))
+
+
+def point_cells(lat, lon, max_level=GRID_MAX_LEVEL):
+    """1点が属する各レベルのセル [(level, cell_x, cell_y), ...] を返す"""
+    x, y = lonlat_to_unit(lon, lat)
+    return [(level, cell_index(x, level), cell_index(y, level)) for level in range(max_level + 1)]
+
+
+def zoom_to_level(zoom):
+    """地図のズームレベルを集計に使うグリッドのレベルにする"""
+    return max(0, min(GRID_MAX_LEVEL, int(zoom) + CLUSTER_LEVEL_OFFSET))
+
+
+def cell_range(bbox, level):
+    """bbox（日付変更線をまたがないもの）を覆うセル番号の範囲 (x0, x1, y0, y1) を返す"""
+    west, south, east, north = bbox
+    x0, y_top = lonlat_to_unit(west, north)
+    x1, y_bottom = lonlat_to_unit(east, south)
+    return (cell_index(x0, level), cell_index(x1, level),
+            cell_index(y_top, level), cell_index(y_bottom, level))
+
+
+def cell_bounds(level, cell_x, cell_y):
+    """セルの範囲 (west, south, east, north) を経度・緯度で返す"""
+    size = 1 << level
+    west = cell_x / size * 360.0 - 180.0
+    east = (cell_x + 1) / size * 360.0 - 180.0
+    north = unit_to_lat(cell_y / size)
+    south = unit_to_lat((cell_y + 1) / size)
+    return west, south, east, north
@@ -0,0 +1,182 @@
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from geogrid import MAX_MERCATOR_LAT
+
+# ヒートマップタイルの設定
+TILE_SIZE = 256
+# ぼかしの半径（ピクセル）。タイルの外側この幅までの点も集計に含める
+HEATMAP_RADIUS = int(os.getenv("HEATMAP_RADIUS", "12"))
+# この密度で色が半分の濃さになる（タイルごとに正規化しないので境目が出ない）
+HEATMAP_SCALE = float(os.getenv("HEATMAP_SCALE", "3.0"))
+# uint16 出力の固定小数点の倍率（値 / 256 が密度）
+HEATMAP_U16_SCALE = 256
+HEATMAP_CACHE_SIZE = int(os.getenv("HEATMAP_CACHE_SIZE", "256"))
+
+
+def to_tile_pixels(lats, lons, z, x, y):
+    """経度・緯度の配列をタイル (z, x, y) 内のピクセル座標に変換する"""
+    lats = np.clip(np.asarray(lats, dtype=np.float64), -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT)
+    lons = np.asarray(lons, dtype=np.float64)
+    scale = (1 << z) * TILE_SIZE
+    sin_lat = np.sin(np.radians(lats))
+    unit_x = (lons + 180.0) / 360.0
+    unit_y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)
+    return unit_y * scale - y * TILE_SIZE, unit_x * scale - x * TILE_SIZE
+
+
+def gaussian_kernel(radius):
+    """ピークが1になる1次元のガウス関数（2次元のピークも1になる）"""
+    offsets = np.arange(-radius, radius + 1, dtype=np.float64)
+    sigma = max(radius / 2.0, 1e-6)
+    return np.exp(-(offsets ** 2) / (2 * sigma ** 2))
+
+
+def smooth(grid, kernel):
+    """分離可能なカーネルで縦・横の順にぼかす（ずらした配列の加算で計算する）"""
+    radius = len(kernel) // 2
+    for axis in (0, 1):
+        padded = np.pad(grid, [(radius, radius) if a == axis else (0, 0) for a in (0, 1)])
+        result = np.zeros_like(grid)
+        length = grid.shape[axis]
+        for offset, weight in enumerate(kernel):
+            window = padded[offset:offset + length] if axis == 0 else padded[:, offset:offset + length]
+            result += weight * window
+        grid = result
+    return grid
+
+
+def render_density(rows, cols, radius=HEATMAP_RADIUS):
+    """タイル内のピクセル座標から TILE_SIZE x TILE_SIZE の密度を計算する
+
+    rows / cols にはタイルの外側 radius ピクセルまでの点を含めてよい
+    （隣のタイルとの境目でぼかしが途切れないようにするため）。
+    """
+    size = TILE_SIZE + 2 * radius
+    counts, _, _ = np.histogram2d(rows, cols, bins=size,
+                                  range=[[-radius, TILE_SIZE + radius], [-radius, TILE_SIZE + radius]])
+    density = smooth(counts, gaussian_kernel(radius))
+    return density[radius:radius + TILE_SIZE, radius:radius + TILE_SIZE]
+
+
+def encode_u16(density):
+    """密度を固定小数点の uint16（リトルエンディアン、行優先）にする"""
+    scaled = np.clip(np.rint(density * HEATMAP_U16_SCALE), 0, 0xFFFF)
+    return scaled.astype("<u2").tobytes()
+
+
+def colorize(density):
+    """密度を RGBA（透明 → 黄 → 赤）に変換する"""
+    intensity = 1.0 - np.exp(-density * (np.log(2) / HEATMAP_SCALE))
+    rgba = np.empty(density.shape + (4,), dtype=np.uint8)
+    rgba[..., 0] = 255
+    rgba[..., 1] = np.rint(255 * (1.0 - intensity)).astype(np.uint8)
+    rgba[..., 2] = 0
+    rgba[..., 3] = np.rint(220 * np.sqrt(intensity)).astype(np.uint8)
+    return rgba
+
+
+def encode_png(rgba):
+    """RGBA配列をPNGにエンコードする（Pillowを使わずzlibで圧縮する）"""
+    height, width, _ = rgba.shape
+    # 各行の先頭にフィルタ種別（0: なし）を付ける
+    raw = np.concatenate([np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)], axis=1)
+
+    def chunk(kind, data):
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)) + chunk(b"IEND", b""))
+
+
+def affected_tiles(points, z, radius=HEATMAP_RADIUS):
+    """点 [(緯度, 経度), ...] が影響するズーム z のタイル {(x, y), ...} を計算で求める
+
+    半径はタイルの幅より小さいので、1点が影響するタイルは縦横それぞれ最大2枚になる。
+    """
+    lats, lons = zip(*points)
+    rows, cols = to_tile_pixels(lats, lons, z, 0, 0)
+    last = (1 << z) - 1
+    # ぼかしの範囲を含めて -radius <= 位置 - タイルの端 < TILE_SIZE + radius を満たすタイルの範囲
+    x_min = np.clip(np.floor((cols - radius) / TILE_SIZE), 0, last).astype(np.int64)
+    x_max = np.clip(np.floor((cols + radius) / TILE_SIZE), 0, last).astype(np.int64)
+    y_min = np.clip(np.floor((rows - radius) / TILE_SIZE), 0, last).astype(np.int64)
+    y_max = np.clip(np.floor((rows + radius) / TILE_SIZE), 0, last).astype(np.int64)
+    tiles = set()
+    for xs in (x_min, x_max):
+        for ys in (y_min, y_max):
+            tiles.update(zip(xs.tolist(), ys.tolist()))
+    return tiles
+
+
+class TileCache:
+    """描画済みタイルのLRUキャッシュ
+
+    点の追加・削除では、その点が影響するタイルだけを捨てる（キャッシュ中のズームごとに計算で求める）。
+    描画中に無効化があった場合は、古い結果をキャッシュに入れない。
+    辞書の操作はすべてロックの中で行う（無効化はDBスレッドから呼ばれ、get() と並行する）。
+    """
+
+    def __init__(self, max_size=HEATMAP_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._tiles = OrderedDict()
+        # キャッシュ中のキーの (z, x, y) 以降の部分（形式など）
+        self._suffixes = set()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            body = self._tiles.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body, generation):
+        """描画開始時の世代が変わっていなければ保存する"""
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._tiles[key] = body
+            self._tiles.move_to_end(key)
+            self._suffixes.add(key[3:])
+            while len(self._tiles) > self.max_size:
+                self._tiles.popitem(last=False)
+
+    def invalidate_points(self, points):
+        """追加・削除された点 [(緯度, 経度), ...] が影響するタイルを捨てる"""
+        if not points:
+            return
+        with self._lock:
+            self._generation += 1
+            zooms = {key[0] for key in self._tiles}
+            suffixes = list(self._suffixes)
+        # 影響するタイルの計算はロックの外で行う（ロック中は辞書の操作だけ）
+        keys = [(z, x, y) + suffix for z in zooms for x, y in affected_tiles(points, z) for suffix in suffixes]
+        with self._lock:
+            for key in keys:
+                self._tiles.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._tiles.clear()
+
+    def __len__(self):
+        return len(self._tiles)
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import time
+
+from applog import get_logger
+from db import run_blocking
+
+logger = get_logger("ingest")
+
+# 書き込みキューの設定（環境変数で調整可能）
+# commit: DBへのコミット後に応答する / enqueue: キューに入れた時点で応答する
+INGEST_DURABILITY = os.getenv("INGEST_DURABILITY", "commit")
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "1000"))
+INGEST_MAX_BATCH = int(os.getenv("INGEST_MAX_BATCH", "100"))
+INGEST_MAX_DELAY_MS = float(os.getenv("INGEST_MAX_DELAY_MS", "20"))
+INGEST_ENQUEUE_TIMEOUT = float(os.getenv("INGEST_ENQUEUE_TIMEOUT", "1.0"))
+
+
+class IngestQueueFull(Exception):
+    """キューが一杯で受け付けられない（バックプレッシャー）"""
+
+
+class IngestQueue:
+    """位置情報記録の書き込みキュー
+
+    リクエストはキューに入れるだけにして、1つのバックグラウンドタスクが
+    件数（max_batch）か待ち時間（max_delay_ms）のしきい値でまとめてコミットする。
+    writer は記録のリストを受け取り、要素ごとの結果のリストを返す同期関数。
+    """
+
+    def __init__(self, writer, durability=INGEST_DURABILITY, queue_size=INGEST_QUEUE_SIZE,
+                 max_batch=INGEST_MAX_BATCH, max_delay_ms=INGEST_MAX_DELAY_MS,
+                 enqueue_timeout=INGEST_ENQUEUE_TIMEOUT):
+        if durability not in ("commit", "enqueue"):
+            raise ValueError(f"Unknown ingest durability mode: {durability}")
+        self.writer = writer
+        self.durability = durability
+        self.queue_size = queue_size
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay_ms / 1000
+        self.enqueue_timeout = enqueue_timeout
+        self._queue = None
+        self._task = None
+        self._accepting = False
+        self._closed = False
+
+    @property
+    def running(self):
+        return self._accepting
+
+    @property
+    def depth(self):
+        """キューに溜まっている件数"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._accepting = True
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """受付を止め、キューに残っている分を書き込んでから終了する"""
+        self._accepting = False
+        if self._task is None:
+            return
+        # 待機中のワーカーを起こす合図。ワーカーはキューが空になるまで処理してから抜ける
+        # （キューが一杯ならワーカーは処理中なので、合図を待たずに終了を判断できる）
+        try:
+            self._queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+        await self._task
+        self._task = None
+        # ワーカーの終了後にキューへ入った記録は書き込まれないので、待っている送信元に失敗を返す
+        self._closed = True
+        self._reject_pending()
+
+    def _reject_pending(self):
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if entry is None:
+                continue
+            _, future = entry
+            if future is not None and not future.done():
+                future.set_exception(IngestQueueFull())
+
+    async def submit(self, item):
+        """記録をキューに入れる
+
+        commit モードではコミット後の結果を、enqueue モードでは None を返す。
+        キューが一杯のまま enqueue_timeout を過ぎた場合は IngestQueueFull。
+        """
+        if not self._accepting:
+            raise RuntimeError("Ingest queue is not running")
+        future = None
+        if self.durability == "commit":
+            future = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(self._queue.put((item, future)), timeout=self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            raise IngestQueueFull()
+        if self._closed:
+            # 待っている間にワーカーが終了した
+            self._reject_pending()
+            if future is None:
+                raise IngestQueueFull()
+        if future is None:
+            return None
+        return await future
+
+    async def _run(self):
+        while self._accepting or not self._queue.empty():
+            entry = await self._queue.get()
+            if entry is None:
+                continue
+            batch = [entry]
+            deadline = time.monotonic() + self.max_delay
+            # しきい値に達するまで後続の記録をまとめる
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    if timeout <= 0:
+                        entry = self._queue.get_nowait()
+                    else:
+                        entry = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if entry is None:
+                    break
+                batch.append(entry)
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = await run_blocking(self.writer, items)
+        except Exception as e:
+            logger.exception("Error in ingest group commit", extra={"event": "ingest.commit_failed",
+                                                                     "size": len(items)})
+            for _, future in batch:
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if future is not None and not future.done():
+                future.set_result(result)
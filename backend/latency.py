@@ -0,0 +1,23 @@
+import numpy as np
+
+# レイテンシの集計（ベンチマークとリプレイで共通）
+PERCENTILES = (50, 95, 99)
+
+
+def summarize_latencies(latencies_ms, errors, elapsed):
+    """レイテンシのリスト（ミリ秒）からスループットとパーセンタイルを計算する"""
+    count = len(latencies_ms)
+    result = {
+        "requests": count,
+        "errors": errors,
+        "duration_s": round(elapsed, 4),
+        "throughput_rps": round(count / elapsed, 2) if elapsed > 0 else None,
+    }
+    if count:
+        values = np.asarray(latencies_ms)
+        result["latency_ms"] = {
+            **{f"p{p}": round(float(np.percentile(values, p)), 3) for p in PERCENTILES},
+            "mean": round(float(values.mean()), 3),
+            "max": round(float(values.max()), 3),
+        }
+    return result
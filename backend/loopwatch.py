@@ -0,0 +1,316 @@
+import asyncio
+import collections
+import contextvars
+import datetime
+import os
+import sys
+import threading
+import time
+import traceback
+from urllib.parse import parse_qsl
+
+from applog import get_logger, request_id_var
+
+# イベントループの遅延の監視と、遅いリクエストのサンプリング
+# ループの心拍（一定間隔の sleep）が止まったら、監視スレッドからループのスタックを取る
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+# 心拍がこれ以上遅れたらループが止まっているとみなす（ミリ秒）
+LOOP_STALL_THRESHOLD_MS = float(os.getenv("LOOP_STALL_THRESHOLD_MS", "200"))
+# これ以上かかったリクエストを記録する（ミリ秒）
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "1000"))
+# 保持する遅いリクエスト・ループ停止の件数
+SLOW_REQUEST_KEEP = int(os.getenv("SLOW_REQUEST_KEEP", "50"))
+STACK_DEPTH = 25
+# 接続を開いたままにするレスポンス（遅いリクエストとして扱わない）
+STREAMING_CONTENT_TYPES = (b"text/event-stream",)
+
+logger = get_logger("loopwatch")
+
+# 処理中のリクエストの計測値（run_blocking がコンテキストを引き継ぐので、DBスレッドからも参照できる）
+current_profile = contextvars.ContextVar("request_profile", default=None)
+
+
+def add_db_time(seconds):
+    """処理中のリクエストにSQLの実行時間を足す（SQLの observer から呼ぶ）"""
+    profile = current_profile.get()
+    if profile is not None:
+        profile.db_seconds += seconds
+        profile.db_statements += 1
+
+
+def format_stack(frame):
+    """フレームから "ファイル:行 関数" のリストを作る（内側が最後）"""
+    return [f"{os.path.basename(entry.filename)}:{entry.lineno} {entry.name}"
+            for entry in traceback.extract_stack(frame, limit=STACK_DEPTH)]
+
+
+def is_idle_worker(stack):
+    """スレッドプールのワーカーが仕事待ち（work_queue.get）で止まっているか"""
+    for index, entry in enumerate(stack):
+        if entry.endswith(" _worker"):
+            return index + 1 < len(stack) and stack[index + 1].endswith(" get")
+    return False
+
+
+def capture_stacks(loop_thread_id, worker_prefix="db_"):
+    """ループのスレッドと、処理中のワーカースレッドのスタックを取る"""
+    frames = sys._current_frames()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = []
+    for thread_id, frame in frames.items():
+        name = names.get(thread_id, str(thread_id))
+        if thread_id == loop_thread_id:
+            stacks.insert(0, {"thread": "event-loop", "stack": format_stack(frame)})
+        elif name.startswith(worker_prefix):
+            stack = format_stack(frame)
+            if not is_idle_worker(stack):
+                stacks.append({"thread": name, "stack": stack})
+    return stacks
+
+
+def value_shape(value):
+    """クエリの値の形（値そのものは残さない）"""
+    if value == "":
+        return "empty"
+    parts = value.split(",")
+    kinds = set()
+    for part in parts:
+        try:
+            int(part)
+            kinds.add("int")
+            continue
+        except ValueError:
+            pass
+        try:
+            float(part)
+            kinds.add("float")
+        except ValueError:
+            kinds.add("str")
+    kind = "str" if "str" in kinds else "float" if "float" in kinds else "int"
+    return f"{kind}[{len(parts)}]" if len(parts) > 1 else kind
+
+
+def is_streaming_response(message):
+    """http.response.start のヘッダーから、接続を開いたままにするレスポンスか判定する"""
+    for name, value in message.get("headers", []):
+        if name.lower() == b"content-type":
+            return value.lower().startswith(STREAMING_CONTENT_TYPES)
+    return False
+
+
+def params_shape(scope):
+    """パス引数の名前・クエリの名前と値の形・ボディの大きさ"""
+    query = scope.get("query_string", b"").decode("latin-1")
+    content_length = None
+    for name, value in scope.get("headers", []):
+        if name == b"content-length":
+            content_length = int(value) if value.isdigit() else None
+            break
+    return {
+        "path": sorted(scope.get("path_params", {})),
+        "query": {key: value_shape(value) for key, value in parse_qsl(query, keep_blank_values=True)},
+        "body_bytes": content_length,
+    }
+
+
+class RequestProfile:
+    """1リクエストの計測値"""
+
+    __slots__ = ("started", "db_seconds", "db_statements", "stacks", "max_loop_lag")
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.db_seconds = 0.0
+        self.db_statements = 0
+        self.stacks = None
+        self.max_loop_lag = 0.0
+
+
+class LoopWatchdog:
+    """イベントループの遅延を測り、止まっている間や遅いリクエストのスタックを取る
+
+    start() / stop() は lifespan から呼ぶ。遅延はループ上のタスクで、停止の検出とスタックの取得は
+    別スレッドで行う（ループが止まっている間もスタックを取れるように）。
+    """
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL, stall_threshold_ms=LOOP_STALL_THRESHOLD_MS,
+                 slow_threshold_ms=SLOW_REQUEST_THRESHOLD_MS, keep=SLOW_REQUEST_KEEP):
+        self.interval = interval
+        self.stall_threshold = stall_threshold_ms / 1000
+        self.slow_threshold = slow_threshold_ms / 1000
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.stall_count = 0
+        self.stalls = collections.deque(maxlen=keep)
+        self.slow_requests = collections.deque(maxlen=keep)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._task = None
+        self._thread = None
+        self._stopping = threading.Event()
+        self._loop_thread_id = None
+        self._beat = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self._beat = now
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            with self._lock:
+                profiles = list(self._inflight.values())
+            for profile in profiles:
+                profile.max_loop_lag = max(profile.max_loop_lag, lag)
+
+    def _monitor(self):
+        stalled = False
+        while not self._stopping.wait(self.interval / 2):
+            now = time.monotonic()
+            blocked = now - self._beat - self.interval
+            if blocked > self.stall_threshold:
+                if not stalled:
+                    # 1回の停止につき1度だけスタックを取る
+                    stalled = True
+                    self._record_stall(blocked)
+            else:
+                stalled = False
+            self._sample_slow_requests(now)
+
+    def _record_stall(self, blocked):
+        stacks = capture_stacks(self._loop_thread_id)
+        stall = {
+            "at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "blocked_ms": round(blocked * 1000, 1),
+            "stack": stacks[0]["stack"] if stacks and stacks[0]["thread"] == "event-loop" else [],
+        }
+        self.stall_count += 1
+        self.stalls.append(stall)
+        logger.warning("Event loop blocked for %.0f ms", stall["blocked_ms"], extra={
+            "event": "loop.stalled", "blocked_ms": stall["blocked_ms"],
+            "top_frame": stall["stack"][-1] if stall["stack"] else None})
+
+    def _sample_slow_requests(self, now):
+        """しきい値を超えて処理中のリクエストについて、その時点のスタックを取る"""
+        with self._lock:
+            profiles = [profile for profile in self._inflight.values()
+                        if profile.stacks is None and now - profile.started > self.slow_threshold]
+        if profiles:
+            stacks = capture_stacks(self._loop_thread_id)
+            for profile in profiles:
+                profile.stacks = stacks
+
+    def begin(self, key):
+        profile = RequestProfile()
+        with self._lock:
+            self._inflight[key] = profile
+        return profile
+
+    def end(self, key):
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    def record_slow_request(self, entry):
+        self.slow_requests.append(entry)
+        logger.warning("Slow request %s %s took %.0f ms", entry["method"], entry["route"], entry["duration_ms"],
+                       extra={"event": "request.slow", "route": entry["route"],
+                              "duration_ms": entry["duration_ms"], "db_ms": entry["db_ms"]})
+
+    def report(self, limit=None):
+        """管理者API用：ループの遅延と直近の遅いリクエスト（新しい順）"""
+        requests = list(self.slow_requests)[::-1]
+        return {
+            "running": self.running,
+            "slow_request_threshold_ms": self.slow_threshold * 1000,
+            "loop": {
+                "last_lag_ms": round(self.last_lag * 1000, 3),
+                "max_lag_ms": round(self.max_lag * 1000, 3),
+                "stall_threshold_ms": self.stall_threshold * 1000,
+                "stalls": self.stall_count,
+                "recent_stalls": list(self.stalls)[::-1],
+            },
+            "requests": requests[:limit] if limit else requests,
+        }
+
+
+class SlowRequestMiddleware:
+    """しきい値より遅かったリクエストのルート・引数の形・DB時間・スタックを記録するASGIミドルウェア
+
+    引数の値やボディそのものは記録しない。SSEのように接続を開いたままにするレスポンスは、
+    ヘッダーを送った時点で計測をやめる（接続時間を遅さとして数えない）。
+    """
+
+    def __init__(self, app, watchdog, route_path):
+        self.app = app
+        self.watchdog = watchdog
+        self.route_path = route_path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        streaming = False
+        key = object()
+
+        async def send_wrapper(message):
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if is_streaming_response(message):
+                    streaming = True
+                    self.watchdog.end(key)
+            await send(message)
+
+        profile = self.watchdog.begin(key)
+        token = current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_profile.reset(token)
+            self.watchdog.end(key)
+            elapsed = time.monotonic() - profile.started
+            if not streaming and elapsed > self.watchdog.slow_threshold:
+                self.watchdog.record_slow_request({
+                    "at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds"),
+                    "request_id": request_id_var.get(),
+                    "method": scope["method"],
+                    "route": self.route_path(scope),
+                    "params": params_shape(scope),
+                    "status": status,
+                    "duration_ms": round(elapsed * 1000, 1),
+                    "db_ms": round(profile.db_seconds * 1000, 1),
+                    "db_statements": profile.db_statements,
+                    "max_loop_lag_ms": round(profile.max_loop_lag * 1000, 1),
+                    "stacks": profile.stacks or [],
+                })
@@ -1,20 +1,71 @@
-from fastapi import FastAPI, HTTPException, Depends, Header, Response, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, field_validator
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError, field_validator
 import sqlite3
 import jwt
 import datetime
-from typing import Optional
+from typing import Any, List, Optional
 import uuid
 import os
 import pytz
 import json
-import traceback
 import shutil
+import threading
+import time
+import asyncio
+import re
+import email.utils
+import gzip
+import functools
+import base64
+import csv
+import io
+import zlib
+from contextlib import asynccontextmanager
+from db import ConnectionPool, run_blocking
+from broadcaster import Broadcaster, format_sse
+from ingest import IngestQueue, IngestQueueFull
+import geogrid
+import heatmap
+from snapshot import MISSING_TIMESTAMP_MS, LocationSnapshot, summarize
+from traffic import TRAFFIC_CAPTURE_FILE, TrafficCaptureMiddleware, TrafficRecorder
+import metrics
+import applog
+import loopwatch
+from applog import LOG_REQUEST_BODIES
 
-app = FastAPI(title="Namecard Places API")
+# 構造化ログ（JSONを標準エラーに書き出す。書き出しはバックグラウンドのスレッドで行う）
+applog.configure_logging()
+logger = applog.get_logger()
+
+@asynccontextmanager
+async def lifespan(app):
+    """起動時にバックグラウンドタスクを開始し、終了時に停止する"""
+    broadcaster.attach(asyncio.get_running_loop())
+    await session_scheduler.start()
+    await ingest_queue.start()
+    await loop_watchdog.start()
+    backfill_task = asyncio.create_task(backfill_timestamps())
+    try:
+        yield
+    finally:
+        backfill_task.cancel()
+        try:
+            await backfill_task
+        except asyncio.CancelledError:
+            pass
+        # キューに残っている記録を書き込んでから止める
+        await ingest_queue.stop()
+        await session_scheduler.stop()
+        await loop_watchdog.stop()
+        broadcaster.detach()
+        if traffic_recorder is not None:
+            await run_blocking(traffic_recorder.close)
+        await run_blocking(applog.flush)
+
+app = FastAPI(title="Namecard Places API", lifespan=lifespan)
 
 # CORS設定
 app.add_middleware(
@@ -32,8 +83,43 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Last-Modified", "X-Request-ID"],
 )
 
+# トラフィックの記録（TRAFFIC_CAPTURE_FILE を指定したときだけ。replay.py で再送できる）
+traffic_recorder = TrafficRecorder(TRAFFIC_CAPTURE_FILE) if TRAFFIC_CAPTURE_FILE else None
+if traffic_recorder is not None:
+    app.add_middleware(TrafficCaptureMiddleware, recorder=traffic_recorder)
+
+# メトリクス（/metrics で Prometheus 形式で出力する）
+http_requests_total = metrics.Counter(
+    "http_requests_total", "HTTP requests by route, method and status", ("route", "method", "status"))
+http_request_duration = metrics.Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route, method and status",
+    ("route", "method", "status"))
+sql_statement_duration = metrics.Histogram(
+    "sqlite_statement_duration_seconds", "SQLite execute time by named statement",
+    ("statement",), buckets=metrics.SQL_BUCKETS)
+# ルートのパスのテンプレート（メトリクスと遅いリクエストの記録で共有する）
+route_path = metrics.RouteResolver()
+app.add_middleware(metrics.MetricsMiddleware, requests=http_requests_total, latency=http_request_duration,
+                   route_path=route_path)
+
+# イベントループの遅延の監視と、遅いリクエストの記録（/api/admin/slow-requests で参照する）
+loop_watchdog = loopwatch.LoopWatchdog()
+app.add_middleware(loopwatch.SlowRequestMiddleware, watchdog=loop_watchdog, route_path=route_path)
+
+# リクエストIDとアクセスログ（最も外側に置き、他のミドルウェアのログにもIDが付くようにする）
+app.add_middleware(applog.RequestContextMiddleware)
+
+# SQL文字列 -> 名前（SQL_* 定数の名前。モジュールの末尾で埋める）
+SQL_STATEMENT_NAMES = {}
+
+def observe_sql_statement(sql, seconds):
+    """接続プールから呼ばれ、SQLの実行時間を記録する（定数にない文は "other"）"""
+    sql_statement_duration.observe(seconds, SQL_STATEMENT_NAMES.get(sql, "other"))
+    loopwatch.add_db_time(seconds)
+
 # JWT秘密鍵（本番環境では環境変数から取得）
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")  # 本番環境では変更必須
@@ -57,6 +143,114 @@ def get_jst_timestamp(dt=None):
         dt = pytz.UTC.localize(dt).astimezone(JST)
     return dt.isoformat()
 
+# JSTの固定オフセット（日本に夏時間はないので pytz の astimezone を使わずに済む）
+JST_OFFSET = datetime.timezone(datetime.timedelta(hours=9))
+# 整形済みタイムスタンプのキャッシュ件数
+TIMESTAMP_FORMAT_CACHE_SIZE = int(os.getenv("TIMESTAMP_FORMAT_CACHE_SIZE", "65536"))
+
+def datetime_to_ms(dt):
+    """datetimeをエポックミリ秒に変換する"""
+    return round(dt.timestamp() * 1000)
+
+def timestamp_to_ms(timestamp):
+    """ISO形式のタイムスタンプ文字列をエポックミリ秒に変換する（変換できなければNone）"""
+    try:
+        dt = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+    if dt.tzinfo is None:
+        # ナイーブな値（CURRENT_TIMESTAMP など）はUTCとして扱う
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return datetime_to_ms(dt)
+
+@functools.lru_cache(maxsize=TIMESTAMP_FORMAT_CACHE_SIZE)
+def format_timestamp_ms(timestamp_ms):
+    """エポックミリ秒をJSTのISO形式に整形する（同じ値は一度だけ整形する）"""
+    seconds, millis = divmod(timestamp_ms, 1000)
+    dt = datetime.datetime.fromtimestamp(seconds, JST_OFFSET).replace(microsecond=millis * 1000)
+    return dt.isoformat(timespec="milliseconds" if millis else "seconds")
+
+def location_timestamp(timestamp_ms, timestamp, epoch=False):
+    """記録のタイムスタンプを出力形式にする（timestamp_ms が未設定の行は文字列から変換）"""
+    if timestamp_ms is None:
+        timestamp_ms = timestamp_to_ms(timestamp)
+        if timestamp_ms is None:
+            return None if epoch else timestamp
+    return timestamp_ms if epoch else format_timestamp_ms(timestamp_ms)
+
+# タイムスタンプをエポックミリ秒のまま返すメディアタイプ（Accept ヘッダーで指定する）
+EPOCH_MEDIA_TYPE = "application/vnd.namecard-places.epoch+json"
+
+def wants_epoch(request):
+    """クライアントがエポックミリ秒形式を要求しているか判定する"""
+    return EPOCH_MEDIA_TYPE in request.headers.get("accept", "")
+
+class ResourceVersions:
+    """公開APIのリソースごとの更新カウンタ（ETag・Last-Modified の生成用）
+
+    設定の保存、セッションの更新、位置情報の追加・削除のたびに bump() する。
+    カウンタはプロセス内のものなので、起動ごとに異なる接頭辞をETagに含める。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._modified = {}
+        self._boot_id = uuid.uuid4().hex[:8]
+        self._started_at = int(time.time())
+
+    def bump(self, resource):
+        """カウンタを進め、新しい (バージョン, Last-Modified) を返す"""
+        with self._lock:
+            self._versions[resource] = self._versions.get(resource, 0) + 1
+            # Last-Modified は秒単位なので、同じ秒の更新でも必ず値が進むようにする
+            previous = self._modified.get(resource, self._started_at)
+            self._modified[resource] = max(int(time.time()), previous + 1)
+            return self._versions[resource], self._modified[resource]
+
+    def version(self, resource):
+        return self._versions.get(resource, 0)
+
+    def etag(self, resource, version=None, suffix=""):
+        if version is None:
+            version = self.version(resource)
+        return f'"{resource}-{self._boot_id}-{version}{suffix}"'
+
+    def last_modified(self, resource):
+        return self._modified.get(resource, self._started_at)
+
+resource_versions = ResourceVersions()
+
+def validator_headers(etag, last_modified):
+    """ETag・Last-Modified ヘッダーを生成する"""
+    return {
+        "ETag": etag,
+        "Last-Modified": email.utils.formatdate(last_modified, usegmt=True),
+        # キャッシュしてよいが毎回再検証させる
+        "Cache-Control": "no-cache",
+    }
+
+def is_not_modified(request, etag, last_modified):
+    """条件付きリクエスト（If-None-Match / If-Modified-Since）が一致するか判定する"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+        # If-None-Match は弱い比較で判定する
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return last_modified <= since
+    return False
+
+def not_modified_response(headers):
+    return Response(status_code=304, headers=headers)
+
 # データモデル
 class LocationRecord(BaseModel):
     latitude: float
@@ -86,6 +280,10 @@ class RecordingSession(BaseModel):
 class AdminLogin(BaseModel):
     password: str
 
+class LocationBatch(BaseModel):
+    # 各要素は記録時に個別に検証する（不正な要素があってもバッチ全体は失敗させない）
+    locations: List[Any]
+
 class NameCardConfig(BaseModel):
     personalInfo: dict
     socialLinks: list
@@ -101,7 +299,7 @@ def load_config():
         # 設定ファイルが存在しない場合、サンプルからコピー
         if not os.path.exists(CONFIG_FILE) and os.path.exists(EXAMPLE_CONFIG_FILE):
             shutil.copy2(EXAMPLE_CONFIG_FILE, CONFIG_FILE)
-            print(f"Created {CONFIG_FILE} from {EXAMPLE_CONFIG_FILE}")
+            logger.info("Created %s from %s", CONFIG_FILE, EXAMPLE_CONFIG_FILE, extra={"event": "config.created"})
         
         if os.path.exists(CONFIG_FILE):
             with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
@@ -126,8 +324,8 @@ def load_config():
                     "showQRCode": False
                 }
             }
-    except Exception as e:
-        print(f"Error loading config: {e}")
+    except Exception:
+        logger.exception("Error loading config", extra={"event": "config.load_failed"})
         # エラーの場合はデフォルト設定を返す
         return {
             "personalInfo": {
@@ -154,13 +352,173 @@ def save_config(config_data):
         with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
             json.dump(config_data, f, ensure_ascii=False, indent=2)
         return True
-    except Exception as e:
-        print(f"Error saving config: {e}")
+    except Exception:
+        logger.exception("Error saving config", extra={"event": "config.save_failed"})
         return False
+    finally:
+        config_cache.invalidate()
+
+def build_card_info(config):
+    """名刺表示用の情報を設定から生成する"""
+    # personalInfoから表示用の情報を生成
+    personal_info = config.get("personalInfo", {})
+    social_links = config.get("socialLinks", [])
+    design = config.get("design", {})
+    
+    # 空文字列の項目をフィルタリング
+    filtered_info = {}
+    for key, value in personal_info.items():
+        if value and value.strip():  # 空文字列や空白文字のみでない場合
+            filtered_info[key] = value
+    
+    # 有効なソーシャルリンクのみをフィルタリング
+    enabled_social_links = [
+        link for link in social_links 
+        if link.get("enabled", False) and link.get("url", "").strip()
+    ]
+    
+    return {
+        "personalInfo": filtered_info,
+        "socialLinks": enabled_social_links,
+        "design": design
+    }
+
+# 設定ファイルの変更確認の間隔（秒）。この間はstatも行わずキャッシュを返す
+CONFIG_CHECK_INTERVAL = float(os.getenv("CONFIG_CHECK_INTERVAL", "1.0"))
+
+class ConfigCache:
+    """設定ファイルと /api/card-info のレスポンスのキャッシュ
+
+    save_config() のほか、config.json の mtime・inode・サイズが変わった場合
+    （docker-compose でマウントしたファイルを差し替えた場合など）にも読み直す。
+    キャッシュは (ETag, Last-Modified, 本文) の組で、読み直しのたびに組ごと差し替える。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._signature = None
+        self._entry = None
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _stat_signature():
+        try:
+            st = os.stat(CONFIG_FILE)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def peek(self):
+        """直近に確認済みのキャッシュがあればI/Oなしで返す（なければNone）"""
+        entry = self._entry
+        if entry is not None and time.monotonic() - self._checked_at < CONFIG_CHECK_INTERVAL:
+            self.hits += 1
+            return entry
+        return None
+
+    def refresh(self):
+        """ファイルの変更を確認し、必要なら読み直したキャッシュを返す"""
+        with self._lock:
+            signature = self._stat_signature()
+            if self._entry is None or signature != self._signature:
+                self.misses += 1
+                config = load_config()
+                # load_config() がサンプルからコピーした場合に備えて取り直す
+                self._signature = self._stat_signature()
+                body = encode_json(build_card_info(config))
+                version, last_modified = resource_versions.bump("card-info")
+                # ETag と本文が食い違わないよう、1つのタプルとして差し替える
+                self._entry = (resource_versions.etag("card-info", version), last_modified, body)
+            else:
+                self.hits += 1
+            self._checked_at = time.monotonic()
+            return self._entry
+
+    def invalidate(self):
+        with self._lock:
+            self._entry = None
+            self._signature = None
+
+config_cache = ConfigCache()
+
+# R*Tree を locations から作り直すSQL（移行時と再構築コマンドで使う）
+SQL_FILL_LOCATION_RTREE = '''
+    INSERT INTO location_rtree (id, min_lon, max_lon, min_lat, max_lat)
+    SELECT id, longitude, longitude, latitude, latitude FROM locations
+'''
+
+SQL_UPSERT_GRID_CELL = '''
+    INSERT INTO location_grid (level, cell_x, cell_y, count, sum_lat, sum_lon)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (level, cell_x, cell_y) DO UPDATE SET
+        count = count + excluded.count,
+        sum_lat = sum_lat + excluded.sum_lat,
+        sum_lon = sum_lon + excluded.sum_lon
+'''
+SQL_DELETE_EMPTY_GRID_CELL = '''
+    DELETE FROM location_grid WHERE level = ? AND cell_x = ? AND cell_y = ? AND count <= 0
+'''
+
+def update_location_grid(conn, points, sign=1):
+    """追加（sign=1）・削除（sign=-1）された点 [(緯度, 経度), ...] をグリッドに反映する"""
+    deltas = {}
+    for lat, lon in points:
+        for cell in geogrid.point_cells(lat, lon):
+            count, sum_lat, sum_lon = deltas.get(cell, (0, 0.0, 0.0))
+            deltas[cell] = (count + sign, sum_lat + sign * lat, sum_lon + sign * lon)
+    conn.executemany(SQL_UPSERT_GRID_CELL, [cell + delta for cell, delta in deltas.items()])
+    if sign < 0:
+        conn.executemany(SQL_DELETE_EMPTY_GRID_CELL, list(deltas))
+
+def fill_location_grid(conn):
+    """グリッドを locations から作り直す（移行時と再構築コマンドで使う）"""
+    conn.execute('DELETE FROM location_grid')
+    cursor = conn.execute('SELECT latitude, longitude FROM locations')
+    while True:
+        points = cursor.fetchmany(1000)
+        if not points:
+            break
+        update_location_grid(conn, points)
+
+# ISO形式の timestamp 列をエポックミリ秒に変換するSQL式（ナイーブな値はUTC扱い）
+SQL_TIMESTAMP_TO_MS = "CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)"
+
+# 日別・時間別の件数表（JSTの区切り。キーは 1970-01-01 JST からの日数・時間数）
+COUNT_UNITS = {"day": 86400 * 1000, "hour": 3600 * 1000}
+JST_OFFSET_MS = 9 * 3600 * 1000
+
+def sql_count_bucket(row, unit):
+    """トリガー内で行（NEW / OLD）の集計キーを求めるSQL式"""
+    timestamp_ms = f"COALESCE({row}.timestamp_ms, {SQL_TIMESTAMP_TO_MS.format(column=row + '.timestamp')})"
+    return f"(({timestamp_ms}) + {JST_OFFSET_MS}) / {COUNT_UNITS[unit]}"
+
+def sql_time_count_delta(row, unit, delta):
+    """トリガー内で件数表に delta を加えるSQL（時刻を換算できない行は数えない）"""
+    return f'''
+        INSERT INTO location_time_counts (unit, bucket, count)
+        SELECT '{unit}', bucket, {delta} FROM (SELECT {sql_count_bucket(row, unit)} AS bucket)
+        WHERE bucket IS NOT NULL
+        ON CONFLICT (unit, bucket) DO UPDATE SET count = count + excluded.count;
+    '''
+
+SQL_DELETE_EMPTY_TIME_COUNTS = 'DELETE FROM location_time_counts WHERE count <= 0;'
+
+def fill_location_time_counts(conn):
+    """日別・時間別の件数表を locations から作り直す"""
+    conn.execute('DELETE FROM location_time_counts')
+    timestamp_ms = f"COALESCE(timestamp_ms, {SQL_TIMESTAMP_TO_MS.format(column='timestamp')})"
+    for unit, unit_ms in COUNT_UNITS.items():
+        conn.execute(f'''
+            INSERT INTO location_time_counts (unit, bucket, count)
+            SELECT ?, (({timestamp_ms}) + {JST_OFFSET_MS}) / {unit_ms} AS bucket, COUNT(*)
+            FROM locations GROUP BY bucket HAVING bucket IS NOT NULL
+        ''', (unit,))
 
 # データベース初期化
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
+def init_schema(conn):
+    """テーブルと初期レコードを作成する（書き込み接続の初回オープン時に実行）"""
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS locations (
@@ -182,79 +540,1241 @@ def init_db():
             description TEXT
         )
     ''')
+    # 位置情報の追加・削除の変更履歴（/api/locations?since= の差分取得用）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS location_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            location_id INTEGER NOT NULL,
+            op TEXT NOT NULL CHECK (op IN ('insert', 'delete'))
+        )
+    ''')
     # 初期セッションレコードを作成
     cursor.execute('''
         INSERT OR IGNORE INTO recording_sessions (id, enabled) VALUES (1, 0)
     ''')
-    conn.commit()
-    conn.close()
+    migrate_schema(conn)
+
+# スキーマのバージョン（PRAGMA user_version で管理）
+SCHEMA_VERSION = 7
+
+# 1人1記録の制限を付ける移行で、制限に違反している既存の記録を退避して削除するか
+# （指定しない場合は該当する記録を示して移行を止める）
+MIGRATE_ARCHIVE_DUPLICATE_SESSIONS = os.getenv("MIGRATE_ARCHIVE_DUPLICATE_SESSIONS", "").lower() in ("1", "true", "yes")
+# 移行を止めるときにメッセージに含める記録の件数
+MIGRATION_REPORT_LIMIT = 20
+
+def migrate_schema(conn):
+    """既存のデータベースを現在のスキーマに移行する"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        # UNIQUE インデックスを張る前に、1人1記録の制限に違反している記録を確認する
+        # （セッションIDごとに最初の1件を残す）
+        duplicates = conn.execute('''
+            SELECT id, session_id, timestamp FROM locations
+            WHERE session_id IS NOT NULL AND session_id != ''
+              AND id NOT IN (
+                  SELECT MIN(id) FROM locations
+                  WHERE session_id IS NOT NULL AND session_id != ''
+                  GROUP BY session_id
+              )
+            ORDER BY id
+        ''').fetchall()
+        if duplicates and not MIGRATE_ARCHIVE_DUPLICATE_SESSIONS:
+            listed = ", ".join(f"id={row[0]} session_id={row[1]!r} timestamp={row[2]}"
+                               for row in duplicates[:MIGRATION_REPORT_LIMIT])
+            more = len(duplicates) - MIGRATION_REPORT_LIMIT
+            if more > 0:
+                listed += f", ... ({more} more)"
+            raise RuntimeError(
+                f"Schema migration stopped: {len(duplicates)} location records share a session_id "
+                f"with an earlier record and would violate the one-record-per-session constraint: {listed}. "
+                "Resolve them manually, or set MIGRATE_ARCHIVE_DUPLICATE_SESSIONS=1 to move them to "
+                "locations_duplicate_archive and continue.")
+        if duplicates:
+            # 削除する記録は退避テーブルに残す。差分取得のクライアントにも削除を伝える
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS locations_duplicate_archive (
+                    id INTEGER PRIMARY KEY,
+                    latitude REAL NOT NULL,
+                    longitude REAL NOT NULL,
+                    timestamp DATETIME,
+                    session_id TEXT,
+                    user_agent TEXT,
+                    ip_address TEXT,
+                    archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            for location_id, _, _ in duplicates:
+                conn.execute('''
+                    INSERT OR REPLACE INTO locations_duplicate_archive
+                        (id, latitude, longitude, timestamp, session_id, user_agent, ip_address)
+                    SELECT id, latitude, longitude, timestamp, session_id, user_agent, ip_address
+                    FROM locations WHERE id = ?
+                ''', (location_id,))
+                conn.execute('DELETE FROM locations WHERE id = ?', (location_id,))
+                conn.execute("INSERT INTO location_changes (location_id, op) VALUES (?, 'delete')",
+                             (location_id,))
+            logger.warning("Schema migration: archived and removed %d duplicate session records", len(duplicates),
+                           extra={"event": "schema.migration", "archived": len(duplicates),
+                                  "location_ids": [row[0] for row in duplicates]})
+        # 一覧の並び替え（ORDER BY timestamp）とセッションIDでの検索用
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_locations_timestamp ON locations (timestamp)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_locations_session_id ON locations (session_id)')
+        # 1人1記録の制限（セッションIDなし・空文字の記録は対象外）
+        conn.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_locations_session_unique
+            ON locations (session_id)
+            WHERE session_id IS NOT NULL AND session_id != ''
+        ''')
+    if version < 2:
+        # タイムスタンプをエポックミリ秒の整数列で持つ（既存行は起動後に少しずつ埋める）
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(locations)")}
+        if "timestamp_ms" not in columns:
+            conn.execute('ALTER TABLE locations ADD COLUMN timestamp_ms INTEGER')
+        conn.execute('DROP INDEX IF EXISTS idx_locations_timestamp')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_locations_timestamp_ms ON locations (timestamp_ms)')
+        # timestamp_ms を指定しない書き込み（旧バージョン・外部ツール）でも値が入るようにする
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS locations_fill_timestamp_ms
+            AFTER INSERT ON locations WHEN NEW.timestamp_ms IS NULL
+            BEGIN
+                UPDATE locations
+                SET timestamp_ms = {SQL_TIMESTAMP_TO_MS.format(column="NEW.timestamp")}
+                WHERE id = NEW.id;
+            END
+        ''')
+    if version < 3:
+        # 記録件数のカウンタ（COUNT(*) の全件走査を避けるためトリガーで維持する）
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS location_counter (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('INSERT OR REPLACE INTO location_counter (id, total) SELECT 1, COUNT(*) FROM locations')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS locations_count_insert AFTER INSERT ON locations
+            BEGIN
+                UPDATE location_counter SET total = total + 1 WHERE id = 1;
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS locations_count_delete AFTER DELETE ON locations
+            BEGIN
+                UPDATE location_counter SET total = total - 1 WHERE id = 1;
+            END
+        ''')
+    if version < 4:
+        # 範囲（bbox）検索用の R*Tree。locations への追加・削除・座標変更はトリガーで反映する
+        conn.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS location_rtree
+            USING rtree(id, min_lon, max_lon, min_lat, max_lat)
+        ''')
+        conn.execute('DELETE FROM location_rtree')
+        conn.execute(SQL_FILL_LOCATION_RTREE)
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS locations_rtree_insert AFTER INSERT ON locations
+            BEGIN
+                INSERT INTO location_rtree (id, min_lon, max_lon, min_lat, max_lat)
+                VALUES (NEW.id, NEW.longitude, NEW.longitude, NEW.latitude, NEW.latitude);
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS locations_rtree_delete AFTER DELETE ON locations
+            BEGIN
+                DELETE FROM location_rtree WHERE id = OLD.id;
+            END
+        ''')
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS locations_rtree_update AFTER UPDATE OF latitude, longitude ON locations
+            BEGIN
+                UPDATE location_rtree
+                SET min_lon = NEW.longitude, max_lon = NEW.longitude,
+                    min_lat = NEW.latitude, max_lat = NEW.latitude
+                WHERE id = NEW.id;
+            END
+        ''')
+    if version < 5:
+        # クラスタリング用の多段グリッド（記録・削除の処理で差分更新する）
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS location_grid (
+                level INTEGER NOT NULL,
+                cell_x INTEGER NOT NULL,
+                cell_y INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                sum_lat REAL NOT NULL,
+                sum_lon REAL NOT NULL,
+                PRIMARY KEY (level, cell_x, cell_y)
+            ) WITHOUT ROWID
+        ''')
+        fill_location_grid(conn)
+    if version < 6:
+        # ダッシュボード用の日別・時間別件数（locations の変更に合わせてトリガーで維持する）
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS location_time_counts (
+                unit TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (unit, bucket)
+            ) WITHOUT ROWID
+        ''')
+        fill_location_time_counts(conn)
+    if version < 7:
+        # 時刻を換算できない行でも記録できるよう、件数表のトリガーを作り直す
+        for name in ("insert", "delete", "update"):
+            conn.execute(f"DROP TRIGGER IF EXISTS locations_time_counts_{name}")
+        increments = "".join(sql_time_count_delta("NEW", unit, 1) for unit in COUNT_UNITS)
+        decrements = "".join(sql_time_count_delta("OLD", unit, -1) for unit in COUNT_UNITS)
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS locations_time_counts_insert AFTER INSERT ON locations
+            BEGIN
+                {increments}
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS locations_time_counts_delete AFTER DELETE ON locations
+            BEGIN
+                {decrements}
+                {SQL_DELETE_EMPTY_TIME_COUNTS}
+            END
+        ''')
+        # timestamp_ms の埋め戻しでは同じ区切りに入るので件数は変わらない
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS locations_time_counts_update
+            AFTER UPDATE OF timestamp, timestamp_ms ON locations
+            BEGIN
+                {decrements}
+                {increments}
+                {SQL_DELETE_EMPTY_TIME_COUNTS}
+            END
+        ''')
+    if version < SCHEMA_VERSION:
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+# 全エンドポイントで共有する接続プール（読み取りプール + 単一の書き込み接続、WAL）
+db_pool = ConnectionPool(lambda: DB_PATH, initializer=init_schema, observer=observe_sql_statement)
+
+def init_db():
+    """データベースを初期化する"""
+    with db_pool.writer():
+        pass
 
 # データベース初期化実行
 init_db()
 
+# よく使うSQL（同一文字列を使い回して接続ごとのステートメントキャッシュに載せる）
+SQL_SELECT_SESSION = '''
+    SELECT enabled, expires_at, description FROM recording_sessions WHERE id = 1
+'''
+# 行が消えていても管理画面からの更新で作り直す（読み込み側では書き込まない）
+SQL_UPDATE_SESSION = '''
+    INSERT INTO recording_sessions (id, enabled, expires_at, description) VALUES (1, ?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET
+        enabled = excluded.enabled, expires_at = excluded.expires_at, description = excluded.description
+'''
+SQL_EXPIRE_SESSION = '''
+    UPDATE recording_sessions SET enabled = 0
+    WHERE id = 1 AND enabled = 1 AND expires_at IS ?
+'''
+SQL_INSERT_LOCATION = '''
+    INSERT INTO locations (latitude, longitude, timestamp, timestamp_ms, session_id, user_agent, ip_address)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_SELECT_LOCATIONS = '''
+    SELECT id, latitude, longitude, timestamp_ms, timestamp, session_id
+    FROM locations
+    ORDER BY timestamp_ms DESC, id DESC
+'''
+SQL_SELECT_LOCATIONS_SINCE = '''
+    SELECT id, latitude, longitude, timestamp_ms, timestamp, session_id
+    FROM locations
+    WHERE id IN (SELECT location_id FROM location_changes WHERE seq > ? AND op = 'insert')
+    ORDER BY id
+'''
+SQL_SELECT_DELETED_SINCE = '''
+    SELECT DISTINCT location_id FROM location_changes WHERE seq > ? AND op = 'delete'
+'''
+SQL_CHANGES_RANGE = 'SELECT MAX(seq), MIN(seq) FROM location_changes'
+SQL_LOG_LOCATION_CHANGE = 'INSERT INTO location_changes (location_id, op) VALUES (?, ?)'
+SQL_PRUNE_LOCATION_CHANGES = 'DELETE FROM location_changes WHERE seq <= ?'
+SQL_SELECT_LOCATIONS_ADMIN = '''
+    SELECT id, latitude, longitude, timestamp_ms, timestamp, session_id, user_agent, ip_address
+    FROM locations
+    ORDER BY timestamp_ms DESC, id DESC
+'''
+SQL_LOCATION_COUNT = 'SELECT total FROM location_counter WHERE id = 1'
+
+def build_page_queries(columns):
+    """キーセット方式のページ取得SQLを作る（並び順は timestamp_ms DESC, id DESC）"""
+    return {
+        "first": f'''
+            SELECT {columns} FROM locations
+            ORDER BY timestamp_ms DESC, id DESC LIMIT ?
+        ''',
+        "after": f'''
+            SELECT {columns} FROM locations
+            WHERE (timestamp_ms, id) < (?, ?)
+            ORDER BY timestamp_ms DESC, id DESC LIMIT ?
+        ''',
+        # timestamp_ms が未設定の行（埋め戻し前）は末尾に id の降順で並ぶ
+        "nulls": f'''
+            SELECT {columns} FROM locations
+            WHERE timestamp_ms IS NULL AND id < ?
+            ORDER BY id DESC LIMIT ?
+        ''',
+    }
+
+SQL_PAGE_LOCATIONS = build_page_queries("id, latitude, longitude, timestamp_ms, timestamp, session_id")
+SQL_PAGE_LOCATIONS_ADMIN = build_page_queries(
+    "id, latitude, longitude, timestamp_ms, timestamp, session_id, user_agent, ip_address")
+SQL_BACKFILL_TIMESTAMP_MS = f'''
+    UPDATE locations SET timestamp_ms = {SQL_TIMESTAMP_TO_MS.format(column="timestamp")}
+    WHERE id IN (
+        SELECT id FROM locations
+        WHERE timestamp_ms IS NULL AND julianday(timestamp) IS NOT NULL
+        LIMIT ?
+    )
+'''
+SQL_SELECT_LOCATION_POINT = 'SELECT latitude, longitude FROM locations WHERE id = ?'
+SQL_DELETE_LOCATION = 'DELETE FROM locations WHERE id = ?'
+SQL_DELETE_OWN_LOCATION = 'DELETE FROM locations WHERE id = ? AND session_id = ?'
+
+# expires_at の形式（YYYY-MM-DD[T ]HH:MM[:SS]、以降の小数秒・タイムゾーン表記は無視）
+EXPIRES_AT_PATTERN = re.compile(r'^\s*(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2})(?::(\d{2}))?')
+
+def parse_expires_at(expires_at):
+    """expires_atの文字列をJSTのdatetimeに変換する（パースできない場合はNone）
+
+    管理画面は日本時間で入力するため、時刻は常にJSTとして解釈する。
+    """
+    if not expires_at:
+        return None
+    match = EXPIRES_AT_PATTERN.match(expires_at)
+    if not match:
+        logger.warning("Unsupported expires_at format", extra={"event": "session.expires_at_invalid",
+                                                             "expires_at": expires_at})
+        # パースエラーの場合は期限切れとして扱わない
+        return None
+    try:
+        year, month, day, hour, minute, second = (int(v) if v else 0 for v in match.groups())
+        return JST.localize(datetime.datetime(year, month, day, hour, minute, second))
+    except ValueError as e:
+        logger.warning("Invalid expires_at: %s", e, extra={"event": "session.expires_at_invalid",
+                                                            "expires_at": expires_at})
+        return None
+
+def load_recording_session_row():
+    """DBから記録セッション行 (enabled, expires_at, description) を読み込む
+
+    状態の確認では書き込まない。初期レコードは init_schema で作成し、
+    存在しない場合は無効として扱う（次の update_recording_session で作り直す）。
+    """
+    with db_pool.reader() as conn:
+        result = conn.execute(SQL_SELECT_SESSION).fetchone()
+    
+    if not result or len(result) < 3:
+        return (0, None, None)
+    return result
+
+class RecordingSessionCache:
+    """記録セッション行のプロセス内キャッシュ
+
+    期限はパース済みのJST datetimeで保持し、状態確認や記録時にDBへアクセスしない。
+    セッションの更新時は update_recording_session から直接書き換える（ライトスルー）。
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._state = None
+        self._version = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def loaded(self):
+        return self._state is not None
+
+    def load(self):
+        """DBからセッション行を読み込んでキャッシュする"""
+        version = self._version
+        enabled, expires_at, description = self._loader()
+        state = self._build(enabled, expires_at, description)
+        with self._lock:
+            # 読み込み中に set() された場合は新しい方を残す
+            if self._version == version:
+                self._state = state
+        resource_versions.bump("recording-status")
+        return self._state
+
+    def peek(self):
+        """キャッシュ済みの状態をI/Oなしで返す（未読み込みならNone）"""
+        state = self._state
+        if state is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return state
+
+    def get(self):
+        state = self.peek()
+        if state is None:
+            state = self.load()
+        return state
+
+    def set(self, enabled, expires_at, description):
+        state = self._build(enabled, expires_at, description)
+        with self._lock:
+            self._version += 1
+            self._state = state
+        resource_versions.bump("recording-status")
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+            self._state = None
+
+    @staticmethod
+    def _build(enabled, expires_at, description):
+        return {
+            "enabled": bool(enabled),
+            "expires_at": expires_at,
+            "expires_dt": parse_expires_at(expires_at),
+            "description": description,
+        }
+
+session_cache = RecordingSessionCache(load_recording_session_row)
+
 # 記録セッション状態を取得
-def get_recording_session():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT enabled, expires_at, description FROM recording_sessions WHERE id = 1
-    ''')
-    result = cursor.fetchone()
+def get_recording_session(state=None):
+    """記録セッション状態を取得（期限切れ判定はメモリ上で行う）"""
+    if state is None:
+        state = session_cache.get()
+    enabled = state["enabled"]
+    if enabled and state["expires_dt"] is not None and state["expires_dt"] < get_jst_now():
+        # 期限切れの場合は無効として扱う
+        enabled = False
+    return {"enabled": enabled, "expires_at": state["expires_at"], "description": state["description"]}
+
+# 期限切れを反映できなかったときに次に試すまでの間隔（秒）
+SESSION_EXPIRY_RETRY_SECONDS = float(os.getenv("SESSION_EXPIRY_RETRY_SECONDS", "1.0"))
+
+class SessionExpiryScheduler:
+    """記録セッションの期限切れを時刻どおりにDBとキャッシュへ反映するバックグラウンドタスク
+
+    現在の expires_at にタイマーを設定し、期限になったら enabled を落とす。
+    セッションが更新されたら rearm() でタイマーを張り直す。
+    """
+
+    def __init__(self):
+        self._task = None
+        self._loop = None
+        self._rearm_event = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._rearm_event = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._loop = None
+
+    def rearm(self):
+        """タイマーを張り直す（どのスレッドからでも呼べる）"""
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._rearm_event.set)
+
+    async def _run(self):
+        while True:
+            self._rearm_event.clear()
+            if not session_cache.loaded:
+                await run_blocking(session_cache.load)
+            state = session_cache.get()
+
+            timeout = None
+            if state["enabled"] and state["expires_dt"] is not None:
+                timeout = max(0.0, (state["expires_dt"] - get_jst_now()).total_seconds())
+
+            try:
+                await asyncio.wait_for(self._rearm_event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                try:
+                    updated = await run_blocking(expire_recording_session, state["expires_at"])
+                except Exception:
+                    logger.exception("Error expiring recording session", extra={"event": "session.expire_failed"})
+                    updated = 0
+                if not updated:
+                    # キャッシュが期限切れのまま残っても、書き込みを繰り返さないよう間を空ける
+                    await asyncio.sleep(SESSION_EXPIRY_RETRY_SECONDS)
+
+session_scheduler = SessionExpiryScheduler()
+
+async def current_recording_session():
+    """記録セッション状態を取得（キャッシュ未読み込みの場合のみDBを読む）"""
+    state = session_cache.peek()
+    if state is None:
+        state = await run_blocking(session_cache.load)
+    return get_recording_session(state)
+
+# ===== データアクセス層（同期処理。ルートからは run_blocking 経由で呼ぶ） =====
+
+# ライブ更新の配信（/api/events）
+broadcaster = Broadcaster()
+
+def update_recording_session(enabled, expires_at, description):
+    """記録セッションを更新する"""
+    with db_pool.writer() as conn:
+        conn.execute(SQL_UPDATE_SESSION, (1 if enabled else 0, expires_at, description))
+        # 書き込みロック内で更新し、期限切れ処理との順序を保つ
+        session_cache.set(enabled, expires_at, description)
+    broadcaster.publish("session", get_recording_session())
+
+def expire_recording_session(expires_at):
+    """期限を迎えたセッションを無効化する（その間にセッションが変更されていれば何もしない）
+
+    DBの行がキャッシュを経由せずに変更・削除されていた場合は、キャッシュをDBから読み直す。
+    """
+    with db_pool.writer() as conn:
+        updated = conn.execute(SQL_EXPIRE_SESSION, (expires_at,)).rowcount
+        if updated:
+            state = session_cache.get()
+            session_cache.set(False, state["expires_at"], state["description"])
+    if not updated:
+        session_cache.load()
+    broadcaster.publish("session", get_recording_session())
+    return updated
+
+# 変更履歴の保持件数（これより古いカーソルで問い合わせた場合は全件を返す）
+LOCATION_CHANGES_RETENTION = int(os.getenv("LOCATION_CHANGES_RETENTION", "10000"))
+
+def log_location_change(conn, location_id, op):
+    """位置情報の変更履歴を記録する（書き込みと同じトランザクション内で呼ぶ）"""
+    seq = conn.execute(SQL_LOG_LOCATION_CHANGE, (location_id, op)).lastrowid
+    # 古い履歴をときどき間引く
+    if seq % 1000 == 0:
+        conn.execute(SQL_PRUNE_LOCATION_CHANGES, (seq - LOCATION_CHANGES_RETENTION,))
+    return seq
+
+# バッチ記録の1回あたりの上限件数
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "500"))
+
+def insert_locations_batch(locations):
+    """複数の位置情報を1トランザクションで記録する
+
+    locations は検証済みの LocationRecord のリスト。要素ごとに
+    ("accepted", id) または ("duplicate_session", None) を返す。
+    1人1記録の制限は insert_location と同じく UNIQUE インデックスで判定し、違反した行だけを除く。
+    """
+    results = [None] * len(locations)
+    jst_now = datetime.datetime.now(JST)
+    timestamp = jst_now.isoformat()
+    timestamp_ms = datetime_to_ms(jst_now)
     
-    if not result:
-        # 初期レコードが存在しない場合は作成
-        cursor.execute('''
-            INSERT INTO recording_sessions (id, enabled, expires_at, description) 
-            VALUES (1, 0, NULL, NULL)
-        ''')
-        conn.commit()
-        # 新しく作成したレコードを取得
-        cursor.execute('''
-            SELECT enabled, expires_at, description FROM recording_sessions WHERE id = 1
-        ''')
-        result = cursor.fetchone()
+    try:
+        with db_pool.writer() as conn:
+            accepted = []
+            ids = []
+            for index, loc in enumerate(locations):
+                try:
+                    # 制約違反はその文だけが取り消され、トランザクションの他の行は残る
+                    # （同じバッチ内の重複も先着1件のみ受け付ける）
+                    location_id = conn.execute(SQL_INSERT_LOCATION,
+                                               (loc.latitude, loc.longitude, timestamp, timestamp_ms,
+                                                loc.session_id, None, None)).lastrowid
+                except sqlite3.IntegrityError:
+                    if not loc.session_id:
+                        raise
+                    results[index] = ("duplicate_session", None)
+                    continue
+                results[index] = ("accepted", location_id)
+                accepted.append(index)
+                ids.append(location_id)
         
-        # もしまだ取得できない場合はデフォルト値を返す
-        if not result:
-            conn.close()
-            return {"enabled": False, "expires_at": None, "description": None}
+            if accepted:
+                seqs = [log_location_change(conn, location_id, 'insert') for location_id in ids]
+                update_location_grid(conn, [(locations[i].latitude, locations[i].longitude)
+                                            for i in accepted])
+                # スナップショットへの追記は書き込みロック内で行い、IDの順に並ぶようにする
+                location_snapshot.append([(location_id, locations[i].latitude, locations[i].longitude,
+                                           timestamp_ms) for location_id, i in zip(ids, accepted)])
+    except BaseException:
+        # コミットできなかった場合は、追記済みのスナップショットを作り直す
+        location_snapshot.invalidate()
+        raise
     
-    conn.close()
-      # resultが空やNoneでないかを確認
-    if not result or len(result) < 3:
-        return {"enabled": False, "expires_at": None, "description": None}
+    if accepted:
+        resource_versions.bump("locations")
+        heatmap_tiles.invalidate_points([(locations[i].latitude, locations[i].longitude)
+                                         for i in accepted])
+        for location_id, index, seq in zip(ids, accepted, seqs):
+            loc = locations[index]
+            broadcaster.publish("location", format_location(
+                (location_id, loc.latitude, loc.longitude, timestamp_ms, timestamp, loc.session_id)
+            ), event_id=seq)
+    return results
+
+def insert_location(location):
+    """位置情報を1件記録し、IDを返す（1人1記録の制限に違反する場合は409）
+
+    書き込みキューの停止中に使う。キュー経由の insert_locations_batch も同じくINSERTの制約違反で判定する。
+    """
+    # JSTタイムスタンプを生成
+    jst_now = datetime.datetime.now(JST)
+    timestamp_ms = datetime_to_ms(jst_now)
+    try:
+        with db_pool.writer() as conn:
+            # 1人1記録の制限は UNIQUE インデックスで保証する
+            location_id = conn.execute(SQL_INSERT_LOCATION,
+                                       (location.latitude, location.longitude, jst_now.isoformat(),
+                                        timestamp_ms, location.session_id, None, None)).lastrowid
+            seq = log_location_change(conn, location_id, 'insert')
+            update_location_grid(conn, [(location.latitude, location.longitude)])
+            # スナップショットへの追記は書き込みロック内で行い、IDの順に並ぶようにする
+            location_snapshot.append([(location_id, location.latitude, location.longitude, timestamp_ms)])
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=409, detail="既に位置情報を記録済みです")
+    except BaseException:
+        # コミットできなかった場合は、追記済みのスナップショットを作り直す
+        location_snapshot.invalidate()
+        raise
+    resource_versions.bump("locations")
+    heatmap_tiles.invalidate_points([(location.latitude, location.longitude)])
+    broadcaster.publish("location", format_location(
+        (location_id, location.latitude, location.longitude, timestamp_ms, None, location.session_id)
+    ), event_id=seq)
+    return location_id
+
+# 位置情報記録の書き込みキュー（グループコミット）
+ingest_queue = IngestQueue(insert_locations_batch)
+
+def format_location(row, epoch=False):
+    """公開用の位置情報1件を辞書に変換する（epoch=True ならタイムスタンプはエポックミリ秒）"""
+    location_id, lat, lon, timestamp_ms, timestamp, session_id = row
+    return {
+        "id": location_id,
+        "latitude": lat,
+        "longitude": lon,
+        "timestamp": location_timestamp(timestamp_ms, timestamp, epoch),
+        "session_id": session_id or ""
+    }
+
+def fetch_locations(epoch=False):
+    """公開用の位置情報一覧を取得する"""
+    # テーブルは接続プールの初期化時に作成済み
+    with db_pool.reader() as conn:
+        rows = conn.execute(SQL_SELECT_LOCATIONS).fetchall()
     
-    enabled, expires_at, description = result
-      # 期限切れチェック
-    if expires_at:
-        try:
-            # ISO形式の文字列をパース（簡単な形式のみサポート）
-            expires_str = expires_at.replace('Z', '+00:00').replace('T', ' ')
-            if '+' in expires_str:
-                expires_str = expires_str.split('+')[0]
-              # 秒が含まれているかチェック
-            if len(expires_str) >= 19 and expires_str[16] == ':':
-                # 秒が含まれている場合（YYYY-MM-DD HH:MM:SS）
-                expires_dt = datetime.datetime.strptime(expires_str[:19], '%Y-%m-%d %H:%M:%S')
+    return [format_location(row, epoch) for row in rows]
+
+def fetch_location_changes(since, epoch=False):
+    """カーソル以降に追加・削除された位置情報を取得する
+
+    カーソルが0以下、または履歴が間引かれていて差分を作れない場合は
+    全件を reset=True で返す。
+    """
+    with db_pool.reader() as conn:
+        # 同じスナップショットからカーソルと差分を読む
+        conn.execute("BEGIN")
+        latest, oldest = conn.execute(SQL_CHANGES_RANGE).fetchone()
+        latest = latest or 0
+        reset = since <= 0 or since > latest or (oldest is not None and since < oldest - 1)
+        if reset:
+            rows = conn.execute(SQL_SELECT_LOCATIONS).fetchall()
+            deleted = []
+        else:
+            rows = conn.execute(SQL_SELECT_LOCATIONS_SINCE, (since,)).fetchall()
+            deleted = [row[0] for row in conn.execute(SQL_SELECT_DELETED_SINCE, (since,))]
+    
+    return {
+        "cursor": latest,
+        "reset": reset,
+        "locations": [format_location(row, epoch) for row in rows],
+        "deleted": deleted
+    }
+
+def format_admin_location(loc, epoch=False):
+    """管理者向けの位置情報1件を辞書に変換する"""
+    return {
+        "id": loc[0],
+        "latitude": loc[1],
+        "longitude": loc[2],
+        "timestamp": location_timestamp(loc[3], loc[4], epoch),
+        "session_id": loc[5],
+        "user_agent": loc[6],
+        "ip_address": loc[7]
+    }
+
+def fetch_admin_locations(epoch=False):
+    """管理者向けの位置情報一覧を取得する"""
+    with db_pool.reader() as conn:
+        locations = conn.execute(SQL_SELECT_LOCATIONS_ADMIN).fetchall()
+    
+    return [format_admin_location(loc, epoch) for loc in locations]
+
+# ページ取得の既定件数と上限
+LOCATIONS_PAGE_SIZE = int(os.getenv("LOCATIONS_PAGE_SIZE", "100"))
+LOCATIONS_PAGE_SIZE_MAX = int(os.getenv("LOCATIONS_PAGE_SIZE_MAX", "1000"))
+# SQLiteのrowidの最大値（timestamp_ms 未設定の行を先頭から読むときに使う）
+MAX_ROWID = 2 ** 63 - 1
+
+def encode_page_cursor(timestamp_ms, location_id):
+    """ページの最後の行からクライアントに渡すカーソル文字列を作る"""
+    raw = f"{'' if timestamp_ms is None else timestamp_ms}:{location_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_page_cursor(cursor):
+    """カーソル文字列を (timestamp_ms, id) に戻す（不正な値は400）"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp_ms, location_id = raw.split(":")
+        return (int(timestamp_ms) if timestamp_ms else None), int(location_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def page_limit(limit):
+    """ページの件数を検証する（未指定なら既定値）"""
+    if limit is None:
+        return LOCATIONS_PAGE_SIZE
+    if limit < 1 or limit > LOCATIONS_PAGE_SIZE_MAX:
+        raise HTTPException(status_code=400,
+                            detail=f"limit must be between 1 and {LOCATIONS_PAGE_SIZE_MAX}")
+    return limit
+
+def fetch_location_page(queries, limit, cursor=None):
+    """位置情報を1ページ分取得し、(行のリスト, 次のカーソル) を返す
+
+    cursor は decode_page_cursor() の結果。最後のページでは次のカーソルは None。
+    """
+    with db_pool.reader() as conn:
+        # 2回に分けて読む場合も同じスナップショットから読む
+        conn.execute("BEGIN")
+        if cursor is None:
+            rows = conn.execute(queries["first"], (limit + 1,)).fetchall()
+        else:
+            timestamp_ms, last_id = cursor
+            if timestamp_ms is not None:
+                rows = conn.execute(queries["after"], (timestamp_ms, last_id, limit + 1)).fetchall()
+                if len(rows) <= limit:
+                    rows += conn.execute(queries["nulls"], (MAX_ROWID, limit + 1 - len(rows))).fetchall()
             else:
-                # 秒が含まれていない場合（YYYY-MM-DD HH:MM）
-                expires_dt = datetime.datetime.strptime(expires_str[:16], '%Y-%m-%d %H:%M')
-            
-            expires_dt = JST.localize(expires_dt)
-            
-            if expires_dt < get_jst_now():
-                # 期限切れの場合は無効化
-                conn = sqlite3.connect(DB_PATH)
-                cursor = conn.cursor()
-                cursor.execute('UPDATE recording_sessions SET enabled = 0 WHERE id = 1')
-                conn.commit()
-                conn.close()
-                return {"enabled": False, "expires_at": expires_at, "description": description}
-        except Exception as e:
-            print(f"Date parsing error: {e}")
-            # パースエラーの場合は期限切れとして扱わない
+                rows = conn.execute(queries["nulls"], (last_id, limit + 1)).fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_page_cursor(rows[-1][3], rows[-1][0])
+    return rows, next_cursor
+
+def fetch_location_count():
+    """記録件数をカウンタから取得する"""
+    with db_pool.reader() as conn:
+        row = conn.execute(SQL_LOCATION_COUNT).fetchone()
+    return row[0] if row else 0
+
+# ダッシュボードに表示する範囲
+DASHBOARD_DAYS = 14
+DASHBOARD_HOURS = 24
+# 地域別件数に使うグリッドのレベル（2^6 x 2^6 = 最大4096セル）と表示件数
+DASHBOARD_GRID_LEVEL = 6
+DASHBOARD_TOP_CELLS = 10
+
+SQL_SELECT_TIME_COUNTS = '''
+    SELECT bucket, count FROM location_time_counts WHERE unit = ? AND bucket BETWEEN ? AND ?
+'''
+SQL_SELECT_TOP_GRID_CELLS = '''
+    SELECT cell_x, cell_y, count, sum_lat, sum_lon FROM location_grid
+    WHERE level = ? ORDER BY count DESC LIMIT ?
+'''
+
+def fetch_dashboard(now_ms=None):
+    """ダッシュボードの集計値を取得する
+
+    件数表・カウンタ・粗いグリッドを読むだけなので、記録件数に関係なく一定のコストで済む。
+    """
+    if now_ms is None:
+        now_ms = datetime_to_ms(get_jst_now())
+    current = {unit: (now_ms + JST_OFFSET_MS) // unit_ms for unit, unit_ms in COUNT_UNITS.items()}
+    spans = {"day": DASHBOARD_DAYS, "hour": DASHBOARD_HOURS}
+    with db_pool.reader() as conn:
+        conn.execute("BEGIN")
+        row = conn.execute(SQL_LOCATION_COUNT).fetchone()
+        series = {}
+        for unit, span in spans.items():
+            first = current[unit] - span + 1
+            counts = dict(conn.execute(SQL_SELECT_TIME_COUNTS, (unit, first, current[unit])).fetchall())
+            series[unit] = [(bucket, counts.get(bucket, 0)) for bucket in range(first, current[unit] + 1)]
+        cells = conn.execute(SQL_SELECT_TOP_GRID_CELLS,
+                             (DASHBOARD_GRID_LEVEL, DASHBOARD_TOP_CELLS)).fetchall()
+
+    def bucket_start(unit, bucket):
+        return bucket * COUNT_UNITS[unit] - JST_OFFSET_MS
+
+    return {
+        "total": row[0] if row else 0,
+        "today": series["day"][-1][1],
+        "this_hour": series["hour"][-1][1],
+        "last_24h": sum(count for _, count in series["hour"]),
+        "days": [{"date": format_timestamp_ms(bucket_start("day", bucket))[:10],
+                  "start_ms": bucket_start("day", bucket), "count": count}
+                 for bucket, count in series["day"]],
+        "hours": [{"start": format_timestamp_ms(bucket_start("hour", bucket)),
+                   "start_ms": bucket_start("hour", bucket), "count": count}
+                  for bucket, count in series["hour"]],
+        "top_cells": [{"latitude": sum_lat / count, "longitude": sum_lon / count, "count": count,
+                       "bounds": geogrid.cell_bounds(DASHBOARD_GRID_LEVEL, cell_x, cell_y)}
+                      for cell_x, cell_y, count, sum_lat, sum_lon in cells],
+    }
+
+def parse_bbox(bbox):
+    """bbox（"西経度,南緯度,東経度,北緯度"）を検証してタプルにする（不正な値は400）
+
+    日付変更線をまたぐ範囲は西経度 > 東経度 で指定する。
+    """
+    try:
+        west, south, east, north = (float(value) for value in bbox.split(","))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="bbox must be 'west,south,east,north'")
+    if not (-180 <= west <= 180 and -180 <= east <= 180 and -90 <= south <= north <= 90):
+        raise HTTPException(status_code=400, detail="bbox is out of range")
+    return west, south, east, north
+
+def split_bbox(bbox):
+    """日付変更線をまたぐ bbox を経度方向に2つに分ける"""
+    west, south, east, north = bbox
+    if west <= east:
+        return [bbox]
+    return [(west, south, 180.0, north), (-180.0, south, east, north)]
+
+def parse_time_param(value, name):
+    """時刻の指定（エポックミリ秒またはISO形式）をエポックミリ秒にする（不正な値は400）
+
+    タイムゾーンのないISO形式はJSTとして扱う。
+    """
+    if value is None:
+        return None
+    if value.lstrip("-").isdigit():
+        return int(value)
+    try:
+        dt = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be epoch milliseconds or ISO 8601")
+    if dt.tzinfo is None:
+        dt = JST.localize(dt)
+    return datetime_to_ms(dt)
+
+def build_filter_query(columns, with_bbox, with_start, with_end):
+    """範囲・期間で絞り込むSQLを作る
+
+    bbox 指定時は R*Tree から候補を引き、locations の座標で厳密に判定する
+    （R*Tree の座標は32bit浮動小数点で外側に丸められているため）。
+    期間のみの指定時は timestamp_ms のインデックスを使う。
+    """
+    conditions = []
+    if with_bbox:
+        # CROSS JOIN で R*Tree を外側のループに固定する
+        source = "location_rtree r CROSS JOIN locations l ON l.id = r.id"
+        conditions += [
+            "r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ?",
+            "l.longitude BETWEEN ? AND ? AND l.latitude BETWEEN ? AND ?",
+        ]
+    else:
+        source = "locations l"
+    if with_start:
+        conditions.append("l.timestamp_ms >= ?")
+    if with_end:
+        conditions.append("l.timestamp_ms < ?")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    select = ", ".join(f"l.{column.strip()}" for column in columns.split(","))
+    return f"SELECT {select} FROM {source} {where} ORDER BY l.timestamp_ms DESC, l.id DESC"
+
+def fetch_locations_filtered(bbox=None, start_ms=None, end_ms=None, epoch=False):
+    """範囲（bbox）・期間で絞り込んだ公開用の位置情報を取得する
+
+    期間の判定は timestamp_ms で行うため、埋め戻しが終わっていない行は期間指定では返されない。
+    """
+    sql = build_filter_query("id, latitude, longitude, timestamp_ms, timestamp, session_id",
+                             bbox is not None, start_ms is not None, end_ms is not None)
+    time_params = tuple(value for value in (start_ms, end_ms) if value is not None)
+    boxes = split_bbox(bbox) if bbox is not None else [None]
+    rows = []
+    with db_pool.reader() as conn:
+        conn.execute("BEGIN")
+        for box in boxes:
+            params = ()
+            if box is not None:
+                west, south, east, north = box
+                params = (west, east, south, north, west, east, south, north)
+            rows += conn.execute(sql, params + time_params).fetchall()
+    if len(boxes) > 1:
+        # 2つの範囲の結果を一覧と同じ順序に並べ直す
+        rows.sort(key=lambda row: (row[3] is not None, row[3] or 0, row[0]), reverse=True)
+    return [format_location(row, epoch) for row in rows]
+
+def rebuild_location_rtree():
+    """R*Tree を locations から作り直し、登録件数を返す"""
+    with db_pool.writer() as conn:
+        conn.execute('DELETE FROM location_rtree')
+        conn.execute(SQL_FILL_LOCATION_RTREE)
+        return conn.execute('SELECT COUNT(*) FROM location_rtree').fetchone()[0]
+
+def rebuild_location_grid():
+    """クラスタリング用グリッドを locations から作り直し、セル数を返す"""
+    with db_pool.writer() as conn:
+        fill_location_grid(conn)
+        return conn.execute('SELECT COUNT(*) FROM location_grid').fetchone()[0]
+
+# 1回の問い合わせで集計するセル数の上限（画面に対して広すぎる bbox を拒否する）
+CLUSTER_MAX_CELLS = int(os.getenv("CLUSTER_MAX_CELLS", "4096"))
+# クラスタごとに返せるサンプルIDの上限
+CLUSTER_MAX_SAMPLES = 10
+
+SQL_SELECT_GRID_CELLS = '''
+    SELECT cell_x, cell_y, count, sum_lat, sum_lon FROM location_grid
+    WHERE level = ? AND cell_x BETWEEN ? AND ? AND cell_y BETWEEN ? AND ?
+'''
+SQL_SAMPLE_IDS_IN_BOX = '''
+    SELECT l.id FROM location_rtree r CROSS JOIN locations l ON l.id = r.id
+    WHERE r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ?
+      AND l.longitude >= ? AND l.longitude < ? AND l.latitude > ? AND l.latitude <= ?
+    ORDER BY l.id DESC LIMIT ?
+'''
+
+def fetch_location_clusters(zoom, bbox, samples=0):
+    """ズームと bbox に応じたクラスタ（セルごとの件数と重心）を取得する
+
+    セル数が CLUSTER_MAX_CELLS を超える場合は ValueError。
+    samples > 0 のときはクラスタごとに最大 samples 件の記録IDを付ける。
+    """
+    level = geogrid.zoom_to_level(zoom)
+    ranges = [geogrid.cell_range(box, level) for box in split_bbox(bbox)]
+    cells = sum((x1 - x0 + 1) * (y1 - y0 + 1) for x0, x1, y0, y1 in ranges)
+    if cells > CLUSTER_MAX_CELLS:
+        raise ValueError(f"bbox covers {cells} cells at zoom {zoom} (max {CLUSTER_MAX_CELLS})")
     
-    return {"enabled": bool(enabled), "expires_at": expires_at, "description": description}
+    clusters = []
+    with db_pool.reader() as conn:
+        conn.execute("BEGIN")
+        for x0, x1, y0, y1 in ranges:
+            for cell_x, cell_y, count, sum_lat, sum_lon in conn.execute(
+                    SQL_SELECT_GRID_CELLS, (level, x0, x1, y0, y1)).fetchall():
+                cluster = {"latitude": sum_lat / count, "longitude": sum_lon / count, "count": count}
+                if samples:
+                    west, south, east, north = geogrid.cell_bounds(level, cell_x, cell_y)
+                    # 最後のセルは東端・南端の値も含める
+                    if east >= 180.0:
+                        east = 180.0 + 1e-9
+                    if south <= -geogrid.MAX_MERCATOR_LAT:
+                        south = -90.0 - 1e-9
+                    if north >= geogrid.MAX_MERCATOR_LAT:
+                        north = 90.0
+                    cluster["ids"] = [row[0] for row in conn.execute(
+                        SQL_SAMPLE_IDS_IN_BOX,
+                        (west, east, south, north, west, east, south, north, samples))]
+                clusters.append(cluster)
+    return {"zoom": zoom, "level": level, "clusters": clusters}
+
+# 集計用の列指向スナップショット
+SQL_SELECT_SNAPSHOT_ROWS = f'''
+    SELECT id, latitude, longitude,
+           COALESCE(timestamp_ms, {SQL_TIMESTAMP_TO_MS.format(column="timestamp")})
+    FROM locations ORDER BY id
+'''
+
+def load_snapshot_rows():
+    """スナップショットの作り直し用に全記録を読む（埋め戻し前の行は timestamp から換算する）"""
+    with db_pool.reader() as conn:
+        return conn.execute(SQL_SELECT_SNAPSHOT_ROWS).fetchall()
+
+location_snapshot = LocationSnapshot(load_snapshot_rows)
+
+# 統計の集計単位（JSTの区切り）
+STATS_BUCKETS = COUNT_UNITS
+
+def compute_location_stats(bucket, start_ms=None, end_ms=None):
+    """スナップショットから統計を計算する（期間指定はマスクで絞り込む）"""
+    columns = location_snapshot.columns()
+    if start_ms is not None or end_ms is not None:
+        timestamps = columns["timestamp_ms"]
+        mask = timestamps != MISSING_TIMESTAMP_MS
+        if start_ms is not None:
+            mask &= timestamps >= start_ms
+        if end_ms is not None:
+            mask &= timestamps < end_ms
+        columns = {name: column[mask] for name, column in columns.items()}
+    stats = summarize(columns, STATS_BUCKETS[bucket], JST_OFFSET_MS)
+    stats["bucket"] = bucket
+    for entry in stats["buckets"]:
+        entry["start"] = format_timestamp_ms(entry["start_ms"])
+    return stats
+
+# ヒートマップタイルの最大ズーム
+HEATMAP_MAX_ZOOM = 22
+HEATMAP_MEDIA_TYPES = {"png": "image/png", "u16": "application/octet-stream"}
+
+# 描画済みタイルのキャッシュ（記録の追加・削除で影響するタイルだけ捨てる）
+heatmap_tiles = heatmap.TileCache()
+
+SQL_SELECT_POINTS_IN_BOX = '''
+    SELECT l.latitude, l.longitude FROM location_rtree r CROSS JOIN locations l ON l.id = r.id
+    WHERE r.max_lon >= ? AND r.min_lon <= ? AND r.max_lat >= ? AND r.min_lat <= ?
+'''
+
+def fetch_heatmap_points(z, x, y):
+    """タイル (z, x, y) とその周囲（ぼかしの半径分）の記録の緯度・経度を取得する
+
+    日付変更線の向こう側の点は含めない（端のタイルのぼかしはそこで途切れる）。
+    """
+    size = 1 << z
+    margin = heatmap.HEATMAP_RADIUS / heatmap.TILE_SIZE
+    west = max(-180.0, (x - margin) / size * 360.0 - 180.0)
+    east = min(180.0, (x + 1 + margin) / size * 360.0 - 180.0)
+    north = geogrid.unit_to_lat(max(0.0, (y - margin) / size))
+    south = geogrid.unit_to_lat(min(1.0, (y + 1 + margin) / size))
+    if y - margin <= 0:
+        north = 90.0
+    if y + 1 + margin >= size:
+        south = -90.0
+    with db_pool.reader() as conn:
+        return conn.execute(SQL_SELECT_POINTS_IN_BOX, (west, east, south, north)).fetchall()
+
+def render_heatmap_tile(z, x, y, fmt):
+    """ヒートマップタイルを描画する（png: RGBA画像 / u16: 密度の uint16 配列）"""
+    points = fetch_heatmap_points(z, x, y)
+    lats = [point[0] for point in points]
+    lons = [point[1] for point in points]
+    rows, cols = heatmap.to_tile_pixels(lats, lons, z, x, y)
+    density = heatmap.render_density(rows, cols)
+    if fmt == "u16":
+        return heatmap.encode_u16(density)
+    return heatmap.encode_png(heatmap.colorize(density))
+
+# エクスポートの1ページあたりの件数（メモリ使用量はこの件数分で一定）
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+EXPORT_FIELDS = ["id", "latitude", "longitude", "timestamp", "timestamp_ms",
+                 "session_id", "user_agent", "ip_address"]
+EXPORT_MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+# クライアントから受け取った文字列の項目（CSVでは表計算ソフトの数式として解釈されないようにする）
+EXPORT_TEXT_FIELDS = ("session_id", "user_agent", "ip_address")
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+def escape_csv_formula(value):
+    """数式として解釈される文字で始まる値の先頭に ' を付ける"""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def export_record(row):
+    """エクスポート用の1件（管理者向けの項目 + エポックミリ秒）"""
+    record = format_admin_location(row)
+    record["timestamp_ms"] = location_timestamp(row[3], row[4], epoch=True)
+    return record
+
+def encode_export_header(export_format):
+    """エクスポートの先頭部分（CSVのヘッダー行）"""
+    if export_format != "csv":
+        return b""
+    return (",".join(EXPORT_FIELDS) + "\n").encode("utf-8")
+
+def encode_export_rows(rows, export_format):
+    """1ページ分の行をCSVまたはNDJSONにエンコードする"""
+    if export_format == "ndjson":
+        return "".join(json.dumps(export_record(row), ensure_ascii=False) + "\n"
+                       for row in rows).encode("utf-8")
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, lineterminator="\n")
+    for row in rows:
+        record = export_record(row)
+        for field in EXPORT_TEXT_FIELDS:
+            record[field] = escape_csv_formula(record[field])
+        writer.writerow(record)
+    return buffer.getvalue().encode("utf-8")
+
+def read_export_page(export_format, position, compressor=None):
+    """エクスポートの1ページを読み込んでエンコード（gzip指定時は圧縮も）する
+
+    (バイト列, 次の位置) を返す。最後のページでは次の位置は None。
+    """
+    rows, next_cursor = fetch_location_page(SQL_PAGE_LOCATIONS_ADMIN, EXPORT_PAGE_SIZE, position)
+    chunk = encode_export_rows(rows, export_format)
+    if compressor is not None:
+        chunk = compressor.compress(chunk)
+        if next_cursor is None:
+            chunk += compressor.flush()
+    return chunk, (decode_page_cursor(next_cursor) if next_cursor else None)
+
+async def export_stream(export_format, use_gzip):
+    """位置情報をページ単位で読みながら出力する（全件をメモリに載せない）"""
+    # wbits=31 で gzip 形式のストリームになる
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if use_gzip else None
+    header = encode_export_header(export_format)
+    if header:
+        yield compressor.compress(header) if compressor else header
+    position = None
+    try:
+        while True:
+            chunk, position = await run_blocking(read_export_page, export_format, position, compressor)
+            if chunk:
+                yield chunk
+            if position is None:
+                break
+    except Exception:
+        # 送信開始後はステータスを変えられないので、ログを残して接続を切る
+        logger.exception("Error in export_stream", extra={"event": "export.failed", "format": export_format})
+        raise
+
+# timestamp_ms の埋め戻しの1回あたりの件数と間隔
+TIMESTAMP_BACKFILL_CHUNK = int(os.getenv("TIMESTAMP_BACKFILL_CHUNK", "1000"))
+TIMESTAMP_BACKFILL_PAUSE = float(os.getenv("TIMESTAMP_BACKFILL_PAUSE", "0.05"))
+
+def backfill_timestamp_ms_chunk(limit=TIMESTAMP_BACKFILL_CHUNK):
+    """timestamp_ms が未設定の行を最大 limit 件埋め、更新件数を返す"""
+    with db_pool.writer() as conn:
+        return conn.execute(SQL_BACKFILL_TIMESTAMP_MS, (limit,)).rowcount
+
+async def backfill_timestamps():
+    """移行前の行の timestamp_ms を少しずつ埋める（書き込みロックを長く占有しない）
+
+    埋め終わるまでの行は読み取り時に文字列から変換するので、結果は変わらない。
+    """
+    total = 0
+    try:
+        while True:
+            updated = await run_blocking(backfill_timestamp_ms_chunk)
+            if not updated:
+                break
+            total += updated
+            await asyncio.sleep(TIMESTAMP_BACKFILL_PAUSE)
+    except Exception:
+        logger.exception("Error in timestamp backfill", extra={"event": "backfill.failed"})
+    if total:
+        logger.info("Backfilled timestamp_ms for %d locations", total,
+                    extra={"event": "backfill.completed", "rows": total})
+
+def delete_location_by_id(location_id):
+    """位置情報を削除し、削除件数を返す"""
+    with db_pool.writer() as conn:
+        point = conn.execute(SQL_SELECT_LOCATION_POINT, (location_id,)).fetchone()
+        deleted = conn.execute(SQL_DELETE_LOCATION, (location_id,)).rowcount
+        if deleted:
+            seq = log_location_change(conn, location_id, 'delete')
+            update_location_grid(conn, [point], sign=-1)
+    if deleted:
+        resource_versions.bump("locations")
+        heatmap_tiles.invalidate_points([point])
+        location_snapshot.invalidate()
+        broadcaster.publish("location-deleted", {"id": location_id}, event_id=seq)
+    return deleted
+
+def delete_locations_by_ids(location_ids):
+    """複数の位置情報を1トランザクションで削除し、削除件数を返す（変更履歴・集計・キャッシュも更新する）"""
+    deleted = []
+    with db_pool.writer() as conn:
+        for location_id in location_ids:
+            point = conn.execute(SQL_SELECT_LOCATION_POINT, (location_id,)).fetchone()
+            if point is None:
+                continue
+            conn.execute(SQL_DELETE_LOCATION, (location_id,))
+            deleted.append((location_id, point, log_location_change(conn, location_id, 'delete')))
+        points = [point for _, point, _ in deleted]
+        if points:
+            update_location_grid(conn, points, sign=-1)
+    if deleted:
+        resource_versions.bump("locations")
+        heatmap_tiles.invalidate_points(points)
+        location_snapshot.invalidate()
+        for location_id, _, seq in deleted:
+            broadcaster.publish("location-deleted", {"id": location_id}, event_id=seq)
+    return len(deleted)
+
+def delete_own_location(location_id, session_id):
+    """セッションIDが一致する位置情報のみ削除し、削除件数を返す"""
+    with db_pool.writer() as conn:
+        point = conn.execute(SQL_SELECT_LOCATION_POINT, (location_id,)).fetchone()
+        deleted = conn.execute(SQL_DELETE_OWN_LOCATION, (location_id, session_id)).rowcount
+        if deleted:
+            seq = log_location_change(conn, location_id, 'delete')
+            update_location_grid(conn, [point], sign=-1)
+    if deleted:
+        resource_versions.bump("locations")
+        heatmap_tiles.invalidate_points([point])
+        location_snapshot.invalidate()
+        broadcaster.publish("location-deleted", {"id": location_id}, event_id=seq)
+    return deleted
+
+def encode_json(data):
+    """JSONResponseと同じ形式でJSONをバイト列にエンコードする"""
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+# /api/locations のgzip配信設定
+LOCATIONS_GZIP = os.getenv("LOCATIONS_GZIP", "1") == "1"
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
+
+class LocationsResponseCache:
+    """/api/locations のエンコード済みレスポンスのキャッシュ
+
+    locations の世代番号（resource_versions の "locations"）ごとにJSONのバイト列と
+    gzip版を保持し、データが変わっていない間はDBにもエンコードにも触れずに返す。
+    世代番号は記録・削除の書き込み処理で進められる。
+    タイムスタンプの形式（ISO / エポックミリ秒）ごとに別のエントリを持つ。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, generation, epoch):
+        entry = self._entries.get(epoch)
+        if entry is not None and entry["generation"] == generation:
+            return entry
+        return None
+
+    def get(self, generation, epoch=False):
+        """指定した世代のキャッシュがあれば返す（なければNone）"""
+        entry = self._lookup(generation, epoch)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def build(self, generation, epoch=False):
+        """DBから読み込んでエンコードし、キャッシュする"""
+        with self._lock:
+            entry = self._lookup(generation, epoch)
+            if entry is None:
+                entry = {"generation": generation, "body": encode_json(fetch_locations(epoch)), "gzip": None}
+                self._entries[epoch] = entry
+            return entry
+
+    @staticmethod
+    def gzip_body(entry):
+        """gzip版のボディを返す（初回のみ圧縮）"""
+        if entry["gzip"] is None:
+            entry["gzip"] = gzip.compress(entry["body"], compresslevel=6, mtime=0)
+        return entry["gzip"]
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = {}
+
+locations_cache = LocationsResponseCache()
+
+def accepts_gzip(request):
+    """クライアントがgzipを受け付けるか判定する"""
+    return LOCATIONS_GZIP and "gzip" in request.headers.get("accept-encoding", "").lower()
 
 # 管理者認証（簡易版）
 def verify_admin_password(password: str):
@@ -289,73 +1809,103 @@ async def enable_recording(session: RecordingSession, admin_password: str):
     if session.expires_at:
         expires_at = session.expires_at
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE recording_sessions 
-        SET enabled = ?, expires_at = ?, description = ?
-        WHERE id = 1
-    ''', (1 if session.enabled else 0, expires_at, session.description))
-    conn.commit()
-    conn.close()
+    await run_blocking(update_recording_session, session.enabled, expires_at, session.description)
+    # 新しい期限でタイマーを張り直す
+    session_scheduler.rearm()
     
     return {"message": "Recording session updated", "session": session}
 
 @app.get("/api/admin/session-status")
 async def get_session_status(admin_password: str):
     verify_admin_password(admin_password)
-    return get_recording_session()
+    return await current_recording_session()
 
 @app.get("/api/admin/locations")
-async def get_all_locations_admin(admin_password: str):
+async def get_all_locations_admin(request: Request, admin_password: str,
+                                  limit: Optional[int] = None, cursor: Optional[str] = None):
     verify_admin_password(admin_password)
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, latitude, longitude, timestamp, session_id, user_agent, ip_address 
-        FROM locations 
-        ORDER BY timestamp DESC
-    ''')
-    locations = cursor.fetchall()
-    conn.close()
+    epoch = wants_epoch(request)
+    if limit is not None or cursor is not None:
+        # ページ単位の取得（{"locations": [...], "next_cursor": ...}）
+        limit = page_limit(limit)
+        position = decode_page_cursor(cursor) if cursor else None
+        
+        def load_page():
+            rows, next_cursor = fetch_location_page(SQL_PAGE_LOCATIONS_ADMIN, limit, position)
+            return encode_json({
+                "locations": [format_admin_location(row, epoch) for row in rows],
+                "next_cursor": next_cursor
+            })
+        body = await run_blocking(load_page)
+    else:
+        # 全件ダンプは件数が多いため、取得からJSONエンコードまでスレッドプールで行う
+        body = await run_blocking(lambda: encode_json(fetch_admin_locations(epoch)))
+    return Response(content=body, media_type=EPOCH_MEDIA_TYPE if epoch else "application/json",
+                    headers={"Vary": "Accept"})
+
+# 管理者向けのエクスポート（CSV / NDJSON をストリーミングで返す）
+@app.get("/api/admin/locations/export")
+async def export_locations_admin(request: Request, admin_password: str, format: str = "csv"):
+    verify_admin_password(admin_password)
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be one of: csv, ndjson")
     
-    return [
-        {
-            "id": loc[0],
-            "latitude": loc[1],
-            "longitude": loc[2],
-            "timestamp": get_jst_timestamp(datetime.datetime.fromisoformat(loc[3]) if loc[3] else None),
-            "session_id": loc[4],
-            "user_agent": loc[5],
-            "ip_address": loc[6]
-        }
-        for loc in locations
-    ]
+    use_gzip = accepts_gzip(request)
+    filename = f"locations-{get_jst_now().strftime('%Y%m%d-%H%M%S')}.{format}"
+    headers = {
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "Vary": "Accept-Encoding"
+    }
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(export_stream(format, use_gzip),
+                             media_type=EXPORT_MEDIA_TYPES[format], headers=headers)
+
+# 管理者用のダッシュボード（集計表から読むだけ）
+@app.get("/api/admin/dashboard")
+async def get_dashboard(admin_password: str):
+    """総件数・今日/直近の件数・日別/時間別件数・件数の多い地域を取得"""
+    verify_admin_password(admin_password)
+    return await run_blocking(fetch_dashboard)
+
+# 遅いリクエストとイベントループの停止
+@app.get("/api/admin/slow-requests")
+async def get_slow_requests(admin_password: str, limit: Optional[int] = None):
+    """直近の遅いリクエスト（ルート・引数の形・DB時間・スタック）とイベントループの遅延を取得"""
+    verify_admin_password(admin_password)
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    return loop_watchdog.report(limit)
+
+# 管理者用の統計
+@app.get("/api/admin/stats")
+async def get_location_stats(admin_password: str, bucket: str = "day",
+                             start: Optional[str] = None, end: Optional[str] = None):
+    """記録の時間帯別件数・重心・範囲・散らばりを取得"""
+    verify_admin_password(admin_password)
+    if bucket not in STATS_BUCKETS:
+        raise HTTPException(status_code=400, detail="bucket must be one of: hour, day")
+    start_ms = parse_time_param(start, "start")
+    end_ms = parse_time_param(end, "end")
+    return await run_blocking(compute_location_stats, bucket, start_ms, end_ms)
 
 # 管理者による記録削除
 @app.delete("/api/admin/locations/{location_id}")
 async def delete_location_admin(location_id: int, admin_password: str):
     verify_admin_password(admin_password)
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('DELETE FROM locations WHERE id = ?', (location_id,))
+    deleted = await run_blocking(delete_location_by_id, location_id)
     
-    if cursor.rowcount == 0:
-        conn.close()
+    if deleted == 0:
         raise HTTPException(status_code=404, detail="Location not found")
     
-    conn.commit()
-    conn.close()
-    
     return {"message": "Location deleted successfully"}
 
 # 管理者による設定取得
 @app.get("/api/admin/config")
 async def get_config_admin(admin_password: str):
     verify_admin_password(admin_password)
-    return load_config()
+    return await run_blocking(load_config)
 
 # 管理者による設定更新
 @app.put("/api/admin/config")
@@ -369,7 +1919,7 @@ async def update_config_admin(config: NameCardConfig, admin_password: str):
         "design": config.design
     }
     
-    if save_config(config_data):
+    if await run_blocking(save_config, config_data):
         return {"message": "Configuration updated successfully", "config": config_data}
     else:
         raise HTTPException(status_code=500, detail="Failed to save configuration")
@@ -378,185 +1928,326 @@ async def update_config_admin(config: NameCardConfig, admin_password: str):
 
 # 記録セッション状態確認（公開）
 @app.get("/api/recording-status")
-async def get_recording_status():
-    session = get_recording_session()
-    return {
+async def get_recording_status(request: Request):
+    session = await current_recording_session()
+    # 期限切れはメモリ上で判定されるため、有効/無効もETagに含める
+    etag = resource_versions.etag("recording-status", suffix="-1" if session["enabled"] else "-0")
+    headers = validator_headers(etag, resource_versions.last_modified("recording-status"))
+    if is_not_modified(request, etag, resource_versions.last_modified("recording-status")):
+        return not_modified_response(headers)
+    return JSONResponse({
         "enabled": session["enabled"],
         "expires_at": session["expires_at"],
         "description": session["description"]
-    }
+    }, headers=headers)
 
 # 位置情報記録（セッション有効時のみ）
 @app.post("/api/record-location")
 async def record_location(location: LocationRecord):
     """位置情報を記録"""
     try:
-        print(f"Received location record request: {location}")
+        # ボディ（座標・セッションID）は LOG_REQUEST_BODIES を指定したときだけ記録する
+        logger.debug("Received location record request", extra={
+            "event": "location.received", "body": location.model_dump() if LOG_REQUEST_BODIES else None})
           # 記録が有効かチェック
-        session = get_recording_session()
+        session = await current_recording_session()
         if not session["enabled"]:  # enabled
-            raise HTTPException(status_code=403, detail="Recording is currently disabled")        # セッションの期限をチェック
-        if session["expires_at"]:  # expires_at exists
-            try:
-                # ISO形式の文字列をパース（簡単な形式のみサポート）
-                expires_str = session["expires_at"].replace('Z', '+00:00').replace('T', ' ')
-                if '+' in expires_str:
-                    expires_str = expires_str.split('+')[0]
-                
-                # 秒が含まれているかチェック
-                if len(expires_str) >= 19 and expires_str[16] == ':':
-                    # 秒が含まれている場合（YYYY-MM-DD HH:MM:SS）
-                    expires_dt = datetime.datetime.strptime(expires_str[:19], '%Y-%m-%d %H:%M:%S')
-                else:
-                    # 秒が含まれていない場合（YYYY-MM-DD HH:MM）
-                    expires_dt = datetime.datetime.strptime(expires_str[:16], '%Y-%m-%d %H:%M')
-                
-                expires_dt = JST.localize(expires_dt)
-                
-                if datetime.datetime.now(JST) > expires_dt:
-                    raise HTTPException(status_code=403, detail="Recording session has expired")
-            except Exception as e:
-                print(f"Date parsing error in record_location: {e}")
-                # パースエラーの場合は期限チェックをスキップ
-          # 既存の記録をチェック（1人1記録の制限）
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
+            raise HTTPException(status_code=403, detail="Recording is currently disabled")
+        # 期限切れは get_recording_session() の判定に含まれている
         
-        if location.session_id:
-            cursor.execute('''
-                SELECT COUNT(*) FROM locations WHERE session_id = ?
-            ''', (location.session_id,))
-            
-            if cursor.fetchone()[0] > 0:
-                conn.close()
+        if not ingest_queue.running:
+            # キューが動いていない（lifespan外）場合は直接書き込む
+            location_id = await run_blocking(insert_location, location)
+        else:
+            try:
+                result = await ingest_queue.submit(location)
+            except IngestQueueFull:
+                raise HTTPException(status_code=503, detail="Too many pending location records",
+                                    headers={"Retry-After": "1"})
+            if result is None:
+                # enqueue モード：書き込みは後で行われる
+                return JSONResponse({"message": "Location accepted"}, status_code=202)
+            status_name, location_id = result
+            if status_name == "duplicate_session":
                 raise HTTPException(status_code=409, detail="既に位置情報を記録済みです")
         
-        # JSTタイムスタンプを生成
-        jst_now = datetime.datetime.now(JST)
-          # 位置情報を記録
-        cursor.execute('''
-            INSERT INTO locations (latitude, longitude, timestamp, session_id, user_agent, ip_address)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (location.latitude, location.longitude, jst_now.isoformat(), location.session_id, None, None))
-        
-        conn.commit()
-        conn.close()
-        
-        print(f"Successfully recorded location: lat={location.latitude}, lon={location.longitude}")
-        return {"message": "Location recorded successfully"}
+        logger.info("Recorded location", extra={"event": "location.recorded", "location_id": location_id})
+        return {"message": "Location recorded successfully", "id": location_id}
         
     except HTTPException as e:
-        print(f"HTTP Exception in record_location: {e}")
+        logger.info("Rejected location record: %s", e.detail,
+                    extra={"event": "location.rejected", "status": e.status_code})
         raise e
     except Exception as e:
-        print(f"Error in record_location: {e}")
-        traceback.print_exc()
+        logger.exception("Error in record_location", extra={"event": "location.failed"})
         raise HTTPException(status_code=500, detail=f"Failed to record location: {str(e)}")
 
+# 位置情報の一括記録（オフライン端末・キオスク向け）
+@app.post("/api/record-locations")
+async def record_locations_batch(batch: LocationBatch):
+    """複数の位置情報をまとめて記録し、要素ごとの結果を返す"""
+    if len(batch.locations) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"A batch can contain at most {MAX_BATCH_SIZE} locations")
+    
+    # 記録が有効かチェック（バッチ全体で1回）
+    session = await current_recording_session()
+    if not session["enabled"]:
+        raise HTTPException(status_code=403, detail="Recording is currently disabled")
+    
+    results = [None] * len(batch.locations)
+    valid_indexes = []
+    valid_locations = []
+    for index, item in enumerate(batch.locations):
+        try:
+            valid_locations.append(LocationRecord.model_validate(item))
+            valid_indexes.append(index)
+        except ValidationError as e:
+            results[index] = {
+                "index": index,
+                "status": "invalid",
+                "errors": [error["msg"] for error in e.errors()]
+            }
+    
+    if valid_locations:
+        try:
+            inserted = await run_blocking(insert_locations_batch, valid_locations)
+        except Exception as e:
+            logger.exception("Error in record_locations_batch",
+                             extra={"event": "location.batch_failed", "size": len(valid_locations)})
+            raise HTTPException(status_code=500, detail=f"Failed to record locations: {str(e)}")
+        for index, (status_name, location_id) in zip(valid_indexes, inserted):
+            result = {"index": index, "status": status_name}
+            if location_id is not None:
+                result["id"] = location_id
+            results[index] = result
+    
+    return {
+        "accepted": sum(1 for result in results if result["status"] == "accepted"),
+        "results": results
+    }
+
 # 位置情報取得（公開用）
 @app.get("/api/locations")
-async def get_locations():
-    """位置情報の一覧を取得"""
+async def get_locations(request: Request, since: Optional[int] = None,
+                        limit: Optional[int] = None, cursor: Optional[str] = None,
+                        bbox: Optional[str] = None, start: Optional[str] = None,
+                        end: Optional[str] = None):
+    """位置情報の一覧を取得（since を指定すると、そのカーソル以降の差分を返す）
+
+    limit / cursor を指定するとページ単位で返す。
+    bbox（西,南,東,北）や start / end（期間）を指定すると、その範囲の記録だけを返す。
+    Accept に EPOCH_MEDIA_TYPE を指定すると、タイムスタンプをエポックミリ秒で返す。
+    """
+    epoch = wants_epoch(request)
+    media_type = EPOCH_MEDIA_TYPE if epoch else "application/json"
+    if bbox is not None or start is not None or end is not None:
+        if since is not None or limit is not None or cursor is not None:
+            raise HTTPException(status_code=400,
+                                detail="bbox/start/end cannot be combined with since/limit/cursor")
+        box = parse_bbox(bbox) if bbox is not None else None
+        start_ms = parse_time_param(start, "start")
+        end_ms = parse_time_param(end, "end")
+        locations = await run_blocking(fetch_locations_filtered, box, start_ms, end_ms, epoch)
+        return JSONResponse(locations, media_type=media_type, headers={"Vary": "Accept"})
+    if since is None and (limit is not None or cursor is not None):
+        limit = page_limit(limit)
+        position = decode_page_cursor(cursor) if cursor else None
+        rows, next_cursor = await run_blocking(fetch_location_page, SQL_PAGE_LOCATIONS, limit, position)
+        return JSONResponse({
+            "locations": [format_location(row, epoch) for row in rows],
+            "next_cursor": next_cursor
+        }, media_type=media_type, headers={"Vary": "Accept"})
+    if since is not None:
+        try:
+            changes = await run_blocking(fetch_location_changes, since, epoch)
+            return JSONResponse(changes, media_type=media_type, headers={"Vary": "Accept"})
+        except Exception as e:
+            logger.exception("Error in get_locations", extra={"event": "locations.failed"})
+            raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    
+    # 取得前の世代番号を使う（取得中に追加があっても次回は必ず再取得される）
+    generation = resource_versions.version("locations")
+    use_gzip = accepts_gzip(request)
+    suffix = ("-epoch" if epoch else "") + ("-gz" if use_gzip else "")
+    etag = resource_versions.etag("locations", generation, suffix=suffix)
+    last_modified = resource_versions.last_modified("locations")
+    headers = validator_headers(etag, last_modified)
+    headers["Vary"] = "Accept, Accept-Encoding"
+    if is_not_modified(request, etag, last_modified):
+        return not_modified_response(headers)
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # まずテーブルが存在するかチェック
-        cursor.execute("""
-            SELECT name FROM sqlite_master 
-            WHERE type='table' AND name='locations'
-        """)
+        entry = locations_cache.get(generation, epoch)
+        if entry is None:
+            entry = await run_blocking(locations_cache.build, generation, epoch)
         
-        if not cursor.fetchone():
-            print("Locations table does not exist")
-            conn.close()
-            return []
-        
-        cursor.execute('''
-            SELECT latitude, longitude, timestamp, session_id 
-            FROM locations 
-            ORDER BY timestamp DESC
-        ''')
-        
-        locations = []
-        for row in cursor.fetchall():
-            lat, lon, timestamp, session_id = row
-            try:
-                # JSTタイムゾーンでフォーマット
-                dt = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-                jst_dt = dt.astimezone(JST)
-                formatted_timestamp = jst_dt.isoformat()
-            except Exception as e:
-                print(f"Timestamp parsing error: {e}")
-                formatted_timestamp = timestamp
-            
-            locations.append({
-                "latitude": lat,
-                "longitude": lon,
-                "timestamp": formatted_timestamp,
-                "session_id": session_id or ""
-            })
-        
-        conn.close()
-        return locations
+        body = entry["body"]
+        if use_gzip and len(body) >= GZIP_MIN_SIZE:
+            body = entry["gzip"] or await run_blocking(locations_cache.gzip_body, entry)
+            headers["Content-Encoding"] = "gzip"
+        return Response(content=body, media_type=media_type, headers=headers)
         
     except Exception as e:
-        print(f"Error in get_locations: {e}")
-        traceback.print_exc()
+        logger.exception("Error in get_locations", extra={"event": "locations.failed"})
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
+# ズームに応じたクラスタ（公開用）
+@app.get("/api/locations/clusters")
+async def get_location_clusters(zoom: int, bbox: str, samples: int = 0):
+    """表示範囲内の記録をグリッド単位で集計したクラスタを取得"""
+    if zoom < 0 or zoom > 30:
+        raise HTTPException(status_code=400, detail="zoom must be between 0 and 30")
+    if samples < 0 or samples > CLUSTER_MAX_SAMPLES:
+        raise HTTPException(status_code=400, detail=f"samples must be between 0 and {CLUSTER_MAX_SAMPLES}")
+    box = parse_bbox(bbox)
+    try:
+        return await run_blocking(fetch_location_clusters, zoom, box, samples)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# ヒートマップタイル（公開用）
+@app.get("/api/heatmap/{z}/{x}/{y}")
+async def get_heatmap_tile(z: int, x: int, y: int, format: str = "png"):
+    """記録の密度をXYZタイルとして取得（png または uint16 の生データ）"""
+    if format not in HEATMAP_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be one of: png, u16")
+    if z < 0 or z > HEATMAP_MAX_ZOOM:
+        raise HTTPException(status_code=400, detail=f"z must be between 0 and {HEATMAP_MAX_ZOOM}")
+    if not (0 <= x < (1 << z) and 0 <= y < (1 << z)):
+        raise HTTPException(status_code=400, detail="tile is out of range")
+    
+    key = (z, x, y, format)
+    body = heatmap_tiles.get(key)
+    if body is None:
+        generation = heatmap_tiles.generation
+        body = await run_blocking(render_heatmap_tile, z, x, y, format)
+        heatmap_tiles.put(key, body, generation)
+    headers = {"X-Tile-Size": str(heatmap.TILE_SIZE)}
+    if format == "u16":
+        headers["X-Heatmap-Scale"] = str(heatmap.HEATMAP_U16_SCALE)
+    return Response(content=body, media_type=HEATMAP_MEDIA_TYPES[format], headers=headers)
+
+# 記録件数（公開用）
+@app.get("/api/locations/count")
+async def get_location_count():
+    """記録件数を取得（トリガーで維持しているカウンタを読むだけ）"""
+    return {"count": await run_blocking(fetch_location_count)}
+
 # 位置情報削除（ユーザー自身の記録のみ）
 @app.delete("/api/locations/{location_id}")
 async def delete_location(location_id: int, x_session_id: str = Header(None)):
     if not x_session_id:
         raise HTTPException(status_code=400, detail="Session ID is required")
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
     # セッションIDが一致する記録のみ削除
-    cursor.execute('''
-        DELETE FROM locations 
-        WHERE id = ? AND session_id = ?
-    ''', (location_id, x_session_id))
+    deleted = await run_blocking(delete_own_location, location_id, x_session_id)
     
-    if cursor.rowcount == 0:
-        conn.close()
+    if deleted == 0:
         raise HTTPException(status_code=404, detail="Location not found or not owned by user")
     
-    conn.commit()
-    conn.close()
-    
     return {"message": "Location deleted successfully"}
 
+# ライブ更新（Server-Sent Events）
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", "15"))
+
+async def event_stream(subscription):
+    """購読したイベントを送り続ける（切断・追い出し時に終了）"""
+    try:
+        # 接続直後に現在の記録状態を送る
+        yield format_sse("session", await current_recording_session())
+        while True:
+            try:
+                message = await asyncio.wait_for(subscription.queue.get(), timeout=SSE_HEARTBEAT_INTERVAL)
+            except asyncio.TimeoutError:
+                # トンネルやプロキシに切断されないよう定期的にコメントを送る
+                yield b": ping\n\n"
+                continue
+            if message is None:
+                break
+            yield message
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+@app.get("/api/events")
+async def stream_events():
+    """位置情報の追加・削除と記録状態の変更をSSEで配信する"""
+    subscription = broadcaster.subscribe()
+    return StreamingResponse(
+        event_stream(subscription),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # 名刺情報取得
 @app.get("/api/card-info")
-async def get_card_info():
-    config = load_config()
-    
-    # personalInfoから表示用の情報を生成
-    personal_info = config.get("personalInfo", {})
-    social_links = config.get("socialLinks", [])
-    design = config.get("design", {})
-    
-    # 空文字列の項目をフィルタリング
-    filtered_info = {}
-    for key, value in personal_info.items():
-        if value and value.strip():  # 空文字列や空白文字のみでない場合
-            filtered_info[key] = value
-    
-    # 有効なソーシャルリンクのみをフィルタリング
-    enabled_social_links = [
-        link for link in social_links 
-        if link.get("enabled", False) and link.get("url", "").strip()
-    ]
-    
+async def get_card_info(request: Request):
+    # フィルタリング済み・シリアライズ済みのレスポンスをキャッシュから返す
+    entry = config_cache.peek()
+    if entry is None:
+        entry = await run_blocking(config_cache.refresh)
+    # ETag は本文と同じエントリから取る（その間に別の読み直しがあっても組が崩れない）
+    etag, last_modified, body = entry
+    headers = validator_headers(etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        return not_modified_response(headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# メトリクス（Prometheus形式）
+def cache_statistics():
+    """キャッシュごとの (ヒット数, ミス数)"""
+    timestamp_info = format_timestamp_ms.cache_info()
     return {
-        "personalInfo": filtered_info,
-        "socialLinks": enabled_social_links,
-        "design": design
+        "locations_response": (locations_cache.hits, locations_cache.misses),
+        "heatmap_tiles": (heatmap_tiles.hits, heatmap_tiles.misses),
+        "timestamp_format": (timestamp_info.hits, timestamp_info.misses),
+        "card_info": (config_cache.hits, config_cache.misses),
+        "recording_session": (session_cache.hits, session_cache.misses),
     }
 
+def render_metrics(location_count):
+    """/metrics の本文を作る"""
+    caches = cache_statistics()
+    lines = []
+    lines += http_requests_total.render()
+    lines += http_request_duration.render()
+    lines += sql_statement_duration.render()
+    lines += metrics.render_samples("ingest_queue_depth", "Location records waiting in the ingest queue",
+                                    {(): ingest_queue.depth})
+    lines += metrics.render_samples("cache_hits_total", "Cache hits", {
+        (name,): hits for name, (hits, _) in caches.items()}, ("cache",), kind="counter")
+    lines += metrics.render_samples("cache_misses_total", "Cache misses", {
+        (name,): misses for name, (_, misses) in caches.items()}, ("cache",), kind="counter")
+    lines += metrics.render_samples("cache_hit_ratio", "Cache hit ratio since start", {
+        (name,): hits / (hits + misses) for name, (hits, misses) in caches.items() if hits + misses}, ("cache",))
+    lines += metrics.render_samples("locations_rows", "Rows in the locations table", {(): location_count})
+    lines += metrics.render_samples("event_loop_lag_seconds", "Most recent event loop lag",
+                                    {(): loop_watchdog.last_lag})
+    lines += metrics.render_samples("event_loop_stalls_total", "Event loop stalls over the threshold",
+                                    {(): loop_watchdog.stall_count}, kind="counter")
+    return "\n".join(lines) + "\n"
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus 形式のメトリクス"""
+    location_count = await run_blocking(fetch_location_count)
+    return Response(content=render_metrics(location_count), media_type=metrics.CONTENT_TYPE)
+
+def collect_statement_names(namespace):
+    """SQL_* 定数（文字列、または文字列の辞書）から SQL文字列 -> 名前 の対応を作る"""
+    names = {}
+    for name, value in namespace.items():
+        if not name.startswith("SQL_"):
+            continue
+        label = name[4:].lower()
+        if isinstance(value, str):
+            names.setdefault(value, label)
+        elif isinstance(value, dict):
+            for key, sql in value.items():
+                if isinstance(sql, str):
+                    names.setdefault(sql, f"{label}_{key}")
+    return names
+
+SQL_STATEMENT_NAMES.update(collect_statement_names(globals()))
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,183 @@
+import bisect
+import threading
+import time
+
+# Prometheus のテキスト形式で出力する軽量なメトリクス
+# 値はスレッドごとの領域に書き込み（ロックなし）、出力時に合計する
+
+HTTP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Sharded:
+    """スレッドごとの値の置き場所（作るときだけロックを取る）"""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {}
+            self._local.shard = shard
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def _snapshot(self):
+        with self._lock:
+            shards = list(self._shards)
+        # 他のスレッドが書き込み中でも読めるよう、各領域をコピーしてから合計する
+        return [dict(shard) for shard in shards]
+
+
+class Counter(_Sharded):
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__()
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def values(self):
+        totals = {}
+        for shard in self._snapshot():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}")
+        return lines
+
+
+class Histogram(_Sharded):
+    def __init__(self, name, documentation, labelnames=(), buckets=HTTP_BUCKETS):
+        super().__init__()
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        shard = self._shard()
+        state = shard.get(labels)
+        if state is None:
+            # [バケットごとの件数..., +Inf の件数, 合計]
+            state = [0] * (len(self.buckets) + 1) + [0.0]
+            shard[labels] = state
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def values(self):
+        """ラベルごとの (累積件数のリスト, 件数, 合計) を返す"""
+        merged = {}
+        for shard in self._snapshot():
+            for labels, state in shard.items():
+                total = merged.setdefault(labels, [0] * len(state[:-1]) + [0.0])
+                for index, value in enumerate(list(state)):
+                    total[index] += value
+        result = {}
+        for labels, state in merged.items():
+            cumulative = []
+            running = 0
+            for count in state[:-1]:
+                running += count
+                cumulative.append(running)
+            result[labels] = (cumulative, running, state[-1])
+        return result
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        bucket_names = self.labelnames + ("le",)
+        for labels, (cumulative, count, total) in sorted(self.values().items()):
+            for bound, value in zip(self.buckets + (float("inf"),), cumulative):
+                lines.append(f"{self.name}_bucket{format_labels(bucket_names, labels + (format_value(bound),))} {value}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}")
+        return lines
+
+
+def render_samples(name, documentation, samples, labelnames=(), kind="gauge"):
+    """出力時に値を求めるメトリクス（samples は ラベルの組 -> 値 の辞書）"""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    for labels, value in sorted(samples.items()):
+        lines.append(f"{name}{format_labels(labelnames, labels)} {format_value(value)}")
+    return lines
+
+
+class RouteResolver:
+    """scope からルートのパスのテンプレート（例: /api/admin/locations/{location_id}）を求める
+
+    ルートに一致しなかったリクエストは "unmatched" にまとめ、ラベルの種類が増えすぎないようにする。
+    """
+
+    def __init__(self):
+        self._route_paths = None
+
+    def __call__(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self._route_paths is None:
+            app = scope.get("app")
+            self._route_paths = {getattr(route, "endpoint", None): route.path
+                                 for route in getattr(app, "routes", [])}
+        return self._route_paths.get(endpoint, "unmatched")
+
+
+class MetricsMiddleware:
+    """リクエスト数と処理時間をルート（パスのテンプレート）・メソッド・ステータスごとに数えるASGIミドルウェア"""
+
+    def __init__(self, app, requests, latency, route_path=None):
+        self.app = app
+        self.requests = requests
+        self.latency = latency
+        self.route_path = route_path or RouteResolver()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            labels = (self.route_path(scope), scope["method"], str(status))
+            self.requests.inc(*labels)
+            self.latency.observe(time.perf_counter() - started, *labels)
@@ -0,0 +1,12 @@
+import main
+
+# 既存データベースの検索用インデックスを locations から作り直す
+# 使い方: cd backend && python rebuild_indexes.py
+count = main.rebuild_location_rtree()
+print(f"Rebuilt location_rtree: {count} locations")
+
+cells = main.rebuild_location_grid()
+print(f"Rebuilt location_grid: {cells} cells")
+
+main.db_pool.close()
+print("\nIndex rebuild completed!")
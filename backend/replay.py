@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+from urllib.parse import parse_qsl, urlencode
+
+import httpx
+
+from latency import summarize_latencies
+from traffic import REDACTED, REDACTED_PARAMS
+
+# 記録したトラフィック（TRAFFIC_CAPTURE_FILE）をローカルのバックエンドに再送する
+# 使い方: cd backend && python replay.py capture.ndjson --speed 4 --output replay.json
+
+# リプレイしないパス（SSEは接続が終わらないため）
+REPLAY_SKIP_PATHS = {"/api/events"}
+
+
+def load_capture(path):
+    """記録ファイルを読み、経過時刻順のリストにする"""
+    with open(path, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return sorted(entries, key=lambda entry: entry["t"])
+
+
+def route_key(entry):
+    """集計用のキー（数値のパス要素は {id} にまとめる）"""
+    path = re.sub(r"/\d+(?=/|$)", "/{id}", entry["path"])
+    return f"{entry['method']} {path}"
+
+
+def build_request(entry, index, admin_password, run_id):
+    """記録1件から再送するリクエスト (method, URL, JSONボディ) を作る
+
+    セッションIDは記録していないので、1人1記録の制限に掛からないよう毎回新しく付ける。
+    """
+    params = [(key, admin_password if key in REDACTED_PARAMS and value == REDACTED else value)
+              for key, value in parse_qsl(entry.get("query", ""), keep_blank_values=True)]
+    url = entry["path"] + (f"?{urlencode(params)}" if params else "")
+    body = None
+    coordinates = entry.get("coords")
+    if coordinates is not None:
+        locations = [{"latitude": lat, "longitude": lon, "session_id": f"replay-{run_id}-{index}-{i}"}
+                     for i, (lat, lon) in enumerate(coordinates)]
+        body = {"locations": locations} if entry["path"] == "/api/record-locations" else locations[0]
+    return entry["method"], url, body
+
+
+async def replay(entries, base_url, speed=1.0, admin_password="admin123", timeout=30.0, transport=None):
+    """記録の時刻どおり（speed 倍速、0以下なら待たずに）リクエストを再送し、経路ごとの結果を返す"""
+    entries = [entry for entry in entries if entry["path"] not in REPLAY_SKIP_PATHS]
+    run_id = time.time_ns()
+    latencies = {}
+    errors = {}
+    statuses = {}
+
+    async def send(client, index, entry):
+        key = route_key(entry)
+        method, url, body = build_request(entry, index, admin_password, run_id)
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, json=body)
+            status = str(response.status_code)
+            # 5xx をエラーとして数える（4xx は記録時と同じ応答のことが多い）
+            failed = response.status_code >= 500
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+            failed = True
+        latencies.setdefault(key, []).append((time.perf_counter() - started) * 1000)
+        counts = statuses.setdefault(key, {})
+        counts[status] = counts.get(status, 0) + 1
+        if failed:
+            errors[key] = errors.get(key, 0) + 1
+
+    started = time.perf_counter()
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, transport=transport) as client:
+        tasks = []
+        for index, entry in enumerate(entries):
+            if speed > 0:
+                delay = entry["t"] / 1000 / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(client, index, entry)))
+        await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    routes = {}
+    for key, values in sorted(latencies.items()):
+        routes[key] = summarize_latencies(values, errors.get(key, 0), elapsed)
+        routes[key]["status"] = statuses[key]
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "base_url": base_url,
+        "speed": speed,
+        "total": summarize_latencies(all_latencies, sum(errors.values()), elapsed),
+        "routes": routes,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a captured traffic log against a backend")
+    parser.add_argument("capture", help="NDJSON file written with TRAFFIC_CAPTURE_FILE")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed multiplier (1 = real time, 0 = as fast as possible)")
+    parser.add_argument("--admin-password", default=os.getenv("ADMIN_PASSWORD", "admin123"))
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--output", default=None, help="write the JSON report to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(replay(load_capture(args.capture), args.base_url, args.speed,
+                                args.admin_password, args.timeout))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
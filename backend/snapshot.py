@@ -0,0 +1,188 @@
+import threading
+
+import numpy as np
+
+# 列ごとの初期容量（足りなくなったら倍に広げる）
+INITIAL_CAPACITY = 1024
+# 地球の平均半径（メートル）
+EARTH_RADIUS_M = 6371008.8
+# 時刻を換算できなかった行の timestamp_ms（時間帯別件数・期間指定の対象外）
+MISSING_TIMESTAMP_MS = np.iinfo(np.int64).min
+
+
+class LocationSnapshot:
+    """locations の列指向スナップショット（集計用）
+
+    ID（uint32）・緯度・経度（float64）・エポックミリ秒（int64）を別々の配列で持つ。
+    記録の追加は末尾への追記で反映し、削除があった場合は次に読むときに作り直す。
+    追記は ID の昇順で届く前提（書き込みロック内で呼ぶ）で、順序が崩れていたら作り直す。
+    loader は (id, 緯度, 経度, エポックミリ秒) の行を ID の昇順で返す同期関数。
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+        self._columns = None
+        self._size = 0
+        self._last_id = 0
+        self._valid = False
+        # 作り直しの読み込み中に届いた追記と削除
+        self._loading = False
+        self._pending = []
+        self._dirty = False
+        self.rebuilds = 0
+
+    @property
+    def valid(self):
+        return self._valid
+
+    def _allocate(self, capacity):
+        return {
+            "id": np.empty(capacity, dtype=np.uint32),
+            "latitude": np.empty(capacity, dtype=np.float64),
+            "longitude": np.empty(capacity, dtype=np.float64),
+            "timestamp_ms": np.empty(capacity, dtype=np.int64),
+        }
+
+    def _append_rows(self, rows):
+        """ロックを持った状態で行を末尾に追記する（読み込み済みのIDは無視する）"""
+        rows = [(row[0], row[1], row[2], MISSING_TIMESTAMP_MS if row[3] is None else row[3])
+                for row in rows if row[0] > self._last_id]
+        if not rows:
+            return
+        needed = self._size + len(rows)
+        capacity = len(self._columns["id"])
+        if needed > capacity:
+            while capacity < needed:
+                capacity *= 2
+            grown = self._allocate(capacity)
+            for name, column in self._columns.items():
+                grown[name][:self._size] = column[:self._size]
+            self._columns = grown
+        values = list(zip(*rows))
+        for name, column in zip(("id", "latitude", "longitude", "timestamp_ms"), values):
+            self._columns[name][self._size:needed] = column
+        self._size = needed
+        self._last_id = rows[-1][0]
+
+    def append(self, rows):
+        """コミット済みの記録 [(id, 緯度, 経度, エポックミリ秒), ...] を追記する"""
+        rows = sorted(rows)
+        with self._lock:
+            if self._loading:
+                self._pending.extend(rows)
+            elif self._valid:
+                if rows and rows[0][0] <= self._last_id:
+                    # 先にコミットされた行より小さいIDが後から届いた（取りこぼさないよう作り直す）
+                    self._valid = False
+                    return
+                self._append_rows(rows)
+
+    def invalidate(self):
+        """削除などで追記では反映できない変更があったときに呼ぶ"""
+        with self._lock:
+            self._valid = False
+            if self._loading:
+                self._dirty = True
+
+    def _rebuild(self):
+        with self._lock:
+            self._loading = True
+            self._pending = []
+            self._dirty = False
+        try:
+            rows = self.loader()
+        except Exception:
+            with self._lock:
+                self._loading = False
+            raise
+        with self._lock:
+            self._columns = self._allocate(max(INITIAL_CAPACITY, len(rows)))
+            self._size = 0
+            self._last_id = 0
+            self._append_rows(rows)
+            # 読み込み中にコミットされた記録は ID が読み込み分より大きい
+            self._append_rows(sorted(self._pending))
+            self._pending = []
+            self._loading = False
+            self._valid = not self._dirty
+            self.rebuilds += 1
+
+    def columns(self):
+        """現在の列の読み取り専用ビューを返す（必要なら作り直す）"""
+        if not self._valid:
+            with self._rebuild_lock:
+                if not self._valid:
+                    self._rebuild()
+        with self._lock:
+            # 追記は _size より後ろにしか書かず、作り直しや拡張では新しい配列を使うので
+            # コピーしなくても返したビューの中身は変わらない
+            views = {}
+            for name, column in self._columns.items():
+                views[name] = column[:self._size]
+                views[name].flags.writeable = False
+            return views
+
+    def __len__(self):
+        return self._size
+
+
+def centroid(lats, lons):
+    """球面上の重心（単位ベクトルの平均）を (緯度, 経度) で返す"""
+    lat_rad = np.radians(lats)
+    lon_rad = np.radians(lons)
+    x = np.mean(np.cos(lat_rad) * np.cos(lon_rad))
+    y = np.mean(np.cos(lat_rad) * np.sin(lon_rad))
+    z = np.mean(np.sin(lat_rad))
+    return float(np.degrees(np.arctan2(z, np.hypot(x, y)))), float(np.degrees(np.arctan2(y, x)))
+
+
+def distances_m(lats, lons, lat, lon):
+    """各点から (lat, lon) までの大円距離（メートル）"""
+    lat_rad = np.radians(lats)
+    center_lat = np.radians(lat)
+    half_dlat = (lat_rad - center_lat) / 2
+    half_dlon = np.radians(lons - lon) / 2
+    a = np.sin(half_dlat) ** 2 + np.cos(lat_rad) * np.cos(center_lat) * np.sin(half_dlon) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def bucket_counts(timestamps_ms, bucket_ms, offset_ms=0):
+    """エポックミリ秒を bucket_ms 幅（offset_ms だけずらした時刻で区切る）で数える
+
+    (区間の開始エポックミリ秒の配列, 件数の配列) を返す。
+    """
+    buckets = (timestamps_ms + offset_ms) // bucket_ms
+    starts, counts = np.unique(buckets, return_counts=True)
+    return starts * bucket_ms - offset_ms, counts
+
+
+def summarize(columns, bucket_ms, offset_ms=0):
+    """スナップショットの列から件数・時間帯別件数・重心・範囲・散らばりを計算する"""
+    lats = columns["latitude"]
+    lons = columns["longitude"]
+    count = int(len(lats))
+    if count == 0:
+        return {"count": 0, "buckets": [], "centroid": None, "bbox": None, "dispersion": None}
+    timestamps = columns["timestamp_ms"]
+    starts, counts = bucket_counts(timestamps[timestamps != MISSING_TIMESTAMP_MS], bucket_ms, offset_ms)
+    center_lat, center_lon = centroid(lats, lons)
+    distances = distances_m(lats, lons, center_lat, center_lon)
+    return {
+        "count": count,
+        "buckets": [{"start_ms": int(start), "count": int(n)} for start, n in zip(starts, counts)],
+        "centroid": {"latitude": center_lat, "longitude": center_lon},
+        "bbox": {
+            "west": float(lons.min()), "south": float(lats.min()),
+            "east": float(lons.max()), "north": float(lats.max()),
+        },
+        "dispersion": {
+            # 重心からの距離の二乗平均平方根（回転半径）と中央値・最大値
+            "radius_of_gyration_m": float(np.sqrt(np.mean(distances ** 2))),
+            "median_distance_m": float(np.median(distances)),
+            "max_distance_m": float(distances.max()),
+            "latitude_std": float(lats.std()),
+            "longitude_std": float(lons.std()),
+        },
+    }
@@ -4,9 +4,33 @@ from httpx import AsyncClient
 from fastapi.testclient import TestClient
 import sqlite3
 import os
+import sys
 import tempfile
+import threading
+import time
+import httpx
+import struct
+import zlib
+import numpy as np
+import contextlib
+import io
+import logging
+import main
+import applog
+import loopwatch
+import benchmark
+import replay
+import metrics
+import geogrid
+import heatmap
+import traffic
 from main import app
+from broadcaster import Broadcaster
+from ingest import IngestQueue, IngestQueueFull
+from snapshot import LocationSnapshot
+from traffic import TrafficCaptureMiddleware, TrafficRecorder
 import json
+from urllib.parse import parse_qsl
 from datetime import datetime, timedelta
 from unittest.mock import patch
 
@@ -19,8 +43,9 @@ TEST_SESSION_ID_2 = "test_session_456"
 
 def create_test_db():
     """テスト用データベースを作成"""
-    if os.path.exists(TEST_DB_PATH):
-        os.remove(TEST_DB_PATH)
+    # 前のテストの接続が残っていると、削除したファイルのWALが新しいDBに書き戻される
+    main.db_pool.close()
+    cleanup_test_db()
     
     conn = sqlite3.connect(TEST_DB_PATH)
     cursor = conn.cursor()
@@ -54,8 +79,18 @@ def create_test_db():
 
 def cleanup_test_db():
     """テスト用データベースをクリーンアップ"""
-    if os.path.exists(TEST_DB_PATH):
-        os.remove(TEST_DB_PATH)
+    for path in (TEST_DB_PATH, TEST_DB_PATH + "-wal", TEST_DB_PATH + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+def reset_app_state():
+    """プール済みの接続などアプリ内の状態を破棄する"""
+    main.db_pool.close()
+    main.session_cache.invalidate()
+    main.config_cache.invalidate()
+    main.locations_cache.invalidate()
+    main.heatmap_tiles.clear()
+    main.location_snapshot.invalidate()
 
 @pytest.fixture(scope="function")
 def test_client():
@@ -64,16 +99,18 @@ def test_client():
     
     # mainモジュール内のすべてのsqlite3.connectを置き換え
     original_connect = sqlite3.connect
-    def mock_connect(db_path):
-        return original_connect(TEST_DB_PATH)
+    def mock_connect(db_path, *args, **kwargs):
+        return original_connect(TEST_DB_PATH, *args, **kwargs)
     
     with patch('main.sqlite3.connect', side_effect=mock_connect):
+        # 接続プールがテスト用DBに接続し直すようにする
+        reset_app_state()
         client = TestClient(app)
         yield client
+        reset_app_state()
     
     # テスト後のクリーンアップ
-    if os.path.exists(TEST_DB_PATH):
-        os.remove(TEST_DB_PATH)
+    cleanup_test_db()
 
 class TestNameCardAPI:
     """名刺API関連のテスト"""
@@ -825,5 +862,1886 @@ class TestCloudflareSecurityFeatures:
             assert response.json()["status"] == "healthy"
 
 
+class TestConnectionPool:
+    """接続プールのテスト"""
+
+    def test_wal_mode_enabled(self, test_client):
+        """書き込み接続でWALジャーナルが有効になっていることを確認"""
+        with main.db_pool.writer() as conn:
+            mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        assert mode == "wal"
+
+    def test_reader_connection_reused(self, test_client):
+        """読み取り接続がリクエスト間で使い回されることを確認"""
+        with main.db_pool.reader() as conn:
+            first = conn
+        with main.db_pool.reader() as conn:
+            second = conn
+        assert first is second
+
+    def test_reader_is_read_only(self, test_client):
+        """読み取り接続では書き込みできないことを確認"""
+        with main.db_pool.reader() as conn:
+            with pytest.raises(sqlite3.OperationalError):
+                conn.execute("DELETE FROM locations")
+
+
+
+class TestNonBlockingDataAccess:
+    """DBアクセスがイベントループを止めないことのテスト"""
+
+    def test_health_latency_flat_during_admin_dump(self, test_client):
+        """大量の管理者向けダンプ中も/api/healthの応答時間が変わらないことを確認"""
+        import time
+        import httpx
+
+        # 大量のデータを投入
+        conn = sqlite3.connect(TEST_DB_PATH)
+        conn.executemany(
+            "INSERT INTO locations (latitude, longitude, timestamp, session_id) VALUES (?, ?, ?, ?)",
+            [(35.0 + i * 1e-5, 139.0 + i * 1e-5, "2025-01-01T12:00:00+09:00", f"s{i}")
+             for i in range(20000)]
+        )
+        conn.commit()
+        conn.close()
+
+        # クエリが遅いケースを再現するためダンプ処理に待ちを加える
+        original_fetch = main.fetch_admin_locations
+        def slow_fetch(*args):
+            time.sleep(0.5)
+            return original_fetch(*args)
+
+        async def scenario():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                dump = asyncio.create_task(
+                    client.get("/api/admin/locations", params={"admin_password": "admin123"})
+                )
+                latencies = []
+                while not dump.done():
+                    start = time.perf_counter()
+                    response = await client.get("/api/health")
+                    latencies.append(time.perf_counter() - start)
+                    assert response.status_code == 200
+                    await asyncio.sleep(0.01)
+                return await dump, latencies
+
+        with patch('main.fetch_admin_locations', side_effect=slow_fetch):
+            dump_response, latencies = asyncio.run(scenario())
+
+        assert dump_response.status_code == 200
+        assert len(dump_response.json()) == 20000
+        # ダンプ中もヘルスチェックが繰り返し応答できていること
+        assert len(latencies) >= 10
+        assert max(latencies) < 0.2
+
+
+class TestRecordingSessionCache:
+    """記録セッションキャッシュのテスト"""
+
+    def test_status_served_from_cache(self, test_client):
+        """キャッシュ済みのセッション状態はDBを読まずに返されることを確認"""
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Cached"},
+                         params={"admin_password": "admin123"})
+
+        with patch.object(main.db_pool, 'reader', side_effect=AssertionError("DB read")):
+            response = test_client.get("/api/recording-status")
+        assert response.status_code == 200
+        assert response.json()["enabled"] == True
+        assert response.json()["description"] == "Cached"
+
+    def test_expiry_evaluated_in_memory(self, test_client):
+        """期限切れのセッションはメモリ上の判定で無効になることを確認"""
+        expires_at = (main.get_jst_now() - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%S')
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": expires_at, "description": "Expired"},
+                         params={"admin_password": "admin123"})
+
+        cached = main.session_cache.get()
+        assert cached["expires_dt"].tzinfo is not None
+
+        response = test_client.get("/api/recording-status")
+        assert response.json()["enabled"] == False
+        assert response.json()["expires_at"] == expires_at
+
+
+
+class TestSessionExpiryScheduler:
+    """記録セッションの期限切れスケジューラのテスト"""
+
+    def test_parse_expires_at_formats(self):
+        """expires_atの各形式がJSTとして解釈されることを確認"""
+        expected = main.JST.localize(datetime(2025, 1, 2, 3, 4, 5))
+        assert main.parse_expires_at("2025-01-02T03:04:05") == expected
+        assert main.parse_expires_at("2025-01-02 03:04:05.123Z") == expected
+        assert main.parse_expires_at("2025-01-02T03:04") == expected.replace(second=0)
+        assert main.parse_expires_at("not a date") is None
+        assert main.parse_expires_at(None) is None
+
+    def test_status_read_does_not_write(self, test_client):
+        """期限切れでも状態確認のリクエストでDBに書き込まないことを確認"""
+        expires_at = (main.get_jst_now() - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%S')
+        main.update_recording_session(True, expires_at, "Expired")
+
+        with patch.object(main.db_pool, 'writer', side_effect=AssertionError("DB write")):
+            response = test_client.get("/api/recording-status")
+        assert response.json()["enabled"] == False
+
+    def test_scheduler_expires_session(self, test_client):
+        """期限になるとスケジューラがセッションを無効化することを確認"""
+        async def scenario():
+            await main.session_scheduler.start()
+            try:
+                expires_at = (main.get_jst_now() + timedelta(seconds=1)).strftime('%Y-%m-%dT%H:%M:%S')
+                await main.run_blocking(main.update_recording_session, True, expires_at, "Timer")
+                main.session_scheduler.rearm()
+                await asyncio.sleep(1.5)
+            finally:
+                await main.session_scheduler.stop()
+
+        asyncio.run(scenario())
+
+        assert main.session_cache.get()["enabled"] == False
+        conn = sqlite3.connect(TEST_DB_PATH)
+        enabled = conn.execute("SELECT enabled FROM recording_sessions WHERE id = 1").fetchone()[0]
+        conn.close()
+        assert enabled == 0
+
+    def test_scheduler_rearmed_by_new_session(self, test_client):
+        """セッションが延長された場合は古い期限で無効化しないことを確認"""
+        async def scenario():
+            await main.session_scheduler.start()
+            try:
+                soon = (main.get_jst_now() + timedelta(seconds=1)).strftime('%Y-%m-%dT%H:%M:%S')
+                await main.run_blocking(main.update_recording_session, True, soon, "Short")
+                main.session_scheduler.rearm()
+                later = (main.get_jst_now() + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S')
+                await main.run_blocking(main.update_recording_session, True, later, "Extended")
+                main.session_scheduler.rearm()
+                await asyncio.sleep(1.5)
+            finally:
+                await main.session_scheduler.stop()
+
+        asyncio.run(scenario())
+        assert main.session_cache.get()["enabled"] == True
+
+    def test_missing_row_is_read_without_writing(self, test_client):
+        """セッション行がない場合、状態の確認では行を作らず無効として返すことを確認"""
+        with main.db_pool.writer() as conn:
+            conn.execute("DELETE FROM recording_sessions")
+        main.session_cache.invalidate()
+        with patch.object(main.db_pool, "writer", side_effect=AssertionError("write on read")):
+            response = test_client.get("/api/recording-status")
+        assert response.status_code == 200
+        assert response.json()["enabled"] == False
+        with main.db_pool.reader() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM recording_sessions").fetchone()[0] == 0
+
+        # 管理画面からの更新で行が作り直される
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Recreated"},
+                         params={"admin_password": "admin123"})
+        main.session_cache.invalidate()
+        assert test_client.get("/api/recording-status").json()["enabled"] == True
+
+    def test_scheduler_reloads_row_changed_behind_cache(self, test_client):
+        """DBの行が直接変更されていた場合はキャッシュを読み直し、書き込みを繰り返さないことを確認"""
+        past = (main.get_jst_now() - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%S')
+        later = (main.get_jst_now() + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%S')
+        main.update_recording_session(True, past, "Cached")
+        conn = sqlite3.connect(TEST_DB_PATH)
+        conn.execute("UPDATE recording_sessions SET expires_at = ?, description = ? WHERE id = 1",
+                     (later, "Changed"))
+        conn.commit()
+        conn.close()
+
+        calls = []
+        original = main.expire_recording_session
+
+        def counting(expires_at):
+            calls.append(expires_at)
+            return original(expires_at)
+
+        async def scenario():
+            await main.session_scheduler.start()
+            try:
+                await asyncio.sleep(0.5)
+            finally:
+                await main.session_scheduler.stop()
+
+        with patch.object(main, "expire_recording_session", side_effect=counting):
+            asyncio.run(scenario())
+
+        assert calls == [past]
+        state = main.session_cache.get()
+        assert state["enabled"] == True
+        assert state["expires_at"] == later
+        assert state["description"] == "Changed"
+
+    def test_scheduler_backs_off_when_expiry_does_not_apply(self, test_client):
+        """期限切れを反映できない状態が続いても、すぐに再試行しないことを確認"""
+        past = (main.get_jst_now() - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%S')
+        main.update_recording_session(True, past, "Stuck")
+        calls = []
+
+        async def scenario():
+            await main.session_scheduler.start()
+            try:
+                await asyncio.sleep(0.5)
+            finally:
+                await main.session_scheduler.stop()
+
+        with patch.object(main, "expire_recording_session", side_effect=lambda e: calls.append(e) or 0):
+            asyncio.run(scenario())
+        assert len(calls) == 1
+
+
+
+class TestConfigCache:
+    """設定ファイルキャッシュのテスト"""
+
+    @pytest.fixture
+    def config_file(self, tmp_path):
+        path = tmp_path / "config.json"
+        path.write_text(json.dumps({
+            "personalInfo": {"name": "Cached Name", "title": " "},
+            "socialLinks": [{"url": "https://example.com", "enabled": True},
+                            {"url": "https://hidden.example.com", "enabled": False}],
+            "design": {"primaryColor": "#000000"}
+        }), encoding="utf-8")
+        with patch('main.CONFIG_FILE', str(path)):
+            main.config_cache.invalidate()
+            yield path
+        main.config_cache.invalidate()
+
+    def test_card_info_served_from_cache(self, test_client, config_file):
+        """2回目以降の名刺情報取得で設定ファイルを読まないことを確認"""
+        first = test_client.get("/api/card-info")
+        assert first.status_code == 200
+        assert first.json()["personalInfo"] == {"name": "Cached Name"}
+        assert len(first.json()["socialLinks"]) == 1
+
+        with patch('main.load_config', side_effect=AssertionError("config read")):
+            second = test_client.get("/api/card-info")
+        assert second.status_code == 200
+        assert second.content == first.content
+
+    def test_cache_invalidated_by_save(self, test_client, config_file):
+        """管理画面から設定を保存するとキャッシュが更新されることを確認"""
+        test_client.get("/api/card-info")
+        response = test_client.put("/api/admin/config",
+                                   json={"personalInfo": {"name": "Updated"},
+                                         "socialLinks": [], "design": {}},
+                                   params={"admin_password": "admin123"})
+        assert response.status_code == 200
+
+        data = test_client.get("/api/card-info").json()
+        assert data["personalInfo"] == {"name": "Updated"}
+
+    def test_cache_reloaded_on_file_change(self, test_client, config_file):
+        """設定ファイルが外部で書き換えられた場合に読み直すことを確認"""
+        test_client.get("/api/card-info")
+        config_file.write_text(json.dumps({
+            "personalInfo": {"name": "Mounted"}, "socialLinks": [], "design": {}
+        }), encoding="utf-8")
+        stat = os.stat(config_file)
+        os.utime(config_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        with patch('main.CONFIG_CHECK_INTERVAL', 0):
+            data = test_client.get("/api/card-info").json()
+        assert data["personalInfo"] == {"name": "Mounted"}
+
+    def test_etag_taken_with_body(self, test_client, config_file):
+        """ETag が返した本文と同じエントリから取られ、別の読み直しでカウンタが進んでも変わらないことを確認"""
+        first = test_client.get("/api/card-info")
+        # 別スレッドの読み直しが本文を差し替える前にカウンタだけ進めた状態
+        main.resource_versions.bump("card-info")
+        second = test_client.get("/api/card-info")
+        assert second.content == first.content
+        assert second.headers["etag"] == first.headers["etag"]
+        assert test_client.get("/api/card-info",
+                               headers={"If-None-Match": first.headers["etag"]}).status_code == 304
+
+        test_client.put("/api/admin/config",
+                        json={"personalInfo": {"name": "Updated"}, "socialLinks": [], "design": {}},
+                        params={"admin_password": "admin123"})
+        third = test_client.get("/api/card-info")
+        assert third.json()["personalInfo"] == {"name": "Updated"}
+        assert third.headers["etag"] != first.headers["etag"]
+
+
+
+class TestConditionalGet:
+    """ETag / 304 による条件付きGETのテスト"""
+
+    def test_locations_not_modified(self, test_client):
+        """位置情報が変わっていなければ304をDBアクセスなしで返すことを確認"""
+        first = test_client.get("/api/locations")
+        etag = first.headers["etag"]
+        assert "last-modified" in first.headers
+
+        with patch('main.fetch_locations', side_effect=AssertionError("DB scan")):
+            second = test_client.get("/api/locations", headers={"If-None-Match": etag})
+        assert second.status_code == 304
+        assert second.headers["etag"] == etag
+
+    def test_locations_etag_changes_after_insert(self, test_client):
+        """位置情報の追加でETagが変わることを確認"""
+        etag = test_client.get("/api/locations").headers["etag"]
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "ETag"},
+                         params={"admin_password": "admin123"})
+        test_client.post("/api/record-location", json={"latitude": 35.0, "longitude": 139.0})
+
+        response = test_client.get("/api/locations", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+        assert len(response.json()) == 1
+
+    def test_recording_status_etag(self, test_client):
+        """記録状態が変わるまで304、変わったら200を返すことを確認"""
+        etag = test_client.get("/api/recording-status").headers["etag"]
+        assert test_client.get("/api/recording-status",
+                               headers={"If-None-Match": etag}).status_code == 304
+
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "ETag"},
+                         params={"admin_password": "admin123"})
+        response = test_client.get("/api/recording-status", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.json()["enabled"] == True
+
+    def test_card_info_if_modified_since(self, test_client):
+        """Last-Modified を使った条件付きGETに対応していることを確認"""
+        first = test_client.get("/api/card-info")
+        response = test_client.get("/api/card-info",
+                                   headers={"If-Modified-Since": first.headers["last-modified"]})
+        assert response.status_code == 304
+
+
+
+class TestLocationsResponseCache:
+    """位置情報レスポンスキャッシュのテスト"""
+
+    def _record(self, test_client, count):
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Cache"},
+                         params={"admin_password": "admin123"})
+        for i in range(count):
+            test_client.post("/api/record-location",
+                             json={"latitude": 35.0 + i * 0.001, "longitude": 139.0,
+                                   "session_id": f"cache_{i}"})
+
+    def test_unchanged_dataset_served_from_memory(self, test_client):
+        """データが変わらない間はDBを読まずにキャッシュを返すことを確認"""
+        self._record(test_client, 2)
+        first = test_client.get("/api/locations")
+        assert len(first.json()) == 2
+
+        with patch('main.fetch_locations', side_effect=AssertionError("DB scan")):
+            second = test_client.get("/api/locations")
+        assert second.content == first.content
+
+    def test_cache_refreshed_after_delete(self, test_client):
+        """削除で世代番号が進みキャッシュが作り直されることを確認"""
+        self._record(test_client, 2)
+        locations = test_client.get("/api/admin/locations", params={"admin_password": "admin123"}).json()
+        test_client.get("/api/locations")
+
+        test_client.delete(f"/api/admin/locations/{locations[0]['id']}",
+                           params={"admin_password": "admin123"})
+        assert len(test_client.get("/api/locations").json()) == 1
+
+    def test_gzip_variant(self, test_client):
+        """gzipを受け付けるクライアントには圧縮版を返すことを確認"""
+        self._record(test_client, 30)
+        plain = test_client.get("/api/locations", headers={"Accept-Encoding": "identity"})
+        compressed = test_client.get("/api/locations", headers={"Accept-Encoding": "gzip"})
+
+        assert "content-encoding" not in plain.headers
+        assert compressed.headers["content-encoding"] == "gzip"
+        assert compressed.headers["etag"] != plain.headers["etag"]
+        assert compressed.json() == plain.json()
+
+
+
+class TestLocationDeltaCursor:
+    """位置情報の差分取得（since カーソル）のテスト"""
+
+    def _record(self, test_client, session_id):
+        return test_client.post("/api/record-location",
+                                json={"latitude": 35.0, "longitude": 139.0,
+                                      "session_id": session_id}).json()["id"]
+
+    def test_delta_returns_inserts_and_tombstones(self, test_client):
+        """カーソル以降の追加と削除だけが返されることを確認"""
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Delta"},
+                         params={"admin_password": "admin123"})
+        first_id = self._record(test_client, "delta_1")
+
+        snapshot = test_client.get("/api/locations", params={"since": 0}).json()
+        assert snapshot["reset"] == True
+        assert [loc["id"] for loc in snapshot["locations"]] == [first_id]
+
+        second_id = self._record(test_client, "delta_2")
+        test_client.delete(f"/api/locations/{first_id}", headers={"X-Session-Id": "delta_1"})
+
+        delta = test_client.get("/api/locations", params={"since": snapshot["cursor"]}).json()
+        assert delta["reset"] == False
+        assert [loc["id"] for loc in delta["locations"]] == [second_id]
+        assert delta["deleted"] == [first_id]
+        assert delta["cursor"] > snapshot["cursor"]
+
+        # 変更がなければ空の差分が返る
+        empty = test_client.get("/api/locations", params={"since": delta["cursor"]}).json()
+        assert empty["locations"] == [] and empty["deleted"] == []
+        assert empty["cursor"] == delta["cursor"]
+
+    def test_unknown_cursor_resets(self, test_client):
+        """未来のカーソルを渡すと全件が返されることを確認"""
+        response = test_client.get("/api/locations", params={"since": 999})
+        assert response.status_code == 200
+        assert response.json()["reset"] == True
+
+
+
+class TestEventStream:
+    """ライブ更新（SSE）のテスト"""
+
+    def test_broadcast_fans_out_and_evicts_slow_consumer(self):
+        """全クライアントに配信し、溢れたクライアントだけ切断することを確認"""
+        async def scenario():
+            broadcaster = Broadcaster(queue_size=2)
+            broadcaster.attach(asyncio.get_running_loop())
+            fast = broadcaster.subscribe()
+            slow = broadcaster.subscribe()
+
+            broadcaster.publish("location", {"id": 1}, event_id=1)
+            assert b'"id":1' in await fast.queue.get()
+            broadcaster.publish("location", {"id": 2}, event_id=2)
+            assert b'"id":2' in await fast.queue.get()
+            # slow は読み出していないので3件目で溢れる
+            broadcaster.publish("location", {"id": 3}, event_id=3)
+
+            assert slow.evicted
+            assert await slow.queue.get() is None
+            assert not fast.evicted
+            assert broadcaster.subscriber_count == 1
+
+        asyncio.run(scenario())
+
+    def test_stream_pushes_recorded_location(self, test_client):
+        """記録された位置情報がストリームに流れることを確認"""
+        async def scenario():
+            main.broadcaster.attach(asyncio.get_running_loop())
+            subscription = main.broadcaster.subscribe()
+            stream = main.event_stream(subscription)
+            try:
+                first = await stream.__anext__()
+                assert first.startswith(b"event: session")
+
+                await main.run_blocking(main.update_recording_session, True, None, "SSE")
+                session_event = await asyncio.wait_for(stream.__anext__(), timeout=2)
+                assert b'"enabled":true' in session_event
+
+                location = main.LocationRecord(latitude=35.0, longitude=139.0, session_id="sse_1")
+                location_id = await main.run_blocking(main.insert_location, location)
+                location_event = await asyncio.wait_for(stream.__anext__(), timeout=2)
+                assert location_event.startswith(b"id: ")
+                assert b"event: location\n" in location_event
+                assert f'"id":{location_id}'.encode() in location_event
+            finally:
+                await stream.aclose()
+                main.broadcaster.detach()
+            assert main.broadcaster.subscriber_count == 0
+
+        asyncio.run(scenario())
+
+
+
+class TestBatchIngest:
+    """位置情報の一括記録のテスト"""
+
+    def _enable(self, test_client):
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Batch"},
+                         params={"admin_password": "admin123"})
+
+    def test_batch_reports_per_item_results(self, test_client):
+        """要素ごとに accepted / duplicate_session / invalid が返されることを確認"""
+        self._enable(test_client)
+        test_client.post("/api/record-location",
+                         json={"latitude": 35.0, "longitude": 139.0, "session_id": "already"})
+
+        response = test_client.post("/api/record-locations", json={"locations": [
+            {"latitude": 35.1, "longitude": 139.1, "session_id": "batch_1"},
+            {"latitude": 35.2, "longitude": 139.2, "session_id": "already"},
+            {"latitude": 135.0, "longitude": 139.3},
+            {"latitude": 35.4, "longitude": 139.4, "session_id": "batch_1"},
+            {"latitude": 35.5, "longitude": 139.5},
+        ]})
+        assert response.status_code == 200
+        data = response.json()
+        statuses = [result["status"] for result in data["results"]]
+        assert statuses == ["accepted", "duplicate_session", "invalid", "duplicate_session", "accepted"]
+        assert data["accepted"] == 2
+
+        # 返されたIDで実際に記録されていることを確認
+        locations = {loc["id"]: loc for loc in test_client.get("/api/locations").json()}
+        assert locations[data["results"][0]["id"]]["session_id"] == "batch_1"
+        assert locations[data["results"][4]["id"]]["latitude"] == 35.5
+        assert len(locations) == 3
+
+    def test_batch_rejected_when_disabled(self, test_client):
+        """記録が無効の場合はバッチ全体が403になることを確認"""
+        response = test_client.post("/api/record-locations",
+                                    json={"locations": [{"latitude": 35.0, "longitude": 139.0}]})
+        assert response.status_code == 403
+
+    def test_batch_size_limit(self, test_client):
+        """上限を超えるバッチは拒否されることを確認"""
+        self._enable(test_client)
+        with patch('main.MAX_BATCH_SIZE', 2):
+            response = test_client.post("/api/record-locations", json={"locations": [
+                {"latitude": 35.0, "longitude": 139.0}] * 3})
+        assert response.status_code == 413
+
+
+class TestIngestQueue:
+    """書き込みキュー（グループコミット）のテスト"""
+
+    def _enable(self, test_client):
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Ingest"},
+                         params={"admin_password": "admin123"})
+
+    def test_concurrent_records_share_one_commit(self, test_client):
+        """同時に届いた記録が1回のコミットにまとめられることを確認"""
+        calls = []
+
+        def writer(items):
+            calls.append(len(items))
+            return main.insert_locations_batch(items)
+
+        async def scenario():
+            queue = IngestQueue(writer, durability="commit", max_batch=100, max_delay_ms=50)
+            await queue.start()
+            try:
+                records = [main.LocationRecord(latitude=35.0 + i / 100, longitude=139.0,
+                                               session_id=f"group_{i}") for i in range(20)]
+                records.append(main.LocationRecord(latitude=35.0, longitude=139.0, session_id="group_0"))
+                return await asyncio.gather(*(queue.submit(record) for record in records))
+            finally:
+                await queue.stop()
+
+        results = asyncio.run(scenario())
+        assert calls == [21]
+        ids = [location_id for status_name, location_id in results[:20]]
+        assert all(status_name == "accepted" for status_name, _ in results[:20])
+        assert len(set(ids)) == 20
+        assert results[20] == ("duplicate_session", None)
+
+    def test_conflicting_row_does_not_fail_batch(self, test_client):
+        """別のプロセスが先に書いたセッションIDがあっても、その行だけが重複になることを確認"""
+        main.init_db()
+        other = sqlite3.connect(main.DB_PATH)
+        try:
+            other.execute("INSERT INTO locations (latitude, longitude, timestamp, session_id) "
+                          "VALUES (35.5, 139.5, '2024-05-01T12:00:00+09:00', 'taken')")
+            other.commit()
+        finally:
+            other.close()
+
+        records = [main.LocationRecord(latitude=35.0, longitude=139.0, session_id="fresh_1"),
+                   main.LocationRecord(latitude=35.1, longitude=139.1, session_id="taken"),
+                   main.LocationRecord(latitude=35.2, longitude=139.2, session_id="fresh_2")]
+        results = main.insert_locations_batch(records)
+        assert [status_name for status_name, _ in results] == ["accepted", "duplicate_session", "accepted"]
+        with main.db_pool.reader() as conn:
+            rows = dict(conn.execute("SELECT id, session_id FROM locations").fetchall())
+            changes = [row[0] for row in conn.execute("SELECT location_id FROM location_changes")]
+        assert rows[results[0][1]] == "fresh_1" and rows[results[2][1]] == "fresh_2"
+        assert changes == [results[0][1], results[2][1]]
+        assert main.location_snapshot.columns()["id"].tolist() == sorted(rows)
+
+    def test_enqueue_mode_flushes_on_stop(self, test_client):
+        """enqueue モードでは即座に応答し、停止時に残りが書き込まれることを確認"""
+        async def scenario():
+            queue = IngestQueue(main.insert_locations_batch, durability="enqueue", max_delay_ms=1000)
+            await queue.start()
+            for i in range(5):
+                assert await queue.submit(main.LocationRecord(latitude=35.0, longitude=139.0 + i / 100)) is None
+            await queue.stop()
+
+        asyncio.run(scenario())
+        assert len(test_client.get("/api/locations").json()) == 5
+
+    def test_full_queue_applies_backpressure(self):
+        """キューが一杯のときは IngestQueueFull になることを確認"""
+        release = threading.Event()
+
+        def writer(items):
+            release.wait(5)
+            return [("accepted", 1)] * len(items)
+
+        async def scenario():
+            queue = IngestQueue(writer, durability="enqueue", queue_size=1, max_batch=1,
+                                max_delay_ms=0, enqueue_timeout=0.05)
+            await queue.start()
+            try:
+                await queue.submit("first")
+                await asyncio.sleep(0.05)  # ワーカーが1件目を取り出して書き込み中になる
+                await queue.submit("second")
+                with pytest.raises(IngestQueueFull):
+                    await queue.submit("third")
+            finally:
+                release.set()
+                await queue.stop()
+
+        asyncio.run(scenario())
+
+    def test_stop_drains_waiting_submitters(self):
+        """空きを待っている送信元がいる間に止めても、停止が詰まらず全件が書き込まれることを確認"""
+        release = threading.Event()
+
+        def writer(items):
+            release.wait(5)
+            return [("accepted", item) for item in items]
+
+        async def scenario():
+            queue = IngestQueue(writer, durability="commit", queue_size=1, max_batch=1,
+                                max_delay_ms=0, enqueue_timeout=5)
+            await queue.start()
+            first = asyncio.create_task(queue.submit("first"))
+            await asyncio.sleep(0.05)  # ワーカーが1件目を取り出して書き込み中になる
+            second = asyncio.create_task(queue.submit("second"))
+            await asyncio.sleep(0.01)
+            third = asyncio.create_task(queue.submit("third"))
+            await asyncio.sleep(0.01)
+            stopping = asyncio.create_task(queue.stop())
+            await asyncio.sleep(0.01)
+            release.set()
+            await asyncio.wait_for(stopping, timeout=2)
+            return await asyncio.wait_for(asyncio.gather(first, second, third, return_exceptions=True),
+                                          timeout=2)
+
+        assert asyncio.run(scenario()) == [("accepted", "first"), ("accepted", "second"), ("accepted", "third")]
+
+    def test_stop_rejects_entries_left_behind(self):
+        """ワーカーの終了後にキューへ入った記録の送信元が、待ち続けずに IngestQueueFull になることを確認"""
+        async def scenario():
+            queue = IngestQueue(lambda items: [("accepted", item) for item in items],
+                                durability="commit", queue_size=2, enqueue_timeout=1)
+            await queue.start()
+            await queue.stop()
+            # 受付中の確認を通ったあと、キューへ入る前に停止が終わった送信元を再現する
+            queue._accepting = True
+            with pytest.raises(IngestQueueFull):
+                await asyncio.wait_for(queue.submit("late"), timeout=2)
+            assert queue._queue.empty()
+
+        asyncio.run(scenario())
+
+    def test_record_location_through_queue(self, test_client):
+        """キュー経由の記録でもIDと409が返されることを確認"""
+        self._enable(test_client)
+
+        async def scenario():
+            await main.ingest_queue.start()
+            try:
+                transport = httpx.ASGITransport(app=app)
+                async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                    payload = {"latitude": 35.0, "longitude": 139.0, "session_id": "queued"}
+                    first = await client.post("/api/record-location", json=payload)
+                    second = await client.post("/api/record-location", json=payload)
+                    return first, second
+            finally:
+                await main.ingest_queue.stop()
+
+        first, second = asyncio.run(scenario())
+        assert first.status_code == 200
+        assert isinstance(first.json()["id"], int)
+        assert second.status_code == 409
+
+
+class TestLocationIndexes:
+    """インデックスと1人1記録の制約のテスト"""
+
+    def _insert_duplicates(self):
+        conn = sqlite3.connect(TEST_DB_PATH)
+        conn.executemany(
+            "INSERT INTO locations (latitude, longitude, timestamp, session_id) VALUES (?, ?, ?, ?)",
+            [(35.0, 139.0, "2025-01-01T12:00:00+09:00", "dup"),
+             (35.1, 139.1, "2025-01-01T12:01:00+09:00", "dup"),
+             (35.2, 139.2, "2025-01-01T12:02:00+09:00", ""),
+             (35.3, 139.3, "2025-01-01T12:03:00+09:00", ""),
+             (35.4, 139.4, "2025-01-01T12:04:00+09:00", None)])
+        conn.commit()
+        conn.close()
+
+    def test_migration_stops_on_duplicates_without_opt_in(self, test_client):
+        """重複記録がある場合は、指定がなければ記録を示して移行を止め、何も削除しないことを確認"""
+        self._insert_duplicates()
+        with pytest.raises(RuntimeError) as excinfo:
+            main.init_db()
+        message = str(excinfo.value)
+        assert "id=2 session_id='dup'" in message
+        assert "MIGRATE_ARCHIVE_DUPLICATE_SESSIONS" in message
+
+        conn = sqlite3.connect(TEST_DB_PATH)
+        count = conn.execute("SELECT COUNT(*) FROM locations").fetchone()[0]
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        conn.close()
+        assert count == 5
+        assert version == 0
+
+    def test_migration_removes_duplicates_and_adds_indexes(self, test_client):
+        """指定した場合は既存DBの重複記録を退避・削除してからインデックスを作成することを確認"""
+        self._insert_duplicates()
+        with patch.object(main, "MIGRATE_ARCHIVE_DUPLICATE_SESSIONS", True):
+            main.init_db()
+
+        with main.db_pool.reader() as conn:
+            rows = conn.execute("SELECT id, session_id FROM locations ORDER BY id").fetchall()
+            indexes = {row[1] for row in conn.execute("PRAGMA index_list(locations)")}
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            plan = " ".join(row[3] for row in conn.execute(
+                "EXPLAIN QUERY PLAN " + main.SQL_SELECT_LOCATIONS))
+        # セッションIDごとに最初の1件だけが残り、空文字・NULLは対象外
+        assert [session_id for _, session_id in rows] == ["dup", "", "", None]
+        assert rows[0][0] == 1
+        assert {"idx_locations_timestamp_ms", "idx_locations_session_id",
+                "idx_locations_session_unique"} <= indexes
+        assert version == main.SCHEMA_VERSION
+        assert "USE TEMP B-TREE" not in plan
+        # 削除は差分取得のクライアントにも伝わるよう変更履歴に残る
+        with main.db_pool.reader() as conn:
+            changes = conn.execute("SELECT location_id, op FROM location_changes").fetchall()
+        assert changes == [(2, "delete")]
+        # 削除した記録は退避テーブルに残る
+        with main.db_pool.reader() as conn:
+            archived = conn.execute(
+                "SELECT id, latitude, session_id FROM locations_duplicate_archive").fetchall()
+        assert archived == [(2, 35.1, "dup")]
+
+    def test_duplicate_session_rejected_by_unique_index(self, test_client):
+        """同じセッションIDの2件目はINSERTの制約違反として409になることを確認"""
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Unique"},
+                         params={"admin_password": "admin123"})
+        payload = {"latitude": 35.0, "longitude": 139.0, "session_id": "unique_1"}
+        assert test_client.post("/api/record-location", json=payload).status_code == 200
+        response = test_client.post("/api/record-location", json=payload)
+        assert response.status_code == 409
+        assert response.json()["detail"] == "既に位置情報を記録済みです"
+
+        with main.db_pool.writer() as conn:
+            with pytest.raises(sqlite3.IntegrityError):
+                conn.execute("INSERT INTO locations (latitude, longitude, session_id) VALUES (1, 1, 'unique_1')")
+
+
+class TestEpochTimestamps:
+    """エポックミリ秒のタイムスタンプのテスト"""
+
+    def _insert_legacy_rows(self, count):
+        """移行前（timestamp_ms 未設定）の行を作る"""
+        main.init_db()
+        with main.db_pool.writer() as conn:
+            conn.executemany(
+                "INSERT INTO locations (latitude, longitude, timestamp, session_id) VALUES (?, ?, ?, ?)",
+                [(35.0, 139.0, f"2025-01-01T12:00:{i:02d}+09:00", f"legacy_{i}") for i in range(count)])
+            conn.execute("UPDATE locations SET timestamp_ms = NULL")
+
+    def test_trigger_fills_epoch_for_direct_insert(self, test_client):
+        """timestamp_ms を指定しない書き込みでもトリガーで値が入ることを確認"""
+        main.init_db()
+        with main.db_pool.writer() as conn:
+            conn.execute("INSERT INTO locations (latitude, longitude, timestamp) VALUES "
+                         "(35.0, 139.0, '2025-01-01T12:00:00.250+09:00')")
+            conn.execute("INSERT INTO locations (latitude, longitude, timestamp) VALUES "
+                         "(35.0, 139.0, '2025-01-01 03:00:00')")
+        with main.db_pool.reader() as conn:
+            values = [row[0] for row in conn.execute("SELECT timestamp_ms FROM locations ORDER BY id")]
+        assert values == [1735700400250, 1735700400000]
+
+    def test_backfill_in_chunks(self, test_client):
+        """既存行が指定件数ずつ埋められ、埋め戻しの前後で出力が変わらないことを確認"""
+        self._insert_legacy_rows(5)
+        before = test_client.get("/api/locations").json()
+
+        assert main.backfill_timestamp_ms_chunk(limit=2) == 2
+        asyncio.run(main.backfill_timestamps())
+        with main.db_pool.reader() as conn:
+            remaining = conn.execute("SELECT COUNT(*) FROM locations WHERE timestamp_ms IS NULL").fetchone()[0]
+        assert remaining == 0
+
+        main.locations_cache.invalidate()
+        after = test_client.get("/api/locations").json()
+        assert before == after
+        assert after[0]["timestamp"] == "2025-01-01T12:00:04+09:00"
+
+    def test_epoch_mode_negotiated_by_accept(self, test_client):
+        """Accept で指定したときだけタイムスタンプがエポックミリ秒になることを確認"""
+        self._insert_legacy_rows(2)
+        response = test_client.get("/api/locations", headers={"Accept": main.EPOCH_MEDIA_TYPE})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith(main.EPOCH_MEDIA_TYPE)
+        assert "Accept" in response.headers["vary"]
+        assert [loc["timestamp"] for loc in response.json()] == [1735700401000, 1735700400000]
+
+        iso = test_client.get("/api/locations")
+        assert iso.json()[0]["timestamp"] == "2025-01-01T12:00:01+09:00"
+        assert iso.headers["etag"] != response.headers["etag"]
+
+        admin = test_client.get("/api/admin/locations", params={"admin_password": "admin123"},
+                                headers={"Accept": main.EPOCH_MEDIA_TYPE})
+        assert admin.json()[0]["timestamp"] == 1735700401000
+
+    def test_format_timestamp_ms(self):
+        """JSTのISO形式に整形されることを確認"""
+        assert main.format_timestamp_ms(1735700400000) == "2025-01-01T12:00:00+09:00"
+        assert main.format_timestamp_ms(1735700400123) == "2025-01-01T12:00:00.123+09:00"
+
+
+class TestLocationPagination:
+    """キーセット方式のページ取得と件数カウンタのテスト"""
+
+    def _insert_rows(self, count, same_timestamp=False):
+        conn = sqlite3.connect(TEST_DB_PATH)
+        conn.executemany(
+            "INSERT INTO locations (latitude, longitude, timestamp, session_id) VALUES (?, ?, ?, ?)",
+            [(35.0 + i / 1000, 139.0, "2025-01-01T12:00:00+09:00" if same_timestamp
+              else f"2025-01-01T12:{i // 60:02d}:{i % 60:02d}+09:00", f"page_{i}")
+             for i in range(count)])
+        conn.commit()
+        conn.close()
+
+    def _collect(self, client, url, limit, **params):
+        ids, cursor, pages = [], None, 0
+        while True:
+            query = dict(params, limit=limit)
+            if cursor:
+                query["cursor"] = cursor
+            data = client.get(url, params=query).json()
+            ids += [loc["id"] for loc in data["locations"]]
+            pages += 1
+            cursor = data["next_cursor"]
+            if cursor is None:
+                return ids, pages
+
+    def test_pages_cover_all_rows_in_order(self, test_client):
+        """全ページを辿ると全件が一覧と同じ順序で重複なく得られることを確認"""
+        self._insert_rows(25)
+        expected = [loc["id"] for loc in test_client.get("/api/locations").json()]
+        ids, pages = self._collect(test_client, "/api/locations", 10)
+        assert ids == expected
+        assert pages == 3
+
+        admin_ids, _ = self._collect(test_client, "/api/admin/locations", 7, admin_password="admin123")
+        assert admin_ids == expected
+
+    def test_ties_on_timestamp_are_stable(self, test_client):
+        """同じ時刻の記録も id で順序が決まり、ページをまたいで欠けないことを確認"""
+        self._insert_rows(12, same_timestamp=True)
+        ids, _ = self._collect(test_client, "/api/locations", 5)
+        assert ids == sorted(ids, reverse=True)
+        assert len(ids) == 12
+
+    def test_rows_without_epoch_are_paged_last(self, test_client):
+        """埋め戻し前（timestamp_ms 未設定）の行も末尾のページで返されることを確認"""
+        self._insert_rows(6)
+        main.init_db()
+        with main.db_pool.writer() as conn:
+            conn.execute("UPDATE locations SET timestamp_ms = NULL WHERE id <= 3")
+        ids, _ = self._collect(test_client, "/api/locations", 2)
+        assert ids == [6, 5, 4, 3, 2, 1]
+
+    def test_invalid_cursor_and_limit(self, test_client):
+        """不正なカーソルや件数は400になることを確認"""
+        assert test_client.get("/api/locations", params={"cursor": "not-a-cursor!"}).status_code == 400
+        assert test_client.get("/api/locations", params={"limit": 0}).status_code == 400
+        assert test_client.get("/api/locations",
+                               params={"limit": main.LOCATIONS_PAGE_SIZE_MAX + 1}).status_code == 400
+
+    def test_count_follows_inserts_and_deletes(self, test_client):
+        """件数カウンタが既存行・追加・削除に追従することを確認"""
+        self._insert_rows(4)
+        assert test_client.get("/api/locations/count").json() == {"count": 4}
+
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Count"},
+                         params={"admin_password": "admin123"})
+        test_client.post("/api/record-location", json={"latitude": 35.0, "longitude": 139.0})
+        test_client.delete("/api/admin/locations/1", params={"admin_password": "admin123"})
+        assert test_client.get("/api/locations/count").json() == {"count": 4}
+
+
+class TestLocationExport:
+    """管理者向けエクスポートのテスト"""
+
+    def _insert_rows(self, count):
+        conn = sqlite3.connect(TEST_DB_PATH)
+        conn.executemany(
+            "INSERT INTO locations (latitude, longitude, timestamp, session_id, user_agent) VALUES (?, ?, ?, ?, ?)",
+            [(35.0 + i / 1000, 139.0, f"2025-01-01T12:00:{i:02d}+09:00", f"export_{i}", 'Agent "quoted", x')
+             for i in range(count)])
+        conn.commit()
+        conn.close()
+
+    def test_csv_export_streams_all_pages(self, test_client):
+        """ページをまたいで全件がCSVで出力されることを確認"""
+        import csv
+        import io
+        self._insert_rows(7)
+        with patch('main.EXPORT_PAGE_SIZE', 3):
+            response = test_client.get("/api/admin/locations/export",
+                                       params={"admin_password": "admin123"},
+                                       headers={"Accept-Encoding": "identity"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        assert "attachment" in response.headers["content-disposition"]
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert [int(row["id"]) for row in rows] == [7, 6, 5, 4, 3, 2, 1]
+        assert rows[0]["timestamp"] == "2025-01-01T12:00:06+09:00"
+        assert rows[0]["timestamp_ms"] == "1735700406000"
+        assert rows[0]["user_agent"] == 'Agent "quoted", x'
+
+    def test_csv_export_escapes_formulas(self, test_client):
+        """数式として解釈される文字で始まる値がCSVでは ' 付きで出力され、NDJSONではそのままであることを確認"""
+        import csv
+        import io
+        conn = sqlite3.connect(TEST_DB_PATH)
+        conn.execute("INSERT INTO locations (latitude, longitude, timestamp, session_id, user_agent) "
+                     "VALUES (35.0, 139.0, '2025-01-01T12:00:00+09:00', '=HYPERLINK(\"x\")', '@SUM(A1)')")
+        conn.commit()
+        conn.close()
+        params = {"admin_password": "admin123"}
+        rows = list(csv.DictReader(io.StringIO(
+            test_client.get("/api/admin/locations/export", params=params).text)))
+        assert rows[0]["session_id"] == "'=HYPERLINK(\"x\")"
+        assert rows[0]["user_agent"] == "'@SUM(A1)"
+        assert rows[0]["latitude"] == "35.0"
+        record = json.loads(test_client.get("/api/admin/locations/export",
+                                            params={**params, "format": "ndjson"}).text)
+        assert record["session_id"] == '=HYPERLINK("x")'
+
+    def test_ndjson_export_with_gzip(self, test_client):
+        """NDJSONがgzipで圧縮されて出力されることを確認"""
+        self._insert_rows(5)
+        with patch('main.EXPORT_PAGE_SIZE', 2):
+            response = test_client.get("/api/admin/locations/export",
+                                       params={"admin_password": "admin123", "format": "ndjson"},
+                                       headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        records = [json.loads(line) for line in response.text.splitlines()]
+        assert [record["session_id"] for record in records] == [f"export_{i}" for i in range(4, -1, -1)]
+
+    def test_empty_csv_has_header_only(self, test_client):
+        """記録がない場合もCSVのヘッダー行は出力されることを確認"""
+        response = test_client.get("/api/admin/locations/export", params={"admin_password": "admin123"})
+        assert response.text == ",".join(main.EXPORT_FIELDS) + "\n"
+
+    def test_export_requires_admin_and_valid_format(self, test_client):
+        """パスワードと出力形式が検証されることを確認"""
+        assert test_client.get("/api/admin/locations/export",
+                               params={"admin_password": "wrong"}).status_code == 401
+        assert test_client.get("/api/admin/locations/export",
+                               params={"admin_password": "admin123", "format": "xml"}).status_code == 400
+
+
+class TestViewportQueries:
+    """範囲（bbox）・期間での絞り込みのテスト"""
+
+    POINTS = [
+        # (緯度, 経度, タイムスタンプ)
+        (35.68, 139.76, "2025-01-01T10:00:00+09:00"),   # 東京
+        (34.69, 135.50, "2025-01-01T11:00:00+09:00"),   # 大阪
+        (35.69, 139.70, "2025-01-02T10:00:00+09:00"),   # 東京
+        (-17.7, 178.0, "2025-01-02T11:00:00+09:00"),    # フィジー（日付変更線の西）
+        (-14.3, -170.7, "2025-01-03T10:00:00+09:00"),   # 米領サモア（日付変更線の東）
+    ]
+
+    def _insert_points(self):
+        conn = sqlite3.connect(TEST_DB_PATH)
+        conn.executemany("INSERT INTO locations (latitude, longitude, timestamp) VALUES (?, ?, ?)",
+                         self.POINTS)
+        conn.commit()
+        conn.close()
+        # 移行前に入れた行の timestamp_ms を埋める（本番では起動時のバックグラウンド処理）
+        asyncio.run(main.backfill_timestamps())
+
+    def _ids(self, test_client, **params):
+        response = test_client.get("/api/locations", params=params)
+        assert response.status_code == 200
+        return [loc["id"] for loc in response.json()]
+
+    def test_bbox_returns_points_inside(self, test_client):
+        """bbox 内の記録だけが新しい順に返されることを確認"""
+        self._insert_points()
+        assert self._ids(test_client, bbox="139.5,35.5,140.0,36.0") == [3, 1]
+        # 境界上の点も含まれる
+        assert self._ids(test_client, bbox="135.5,34.69,135.5,34.69") == [2]
+
+    def test_bbox_across_antimeridian(self, test_client):
+        """日付変更線をまたぐ bbox（西 > 東）で両側の記録が返されることを確認"""
+        self._insert_points()
+        assert self._ids(test_client, bbox="170,-30,-160,0") == [5, 4]
+
+    def test_time_range_and_combination(self, test_client):
+        """期間（start 以上 end 未満）と bbox を組み合わせて絞り込めることを確認"""
+        self._insert_points()
+        assert self._ids(test_client, start="2025-01-02T00:00:00", end="2025-01-03T00:00:00") == [4, 3]
+        assert self._ids(test_client, bbox="139.5,35.5,140.0,36.0", end="1735779600000") == [1]
+
+    def test_rtree_follows_inserts_and_deletes(self, test_client):
+        """記録の追加・削除が R*Tree に反映され、再構築しても結果が変わらないことを確認"""
+        self._insert_points()
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "bbox"},
+                         params={"admin_password": "admin123"})
+        new_id = test_client.post("/api/record-location",
+                                  json={"latitude": 35.70, "longitude": 139.80}).json()["id"]
+        test_client.delete("/api/admin/locations/1", params={"admin_password": "admin123"})
+        assert self._ids(test_client, bbox="139.5,35.5,140.0,36.0") == [new_id, 3]
+
+        assert main.rebuild_location_rtree() == 5
+        assert self._ids(test_client, bbox="139.5,35.5,140.0,36.0") == [new_id, 3]
+
+    def test_invalid_parameters(self, test_client):
+        """不正な bbox・時刻や他のモードとの併用は400になることを確認"""
+        assert test_client.get("/api/locations", params={"bbox": "1,2,3"}).status_code == 400
+        assert test_client.get("/api/locations", params={"bbox": "0,50,10,40"}).status_code == 400
+        assert test_client.get("/api/locations", params={"start": "yesterday"}).status_code == 400
+        assert test_client.get("/api/locations",
+                               params={"bbox": "0,0,1,1", "since": 1}).status_code == 400
+
+
+class TestLocationClusters:
+    """ズームに応じたクラスタ集計のテスト"""
+
+    TOKYO_BBOX = "139.0,35.0,140.5,36.5"
+
+    def _enable(self, test_client):
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Clusters"},
+                         params={"admin_password": "admin123"})
+
+    def _record(self, test_client, lat, lon):
+        return test_client.post("/api/record-location", json={"latitude": lat, "longitude": lon}).json()["id"]
+
+    def _grid_snapshot(self):
+        with main.db_pool.reader() as conn:
+            return sorted((level, x, y, count, round(sum_lat, 6), round(sum_lon, 6)) for level, x, y, count, sum_lat, sum_lon
+                          in conn.execute("SELECT * FROM location_grid"))
+
+    def test_low_zoom_merges_nearby_points(self, test_client):
+        """低いズームでは近くの記録が1つのクラスタにまとまり、重心が返されることを確認"""
+        self._enable(test_client)
+        self._record(test_client, 35.68, 139.76)
+        self._record(test_client, 35.70, 139.70)
+        self._record(test_client, 34.69, 135.50)
+
+        data = test_client.get("/api/locations/clusters",
+                               params={"zoom": 5, "bbox": "130,30,145,40"}).json()
+        counts = sorted(cluster["count"] for cluster in data["clusters"])
+        assert counts == [1, 2]
+        tokyo = next(c for c in data["clusters"] if c["count"] == 2)
+        assert tokyo["latitude"] == pytest.approx(35.69)
+        assert tokyo["longitude"] == pytest.approx(139.73)
+
+        # 高いズームでは別々のクラスタになる
+        data = test_client.get("/api/locations/clusters",
+                               params={"zoom": 16, "bbox": "139.69,35.67,139.77,35.71"}).json()
+        assert sorted(c["count"] for c in data["clusters"]) == [1, 1]
+
+    def test_grid_updated_incrementally(self, test_client):
+        """記録・一括記録・削除のたびにグリッドが更新され、再構築と一致することを確認"""
+        self._enable(test_client)
+        first = self._record(test_client, 35.68, 139.76)
+        test_client.post("/api/record-locations", json={"locations": [
+            {"latitude": 35.60, "longitude": 139.60}, {"latitude": 35.61, "longitude": 139.61}]})
+        test_client.delete(f"/api/admin/locations/{first}", params={"admin_password": "admin123"})
+
+        data = test_client.get("/api/locations/clusters", params={"zoom": 3, "bbox": self.TOKYO_BBOX}).json()
+        assert [c["count"] for c in data["clusters"]] == [2]
+
+        incremental = self._grid_snapshot()
+        main.rebuild_location_grid()
+        assert self._grid_snapshot() == incremental
+
+    def test_sample_ids(self, test_client):
+        """samples を指定するとクラスタごとの記録IDが返されることを確認"""
+        self._enable(test_client)
+        ids = [self._record(test_client, 35.68 + i / 1000, 139.76) for i in range(3)]
+        data = test_client.get("/api/locations/clusters",
+                               params={"zoom": 8, "bbox": self.TOKYO_BBOX, "samples": 2}).json()
+        assert data["clusters"][0]["count"] == 3
+        assert data["clusters"][0]["ids"] == sorted(ids, reverse=True)[:2]
+
+    def test_request_bounded_by_screen(self, test_client):
+        """画面に対して広すぎる bbox や不正なパラメータは400になることを確認"""
+        response = test_client.get("/api/locations/clusters", params={"zoom": 18, "bbox": "-180,-85,180,85"})
+        assert response.status_code == 400
+        assert test_client.get("/api/locations/clusters",
+                               params={"zoom": 3, "bbox": self.TOKYO_BBOX, "samples": 100}).status_code == 400
+        assert test_client.get("/api/locations/clusters",
+                               params={"zoom": -1, "bbox": self.TOKYO_BBOX}).status_code == 400
+
+
+class TestHeatmapTiles:
+    """ヒートマップタイルのテスト"""
+
+    # 東京駅付近を含むズーム10のタイル
+    TILE = (10, 909, 403)
+
+    def _enable(self, test_client):
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Heatmap"},
+                         params={"admin_password": "admin123"})
+
+    def _record(self, test_client, lat, lon):
+        return test_client.post("/api/record-location", json={"latitude": lat, "longitude": lon}).json()["id"]
+
+    def _density(self, test_client, tile):
+        z, x, y = tile
+        response = test_client.get(f"/api/heatmap/{z}/{x}/{y}", params={"format": "u16"})
+        assert response.status_code == 200
+        scale = int(response.headers["x-heatmap-scale"])
+        return np.frombuffer(response.content, dtype="<u2").reshape(256, 256) / scale
+
+    def test_density_peaks_at_point(self, test_client):
+        """記録の位置に密度のピーク（1件で約1）ができることを確認"""
+        self._enable(test_client)
+        self._record(test_client, 35.681, 139.767)
+        density = self._density(test_client, self.TILE)
+        rows, cols = heatmap.to_tile_pixels([35.681], [139.767], *self.TILE)
+        row, col = np.unravel_index(np.argmax(density), density.shape)
+        assert abs(row - rows[0]) <= 1 and abs(col - cols[0]) <= 1
+        assert density.max() == pytest.approx(1.0, abs=0.1)
+        # 点から離れた場所は0
+        assert density[0, 0] == 0
+
+    def test_png_tile(self, test_client):
+        """PNG形式のタイルが正しいPNGとして返されることを確認"""
+        self._enable(test_client)
+        self._record(test_client, 35.681, 139.767)
+        z, x, y = self.TILE
+        response = test_client.get(f"/api/heatmap/{z}/{x}/{y}")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/png"
+        body = response.content
+        assert body.startswith(b"\x89PNG\r\n\x1a\n")
+        width, height = struct.unpack(">II", body[16:24])
+        assert (width, height) == (256, 256)
+        # IDAT を展開すると (フィルタ1バイト + RGBA) x 行数になる
+        length = struct.unpack(">I", body[33:37])[0]
+        assert body[37:41] == b"IDAT"
+        raw = zlib.decompress(body[41:41 + length])
+        assert len(raw) == 256 * (1 + 256 * 4)
+
+    def test_blur_crosses_tile_boundary(self, test_client):
+        """タイルの端の近くの記録は隣のタイルにもぼかしが描かれることを確認"""
+        self._enable(test_client)
+        z, x, y = self.TILE
+        west, south, east, north = geogrid.cell_bounds(z, x, y)
+        # 東端のすぐ内側
+        self._record(test_client, (south + north) / 2, east - (east - west) / 256 * 2)
+        assert self._density(test_client, (z, x + 1, y))[:, :5].max() > 0
+
+    def test_cache_invalidated_per_tile(self, test_client):
+        """記録・削除で影響するタイルだけがキャッシュから捨てられることを確認"""
+        self._enable(test_client)
+        other = (10, 100, 100)
+        assert self._density(test_client, self.TILE).max() == 0
+        self._density(test_client, other)
+        assert len(main.heatmap_tiles) == 2
+
+        location_id = self._record(test_client, 35.681, 139.767)
+        assert (*other, "u16") in main.heatmap_tiles._tiles
+        assert (*self.TILE, "u16") not in main.heatmap_tiles._tiles
+        assert self._density(test_client, self.TILE).max() > 0
+
+        test_client.delete(f"/api/admin/locations/{location_id}", params={"admin_password": "admin123"})
+        assert self._density(test_client, self.TILE).max() == 0
+
+    def test_stale_render_not_cached(self):
+        """描画中に無効化があった場合は結果をキャッシュしないことを確認"""
+        cache = heatmap.TileCache(max_size=2)
+        generation = cache.generation
+        cache.invalidate_points([(35.0, 139.0)])
+        cache.put((0, 0, 0, "png"), b"old", generation)
+        assert cache.get((0, 0, 0, "png")) is None
+        # 上限を超えると古い順に捨てる
+        for x in range(3):
+            cache.put((2, x, 0, "png"), b"tile", cache.generation)
+        assert len(cache) == 2 and cache.get((2, 0, 0, "png")) is None
+
+    @staticmethod
+    def _affects_tile(lat, lon, z, x, y, radius=heatmap.HEATMAP_RADIUS):
+        """点がタイル (z, x, y) の描画（ぼかしの範囲を含む）に影響するか1枚ずつ判定する"""
+        rows, cols = heatmap.to_tile_pixels([lat], [lon], z, x, y)
+        return bool(-radius <= rows[0] < heatmap.TILE_SIZE + radius
+                    and -radius <= cols[0] < heatmap.TILE_SIZE + radius)
+
+    def test_get_during_invalidation(self):
+        """別スレッドの無効化と並行して get() しても辞書の変更で失敗しないことを確認"""
+        cache = heatmap.TileCache(max_size=2000)
+        for x in range(1000):
+            cache.put((10, x, 0, "png"), b"tile", cache.generation)
+        errors = []
+        stop = threading.Event()
+
+        def invalidate():
+            try:
+                while not stop.is_set():
+                    cache.invalidate_points([(85.0, 179.0)])
+            except Exception as exc:
+                errors.append(exc)
+
+        # スレッドの切り替えを頻繁にして、辞書の走査中に get() が割り込むようにする
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        thread = threading.Thread(target=invalidate)
+        thread.start()
+        try:
+            for i in range(20000):
+                cache.get((10, i % 1000, 0, "png"))
+        finally:
+            stop.set()
+            thread.join()
+            sys.setswitchinterval(interval)
+        assert errors == []
+
+    def test_affected_tiles_match_per_tile_check(self):
+        """計算で求めた影響タイルが、タイルごとの判定と一致することを確認"""
+        rng = np.random.default_rng(0)
+        points = list(zip(rng.uniform(-85, 85, 200), rng.uniform(-180, 180, 200)))
+        # タイルの境目ちょうどの点
+        points += [(0.0, 0.0), (35.0, -180.0), (-85.0, 179.999)]
+        for z in (0, 1, 3):
+            expected = {(x, y) for x in range(1 << z) for y in range(1 << z)
+                        if any(self._affects_tile(lat, lon, z, x, y) for lat, lon in points)}
+            assert heatmap.affected_tiles(points, z) == expected
+        for lat, lon in points[:20]:
+            tiles = heatmap.affected_tiles([(lat, lon)], 10)
+            assert 1 <= len(tiles) <= 4
+            assert all(self._affects_tile(lat, lon, 10, x, y) for x, y in tiles)
+
+    def test_invalid_tile(self, test_client):
+        """範囲外のタイルや不正な形式は400になることを確認"""
+        assert test_client.get("/api/heatmap/2/4/0").status_code == 400
+        assert test_client.get("/api/heatmap/23/0/0").status_code == 400
+        assert test_client.get("/api/heatmap/1/0/0", params={"format": "jpg"}).status_code == 400
+
+
+class TestLocationStats:
+    """列指向スナップショットと統計APIのテスト"""
+
+    def _enable(self, test_client):
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Stats"},
+                         params={"admin_password": "admin123"})
+
+    def _stats(self, test_client, **params):
+        response = test_client.get("/api/admin/stats", params={"admin_password": "admin123", **params})
+        assert response.status_code == 200
+        return response.json()
+
+    def test_stats_summary(self, test_client):
+        """件数・重心・範囲・散らばりが計算されることを確認"""
+        self._enable(test_client)
+        test_client.post("/api/record-locations", json={"locations": [
+            {"latitude": 35.0, "longitude": 139.0}, {"latitude": 36.0, "longitude": 140.0}]})
+        stats = self._stats(test_client)
+        assert stats["count"] == 2
+        assert stats["bbox"] == {"west": 139.0, "south": 35.0, "east": 140.0, "north": 36.0}
+        assert stats["centroid"]["latitude"] == pytest.approx(35.5, abs=0.01)
+        assert stats["centroid"]["longitude"] == pytest.approx(139.5, abs=0.01)
+        # 2点間の距離は約143km なので、重心からはその半分
+        assert stats["dispersion"]["max_distance_m"] == pytest.approx(71500, rel=0.01)
+        assert stats["dispersion"]["radius_of_gyration_m"] == pytest.approx(
+            stats["dispersion"]["max_distance_m"], rel=0.001)
+        assert stats["buckets"][0]["count"] == 2
+        assert stats["buckets"][0]["start"].endswith("T00:00:00+09:00")
+
+    def test_empty_stats(self, test_client):
+        """記録がない場合も統計が返されることを確認"""
+        stats = self._stats(test_client)
+        assert stats["count"] == 0 and stats["centroid"] is None
+
+    def test_snapshot_appends_and_rebuilds_on_delete(self, test_client):
+        """追加は追記で反映され、削除後は作り直されることを確認"""
+        self._enable(test_client)
+        assert self._stats(test_client)["count"] == 0
+        rebuilds = main.location_snapshot.rebuilds
+        ids = [test_client.post("/api/record-location", json={"latitude": 35.0 + i, "longitude": 139.0}).json()["id"]
+               for i in range(3)]
+        assert self._stats(test_client)["count"] == 3
+        assert main.location_snapshot.rebuilds == rebuilds
+
+        test_client.delete(f"/api/admin/locations/{ids[0]}", params={"admin_password": "admin123"})
+        stats = self._stats(test_client)
+        assert stats["count"] == 2 and stats["bbox"]["south"] == 36.0
+        assert main.location_snapshot.rebuilds == rebuilds + 1
+        assert list(main.location_snapshot.columns()["id"]) == ids[1:]
+
+    def test_snapshot_grows_and_keeps_loaded_rows(self):
+        """容量を超える追記と、読み込み中に届いた追記が正しく反映されることを確認"""
+        rows = [(i, 35.0, 139.0, i * 1000) for i in range(1, 4)]
+        def loader():
+            # 読み込み中にコミットされた記録（1件は読み込み結果にも含まれる）
+            snapshot.append([(3, 35.0, 139.0, 3000), (4, 35.0, 139.0, 4000)])
+            return list(rows)
+
+        snapshot = LocationSnapshot(loader)
+        assert list(snapshot.columns()["id"]) == [1, 2, 3, 4]
+        snapshot.append([(i, 35.0, 139.0, i * 1000) for i in range(5, 2000)])
+        columns = snapshot.columns()
+        assert len(columns["id"]) == 1999 and columns["timestamp_ms"][-1] == 1999000
+        assert not columns["latitude"].flags.writeable
+
+    def test_out_of_order_append_forces_rebuild(self):
+        """先に追記されたIDより小さいIDが後から届いた場合は、捨てずに作り直すことを確認"""
+        rows = [(1, 35.0, 139.0, 1000)]
+        snapshot = LocationSnapshot(lambda: list(rows))
+        snapshot.columns()
+        rows += [(2, 35.0, 139.0, 2000), (3, 35.0, 139.0, 3000)]
+        snapshot.append([(3, 35.0, 139.0, 3000)])
+        snapshot.append([(2, 35.0, 139.0, 2000)])
+        assert not snapshot.valid
+        assert list(snapshot.columns()["id"]) == [1, 2, 3]
+
+    def test_concurrent_inserts_keep_every_row(self, test_client):
+        """並行して記録してもスナップショットがDBと同じ行を持つことを確認"""
+        main.update_recording_session(True, None, "Concurrent")
+        main.location_snapshot.columns()
+
+        def record(worker):
+            for i in range(20):
+                location = main.LocationRecord(latitude=35.0 + worker / 100, longitude=139.0 + i / 100)
+                if i % 2:
+                    main.insert_location(location)
+                else:
+                    main.insert_locations_batch([location, location.model_copy()])
+
+        original_append = main.location_snapshot.append
+
+        def delayed_append(rows):
+            # コミットから追記までの間に他のスレッドが割り込みやすくする
+            time.sleep(0.002 * (rows[0][0] % 3))
+            original_append(rows)
+
+        threads = [threading.Thread(target=record, args=(worker,)) for worker in range(6)]
+        with patch.object(main.location_snapshot, "append", side_effect=delayed_append):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        conn = sqlite3.connect(TEST_DB_PATH)
+        ids = [row[0] for row in conn.execute("SELECT id FROM locations ORDER BY id")]
+        conn.close()
+        assert len(ids) == 6 * 30
+        assert list(main.location_snapshot.columns()["id"]) == ids
+
+    def test_stats_with_unparseable_timestamp(self, test_client):
+        """時刻を換算できない行があっても統計が返され、時間帯別件数・期間指定から外れることを確認"""
+        rows = [(1, 35.0, 139.0, 1700000000000), (2, 36.0, 140.0, None)]
+        with patch.object(main.location_snapshot, "loader", lambda: list(rows)):
+            main.location_snapshot.invalidate()
+            stats = self._stats(test_client)
+            assert stats["count"] == 2
+            assert sum(entry["count"] for entry in stats["buckets"]) == 1
+            assert self._stats(test_client, end="4102444800000")["count"] == 1
+
+    def test_stats_filters_and_validation(self, test_client):
+        """期間の絞り込み・集計単位の検証・認証を確認"""
+        self._enable(test_client)
+        test_client.post("/api/record-location", json={"latitude": 35.0, "longitude": 139.0})
+        assert self._stats(test_client, bucket="hour", end="0")["count"] == 0
+        assert self._stats(test_client, bucket="hour", start="0")["count"] == 1
+        assert test_client.get("/api/admin/stats", params={"admin_password": "admin123",
+                                                           "bucket": "year"}).status_code == 400
+        assert test_client.get("/api/admin/stats", params={"admin_password": "wrong"}).status_code == 401
+
+
+class TestDashboardCounters:
+    """トリガーで維持する集計表とダッシュボードのテスト"""
+
+    def _enable(self, test_client):
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Dashboard"},
+                         params={"admin_password": "admin123"})
+
+    def _time_counts(self):
+        with main.db_pool.reader() as conn:
+            return sorted(conn.execute("SELECT unit, bucket, count FROM location_time_counts").fetchall())
+
+    def test_counters_follow_writes(self, test_client):
+        """記録・一括記録・削除で件数が更新され、作り直した結果と一致することを確認"""
+        self._enable(test_client)
+        first = test_client.post("/api/record-location", json={"latitude": 35.68, "longitude": 139.76}).json()["id"]
+        test_client.post("/api/record-locations", json={"locations": [
+            {"latitude": 35.60, "longitude": 139.60}, {"latitude": 34.69, "longitude": 135.50}]})
+        test_client.delete(f"/api/admin/locations/{first}", params={"admin_password": "admin123"})
+
+        response = test_client.get("/api/admin/dashboard", params={"admin_password": "admin123"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total"] == 2
+        assert data["today"] == 2 and data["this_hour"] == 2 and data["last_24h"] == 2
+        assert len(data["days"]) == main.DASHBOARD_DAYS and len(data["hours"]) == main.DASHBOARD_HOURS
+        assert data["days"][-1]["date"] == main.get_jst_now().strftime("%Y-%m-%d")
+        assert sum(cell["count"] for cell in data["top_cells"]) == 2
+
+        incremental = self._time_counts()
+        with main.db_pool.writer() as conn:
+            main.fill_location_time_counts(conn)
+        assert self._time_counts() == incremental
+
+    def test_migration_counts_existing_rows(self, test_client):
+        """移行時に既存の記録（timestamp のみ）から件数表が作られることを確認"""
+        conn = sqlite3.connect(TEST_DB_PATH)
+        conn.executemany("INSERT INTO locations (latitude, longitude, timestamp) VALUES (?, ?, ?)", [
+            (35.0, 139.0, "2024-01-02T00:30:00+09:00"),
+            (35.0, 139.0, "2024-01-02T23:59:00+09:00"),
+            (35.0, 139.0, "2024-01-01T23:59:00+09:00"),
+        ])
+        conn.commit()
+        conn.close()
+
+        now_ms = main.timestamp_to_ms("2024-01-02T23:59:30+09:00")
+        data = main.fetch_dashboard(now_ms=now_ms)
+        assert data["total"] == 3
+        assert [day["count"] for day in data["days"][-2:]] == [1, 2]
+        assert data["days"][-1]["date"] == "2024-01-02"
+        assert data["this_hour"] == 1
+        assert data["hours"][-1]["start"] == "2024-01-02T23:00:00+09:00"
+
+    def test_unparseable_timestamp_is_not_counted(self, test_client):
+        """時刻を換算できない行も記録・削除でき、件数表には数えられないことを確認"""
+        self._enable(test_client)
+        test_client.post("/api/record-location", json={"latitude": 35.68, "longitude": 139.76})
+        before = self._time_counts()
+        with main.db_pool.writer() as conn:
+            conn.execute("INSERT INTO locations (latitude, longitude, timestamp) VALUES (36.0, 140.0, 'unknown')")
+        assert self._time_counts() == before
+        with main.db_pool.writer() as conn:
+            main.fill_location_time_counts(conn)
+        assert self._time_counts() == before
+        with main.db_pool.writer() as conn:
+            conn.execute("DELETE FROM locations WHERE timestamp = 'unknown'")
+        assert self._time_counts() == before
+
+    def test_dashboard_requires_admin(self, test_client):
+        """管理者パスワードが違う場合は401になることを確認"""
+        assert test_client.get("/api/admin/dashboard", params={"admin_password": "wrong"}).status_code == 401
+
+
+class TestBenchmark:
+    """合成データ生成とベンチマークのテスト"""
+
+    def test_generator_is_seeded(self):
+        """同じシードからは同じデータが作られ、時刻が夜に集中することを確認"""
+        rows = benchmark.generate_locations(500, seed=7)
+        assert rows == benchmark.generate_locations(500, seed=7)
+        assert rows != benchmark.generate_locations(500, seed=8)
+        west, south, east, north = benchmark.JAPAN_BBOX
+        assert all(south - 1 <= row[0] <= north + 1 and west - 1 <= row[1] <= east + 1 for row in rows)
+        hours = {datetime.fromisoformat(row[2]).hour for row in rows}
+        assert hours <= {18, 19, 20, 21, 22}
+        assert len({row[4] for row in rows}) == 500
+
+    def test_percentiles(self):
+        """パーセンタイルとスループットが計算されることを確認"""
+        result = benchmark.summarize_latencies([float(i) for i in range(1, 101)], errors=2, elapsed=2.0)
+        assert result["throughput_rps"] == 50.0 and result["errors"] == 2
+        assert result["latency_ms"]["p50"] == pytest.approx(50.5)
+        assert result["latency_ms"]["p99"] == pytest.approx(99.01)
+        assert result["latency_ms"]["max"] == 100.0
+
+    def test_cleanup_goes_through_delete(self, test_client):
+        """測定で記録した行の削除が変更履歴・一覧のキャッシュ・統計に反映されることを確認"""
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Cleanup"},
+                         params={"admin_password": "admin123"})
+        kept = test_client.post("/api/record-location",
+                                json={"latitude": 35.0, "longitude": 139.0, "session_id": "visitor"}).json()["id"]
+        recorded = test_client.post("/api/record-location", json={
+            "latitude": 35.1, "longitude": 139.1,
+            "session_id": f"{benchmark.RECORDED_SESSION_PREFIX}1"}).json()["id"]
+        snapshot = test_client.get("/api/locations", params={"since": 0}).json()
+        stats = lambda: test_client.get("/api/admin/stats", params={"admin_password": "admin123"}).json()
+        assert stats()["count"] == 2
+
+        assert benchmark.remove_recorded_locations() == 1
+        delta = test_client.get("/api/locations", params={"since": snapshot["cursor"]}).json()
+        assert delta["deleted"] == [recorded]
+        assert [loc["id"] for loc in test_client.get("/api/locations").json()] == [kept]
+        assert stats()["count"] == 1
+
+    def test_run_benchmark(self, tmp_path):
+        """ASGI経由で各エンドポイントを測定し、記録した行が片付けられることを確認"""
+        original_path = main.DB_PATH
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = benchmark.run_benchmark([300], endpoints=["get_locations", "record_location"],
+                                             requests=10, concurrency=3, directory=str(tmp_path))
+        assert main.DB_PATH == original_path
+        run = result["runs"][0]
+        assert run["rows"] == 300 and run["load_seconds"] > 0
+        for name in ("get_locations", "record_location"):
+            stats = run["endpoints"][name]
+            assert stats["requests"] == 10 and stats["errors"] == 0
+            assert set(stats["latency_ms"]) >= {"p50", "p95", "p99"}
+        json.dumps(result)
+
+        # 2回目は同じDBを再利用する
+        with contextlib.redirect_stdout(io.StringIO()):
+            again = benchmark.run_benchmark([300], endpoints=["recording_status"], requests=5,
+                                            concurrency=2, directory=str(tmp_path))
+        assert again["runs"][0]["load_seconds"] == 0.0
+        main.db_pool.close()
+
+
+class TestTrafficCapture:
+    """トラフィックの記録とリプレイのテスト"""
+
+    def _capture_app(self, path):
+        recorder = TrafficRecorder(str(path))
+        return recorder, TrafficCaptureMiddleware(app, recorder=recorder)
+
+    def test_capture_is_anonymized(self, test_client, tmp_path):
+        """記録にはパス・時間・大きさ・丸めた座標だけが残り、秘密の値やセッションIDは残らないことを確認"""
+        capture = tmp_path / "capture.ndjson"
+        recorder, wrapped = self._capture_app(capture)
+        client = TestClient(wrapped)
+        client.post("/api/admin/enable-recording",
+                    json={"enabled": True, "expires_at": None, "description": "Capture"},
+                    params={"admin_password": "admin123"})
+        client.post("/api/record-location",
+                    json={"latitude": 35.681236, "longitude": 139.767125, "session_id": "secret-session"})
+        client.get("/api/locations", params={"limit": 5})
+        recorder.close()
+
+        text = capture.read_text(encoding="utf-8")
+        assert "admin123" not in text and "secret-session" not in text and "35.681236" not in text
+        entries = replay.load_capture(str(capture))
+        assert [entry["path"] for entry in entries] == [
+            "/api/admin/enable-recording", "/api/record-location", "/api/locations"]
+        assert entries[0]["query"] == "admin_password=REDACTED"
+        record = entries[1]
+        assert record["coords"] == [[35.68, 139.77]]
+        assert record["status"] == 200 and record["req_bytes"] > 0 and record["resp_bytes"] > 0
+        assert record["duration_ms"] >= 0 and entries[0]["t"] == 0
+        assert entries[2]["query"] == "limit=5"
+
+    def test_query_ranges_are_coarsened(self):
+        """クエリの bbox は座標と同じ桁数に、start / end は時間の区間に丸めて記録されることを確認"""
+        query = traffic.anonymize_query(
+            "bbox=139.767125,35.681236,139.771,35.69&start=2024-05-01T12:34:56&end=1714570496789&zoom=12")
+        params = dict(parse_qsl(query))
+        assert params["bbox"] == "139.77,35.68,139.77,35.69"
+        # 2024-05-01T12:34:56+09:00 → 2024-05-01T12:00:00+09:00
+        assert params["start"] == "1714532400000"
+        assert params["end"] == str(1714570496789 // 3600000 * 3600000)
+        assert params["zoom"] == "12"
+        assert traffic.anonymize_query("bbox=a,b&start=yesterday") == "bbox=REDACTED&start=REDACTED"
+
+    def test_build_request(self):
+        """再送用のリクエストにパスワードと新しいセッションIDが入ることを確認"""
+        entry = {"t": 0, "method": "POST", "path": "/api/record-locations", "query": "admin_password=REDACTED",
+                 "coords": [[35.68, 139.77], [35.0, 139.0]]}
+        method, url, body = replay.build_request(entry, 3, "pw", run_id=1)
+        assert method == "POST" and url == "/api/record-locations?admin_password=pw"
+        assert [loc["latitude"] for loc in body["locations"]] == [35.68, 35.0]
+        assert len({loc["session_id"] for loc in body["locations"]}) == 2
+        assert replay.route_key({"method": "DELETE", "path": "/api/admin/locations/12"}) == \
+            "DELETE /api/admin/locations/{id}"
+
+    def test_replay_reports_per_route(self, test_client):
+        """記録をASGI経由で再送し、経路ごとのパーセンタイルとエラー数が返されることを確認"""
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Replay"},
+                         params={"admin_password": "admin123"})
+        entries = [
+            {"t": 0, "method": "GET", "path": "/api/recording-status", "query": ""},
+            {"t": 5, "method": "POST", "path": "/api/record-location", "query": "", "coords": [[35.68, 139.77]]},
+            {"t": 10, "method": "POST", "path": "/api/record-location", "query": "", "coords": [[35.69, 139.70]]},
+            {"t": 15, "method": "GET", "path": "/api/events", "query": ""},
+        ]
+        report = asyncio.run(replay.replay(entries, "http://replay", speed=10,
+                                           transport=httpx.ASGITransport(app=app)))
+        assert set(report["routes"]) == {"GET /api/recording-status", "POST /api/record-location"}
+        records = report["routes"]["POST /api/record-location"]
+        assert records["requests"] == 2 and records["errors"] == 0 and records["status"] == {"200": 2}
+        assert report["total"]["requests"] == 3 and "p99" in report["total"]["latency_ms"]
+        assert main.fetch_location_count() == 2
+
+
+class TestMetrics:
+    """Prometheus形式のメトリクスのテスト"""
+
+    def _sample(self, text, prefix):
+        lines = [line for line in text.splitlines() if line.startswith(prefix + " ")]
+        assert len(lines) == 1, prefix
+        return float(lines[0].rsplit(" ", 1)[1])
+
+    def test_histogram_merges_threads(self):
+        """スレッドごとに記録した値が出力時に合計され、累積バケットになることを確認"""
+        histogram = metrics.Histogram("test_seconds", "test", ("route",), buckets=(0.1, 1.0))
+        threads = [threading.Thread(target=lambda: [histogram.observe(value, "/a") for value in (0.05, 0.5, 5.0)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        lines = histogram.render()
+        assert 'test_seconds_bucket{route="/a",le="0.1"} 4' in lines
+        assert 'test_seconds_bucket{route="/a",le="1"} 8' in lines
+        assert 'test_seconds_bucket{route="/a",le="+Inf"} 12' in lines
+        assert 'test_seconds_count{route="/a"} 12' in lines
+        assert 'test_seconds_sum{route="/a"} 22.2' in lines
+
+    def test_metrics_endpoint(self, test_client):
+        """ルート別のリクエスト数・SQLの実行時間・キュー・キャッシュ・件数が出力されることを確認"""
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Metrics"},
+                         params={"admin_password": "admin123"})
+        location_id = test_client.post("/api/record-location",
+                                       json={"latitude": 35.0, "longitude": 139.0}).json()["id"]
+        test_client.post("/api/record-location", json={"latitude": 35.1, "longitude": 139.1})
+        test_client.delete(f"/api/admin/locations/{location_id}", params={"admin_password": "admin123"})
+        test_client.get("/api/locations")
+        test_client.get("/api/locations")
+
+        response = test_client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        text = response.text
+        route = 'route="/api/admin/locations/{location_id}",method="DELETE",status="200"'
+        assert self._sample(text, f"http_requests_total{{{route}}}") >= 1
+        assert f"http_request_duration_seconds_bucket{{{route},le=\"+Inf\"}}" in text
+        assert self._sample(text, 'sqlite_statement_duration_seconds_count{statement="insert_location"}') >= 2
+        assert self._sample(text, "ingest_queue_depth") == 0
+        assert self._sample(text, "locations_rows") == 1
+        assert self._sample(text, 'cache_hits_total{cache="locations_response"}') >= 1
+        assert 'cache_hit_ratio{cache="locations_response"}' in text
+
+    def test_config_and_session_cache_counters(self, test_client):
+        """設定と記録セッションのキャッシュのヒット数・ミス数が出力されることを確認"""
+        def counts(cache):
+            text = test_client.get("/metrics").text
+            return (self._sample(text, f'cache_hits_total{{cache="{cache}"}}'),
+                    self._sample(text, f'cache_misses_total{{cache="{cache}"}}'))
+
+        main.config_cache.invalidate()
+        main.session_cache.invalidate()
+        card_hits, card_misses = counts("card_info")
+        session_hits, session_misses = counts("recording_session")
+        test_client.get("/api/card-info")
+        test_client.get("/api/card-info")
+        test_client.get("/api/recording-status")
+        test_client.get("/api/recording-status")
+        assert counts("card_info") == (card_hits + 1, card_misses + 1)
+        hits, misses = counts("recording_session")
+        assert misses == session_misses + 1 and hits >= session_hits + 1
+
+    def test_unmatched_routes_are_grouped(self, test_client):
+        """存在しないパスはルート名 unmatched にまとめられることを確認"""
+        test_client.get("/api/no-such-route/1")
+        test_client.get("/api/no-such-route/2")
+        text = test_client.get("/metrics").text
+        assert "/api/no-such-route" not in text
+        assert 'http_requests_total{route="unmatched",method="GET",status="404"}' in text
+
+
+class TestStructuredLogging:
+    """構造化ログ（JSON・サンプリング・リクエストID）のテスト"""
+
+    @contextlib.contextmanager
+    def _capture(self):
+        """バックグラウンドのリスナーの出力先を一時的に差し替えて、JSONの行を集める"""
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(applog.JsonFormatter())
+        listener = applog.configure_logging()
+        original = listener.handlers
+        listener.handlers = (handler,)
+        entries = []
+        try:
+            yield entries
+            applog.flush()
+        finally:
+            listener.handlers = original
+        entries.extend(json.loads(line) for line in stream.getvalue().splitlines())
+
+    def test_sampling_filter(self):
+        """割合を指定したイベントだけ間引かれ、WARNING以上と指定のないイベントは全て残ることを確認"""
+        sampler = applog.SamplingFilter(applog.parse_sample_rates("a=0.25,b=0,bad=x"))
+
+        def record(event, level=logging.INFO):
+            return logging.LogRecord("t", level, "", 0, "m", (), None) if event is None else \
+                logging.makeLogRecord({"levelno": level, "event": event})
+
+        assert [sampler.filter(record("a")) for _ in range(8)].count(True) == 2
+        assert not sampler.filter(record("b"))
+        assert sampler.filter(record("b", logging.WARNING))
+        assert sampler.filter(record("c"))
+        assert sampler.filter(record(None))
+
+    def test_request_id_and_events(self, test_client):
+        """リクエストIDがレスポンスとログに付き、記録のボディがログに含まれないことを確認"""
+        test_client.post("/api/admin/enable-recording",
+                         json={"enabled": True, "expires_at": None, "description": "Logging"},
+                         params={"admin_password": "admin123"})
+        level = main.logger.level
+        main.logger.setLevel(logging.DEBUG)
+        try:
+            with self._capture() as entries:
+                response = test_client.post("/api/record-location",
+                                            json={"latitude": 35.0, "longitude": 139.0,
+                                                  "session_id": "secret-session"},
+                                            headers={"X-Request-ID": "req-123"})
+                generated = test_client.get("/api/recording-status").headers["X-Request-ID"]
+                invalid = test_client.get("/api/recording-status", headers={"X-Request-ID": "bad id!"})
+        finally:
+            main.logger.setLevel(level)
+        assert response.status_code == 200
+        assert response.headers["X-Request-ID"] == "req-123"
+        assert len(generated) == 32
+        assert invalid.headers["X-Request-ID"] != "bad id!"
+
+        events = {entry.get("event"): entry for entry in entries if entry.get("request_id") == "req-123"}
+        assert events["location.received"]["level"] == "DEBUG"
+        assert "body" not in events["location.received"]
+        assert "secret-session" not in json.dumps(entries)
+        assert all(entry["logger"].startswith("namecard") and "ts" in entry for entry in entries)
+
+    def test_exception_is_logged_as_json(self):
+        """例外が exc フィールドに入り、1行のJSONとして書き出されることを確認"""
+        with self._capture() as entries:
+            try:
+                raise ValueError("boom")
+            except ValueError:
+                main.logger.exception("failed", extra={"event": "test.failed", "size": 3})
+        entry = next(entry for entry in entries if entry.get("event") == "test.failed")
+        assert entry["level"] == "ERROR"
+        assert entry["size"] == 3
+        assert "ValueError: boom" in entry["exc"]
+
+class TestLoopWatchdog:
+    """イベントループの遅延の監視と遅いリクエストの記録のテスト"""
+
+    def test_detects_blocked_loop(self):
+        """ループを止めた関数がスタックに記録され、遅延が測られることを確認"""
+        def block_the_loop():
+            time.sleep(0.3)
+
+        async def scenario():
+            watchdog = loopwatch.LoopWatchdog(interval=0.02, stall_threshold_ms=100)
+            await watchdog.start()
+            await asyncio.sleep(0.05)
+            block_the_loop()
+            await asyncio.sleep(0.1)
+            await watchdog.stop()
+            return watchdog
+
+        watchdog = asyncio.run(scenario())
+        assert watchdog.stall_count == 1
+        assert watchdog.max_lag >= 0.2
+        stall = watchdog.report()["loop"]["recent_stalls"][0]
+        assert stall["blocked_ms"] >= 100
+        assert any(frame.endswith(" block_the_loop") for frame in stall["stack"])
+
+    def test_samples_worker_stack_of_inflight_request(self):
+        """しきい値を超えて処理中のリクエストについて、DBスレッドのスタックが取られることを確認"""
+        def slow_query():
+            time.sleep(0.3)
+
+        async def scenario():
+            watchdog = loopwatch.LoopWatchdog(interval=0.02, slow_threshold_ms=100)
+            await watchdog.start()
+            key = object()
+            profile = watchdog.begin(key)
+            await main.run_blocking(slow_query)
+            watchdog.end(key)
+            await watchdog.stop()
+            return profile
+
+        profile = asyncio.run(scenario())
+        workers = [stack for stack in profile.stacks if stack["thread"].startswith("db_")]
+        assert profile.stacks[0]["thread"] == "event-loop"
+        assert any(frame.endswith(" slow_query") for stack in workers for frame in stack["stack"])
+
+    def test_params_shape(self):
+        """引数の値ではなく形だけが残ることを確認"""
+        shape = loopwatch.params_shape({
+            "query_string": b"bbox=139,35.5,140,36&limit=10&admin_password=secret&start=",
+            "headers": [(b"content-length", b"42")],
+            "path_params": {"location_id": 3},
+        })
+        assert shape == {
+            "path": ["location_id"],
+            "query": {"bbox": "float[4]", "limit": "int", "admin_password": "str", "start": "empty"},
+            "body_bytes": 42,
+        }
+
+    def test_event_stream_is_not_sampled(self):
+        """SSEの接続は開いている時間が長くても遅いリクエストとして記録されないことを確認"""
+        watchdog = loopwatch.LoopWatchdog(slow_threshold_ms=10)
+        inflight_after_start = []
+
+        def make_app(content_type):
+            async def app(scope, receive, send):
+                await send({"type": "http.response.start", "status": 200,
+                            "headers": [(b"content-type", content_type)]})
+                inflight_after_start.append(len(watchdog._inflight))
+                await asyncio.sleep(0.05)
+                await send({"type": "http.response.body", "body": b"data", "more_body": False})
+            return app
+
+        async def call(content_type, path):
+            middleware = loopwatch.SlowRequestMiddleware(make_app(content_type), watchdog, lambda scope: path)
+            scope = {"type": "http", "method": "GET", "path": path, "query_string": b"", "headers": []}
+
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+
+            async def send(message):
+                pass
+
+            await middleware(scope, receive, send)
+
+        asyncio.run(call(b"text/event-stream; charset=utf-8", "/api/events"))
+        assert list(watchdog.slow_requests) == []
+        assert inflight_after_start == [0]
+
+        asyncio.run(call(b"text/csv", "/api/admin/export"))
+        assert [entry["route"] for entry in watchdog.slow_requests] == ["/api/admin/export"]
+
+    def test_slow_requests_endpoint(self, test_client):
+        """遅いリクエストのルート・DB時間が記録され、管理者だけが参照できることを確認"""
+        main.loop_watchdog.slow_requests.clear()
+        with patch.object(main.loop_watchdog, "slow_threshold", 0.0):
+            test_client.get("/api/locations", params={"bbox": "139,35,140,36"},
+                            headers={"X-Request-ID": "slow-1"})
+
+        assert test_client.get("/api/admin/slow-requests", params={"admin_password": "wrong"}).status_code == 401
+        assert test_client.get("/api/admin/slow-requests",
+                               params={"admin_password": "admin123", "limit": 0}).status_code == 400
+        response = test_client.get("/api/admin/slow-requests", params={"admin_password": "admin123"})
+        assert response.status_code == 200
+        entry = response.json()["requests"][0]
+        assert entry["request_id"] == "slow-1"
+        assert entry["route"] == "/api/locations"
+        assert entry["params"]["query"] == {"bbox": "int[4]"}
+        assert entry["status"] == 200
+        assert entry["db_statements"] >= 1
+        assert entry["db_ms"] <= entry["duration_ms"]
+        assert "139" not in json.dumps(entry["params"])
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -0,0 +1,183 @@
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode
+
+# トラフィックの記録（オプトイン）。パスを指定したときだけミドルウェアを有効にする
+TRAFFIC_CAPTURE_FILE = os.getenv("TRAFFIC_CAPTURE_FILE", "")
+# 座標は小数点以下この桁数に丸めて記録する（2桁で約1km）
+TRAFFIC_COORD_PRECISION = int(os.getenv("TRAFFIC_COORD_PRECISION", "2"))
+# 時刻の指定（start / end）はこの秒数単位に切り捨てて記録する
+TRAFFIC_TIME_BUCKET_SECONDS = int(os.getenv("TRAFFIC_TIME_BUCKET_SECONDS", "3600"))
+
+# 値を記録しないクエリパラメータ
+REDACTED_PARAMS = {"admin_password", "password", "token"}
+REDACTED = "REDACTED"
+# 値を丸めて記録するクエリパラメータ（表示範囲・期間から位置や行動が分からないように）
+BBOX_PARAMS = {"bbox"}
+TIME_PARAMS = {"start", "end"}
+# タイムゾーンのない時刻はJSTとして扱う（API側の解釈と同じ）
+JST = datetime.timezone(datetime.timedelta(hours=9))
+# 座標を取り出すリクエストボディ（それ以外のボディは大きさだけ記録する）
+COORDINATE_PATHS = {"/api/record-location", "/api/record-locations"}
+BODY_CAPTURE_LIMIT = 256 * 1024
+
+
+def coarse_bbox(value, precision=TRAFFIC_COORD_PRECISION):
+    """bbox（"西,南,東,北"）の各値を座標と同じ桁数に丸める（解釈できなければ伏せる）"""
+    try:
+        parts = [float(part) for part in value.split(",")]
+    except ValueError:
+        return REDACTED
+    return ",".join(f"{round(part, precision):g}" for part in parts)
+
+
+def coarse_time(value, bucket_seconds=TRAFFIC_TIME_BUCKET_SECONDS):
+    """時刻の指定（エポックミリ秒またはISO形式）を区間の先頭のエポックミリ秒にする（解釈できなければ伏せる）"""
+    if value.lstrip("-").isdigit():
+        ms = int(value)
+    else:
+        try:
+            dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return REDACTED
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=JST)
+        ms = int(dt.timestamp() * 1000)
+    bucket_ms = max(1, bucket_seconds) * 1000
+    return str(ms // bucket_ms * bucket_ms)
+
+
+def anonymize_value(key, value):
+    if key in REDACTED_PARAMS:
+        return REDACTED
+    if key in BBOX_PARAMS:
+        return coarse_bbox(value)
+    if key in TIME_PARAMS and value:
+        return coarse_time(value)
+    return value
+
+
+def anonymize_query(query_string):
+    """クエリ文字列のうち秘密の値を伏せ、範囲と時刻を丸める"""
+    if not query_string:
+        return ""
+    params = [(key, anonymize_value(key, value))
+              for key, value in parse_qsl(query_string, keep_blank_values=True)]
+    return urlencode(params)
+
+
+def coarse_coordinates(body, precision=TRAFFIC_COORD_PRECISION):
+    """記録リクエストのボディから丸めた座標 [[緯度, 経度], ...] を取り出す（取り出せなければ None）"""
+    try:
+        data = json.loads(body)
+        items = data["locations"] if isinstance(data, dict) and "locations" in data else [data]
+        return [[round(float(item["latitude"]), precision), round(float(item["longitude"]), precision)]
+                for item in items]
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+class TrafficRecorder:
+    """リクエストの記録を1行1件のJSON（NDJSON）でファイルに書く
+
+    書き込みはバックグラウンドのスレッドで行い、リクエストの処理を待たせない。
+    時刻は記録開始からの経過ミリ秒だけを残す。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._origin = None
+
+    def elapsed_ms(self):
+        """記録開始からの経過ミリ秒（最初の呼び出しが0）"""
+        now = time.monotonic()
+        if self._origin is None:
+            self._origin = now
+        return round((now - self._origin) * 1000, 3)
+
+    def record(self, entry):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="traffic-capture", daemon=True)
+                self._thread.start()
+        self._queue.put(entry)
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                entry = self._queue.get()
+                if entry is None:
+                    break
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+                if self._queue.empty():
+                    f.flush()
+
+    def close(self):
+        """残っている記録を書き出してスレッドを止める"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+
+class TrafficCaptureMiddleware:
+    """リクエストごとにメソッド・パス・処理時間・ボディの大きさ・丸めた座標を記録するASGIミドルウェア
+
+    セッションIDやIPアドレス、リクエストボディそのものは記録しない。bbox と start / end は丸めて記録する。
+    """
+
+    def __init__(self, app, recorder):
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        entry = {
+            "t": self.recorder.elapsed_ms(),
+            "method": scope["method"],
+            "path": scope["path"],
+            "query": anonymize_query(scope.get("query_string", b"").decode("latin-1")),
+            "status": None,
+            "req_bytes": 0,
+            "resp_bytes": 0,
+        }
+        capture_body = scope["path"] in COORDINATE_PATHS
+        chunks = []
+
+        async def receive_wrapper():
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b"")
+                entry["req_bytes"] += len(body)
+                if capture_body and entry["req_bytes"] <= BODY_CAPTURE_LIMIT:
+                    chunks.append(body)
+            return message
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                entry["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                entry["resp_bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            entry["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            if chunks and entry["req_bytes"] <= BODY_CAPTURE_LIMIT:
+                coordinates = coarse_coordinates(b"".join(chunks))
+                if coordinates is not None:
+                    entry["coords"] = coordinates
+            self.recorder.record(entry)
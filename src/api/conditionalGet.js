@@ -0,0 +1,37 @@
+import axios from 'axios'
+
+// URLごとに最後に受け取ったETagとレスポンスデータを保持する
+const etagCache = new Map()
+
+/**
+ * ETagを使った条件付きGET
+ * 前回のETagを If-None-Match で送り、304の場合は前回のデータを返す
+ */
+export const conditionalGet = async (url, config = {}) => {
+  const cached = etagCache.get(url)
+  const headers = { ...(config.headers || {}) }
+  if (cached) {
+    headers['If-None-Match'] = cached.etag
+  }
+
+  const response = await axios.get(url, {
+    ...config,
+    headers,
+    validateStatus: (status) => (status >= 200 && status < 300) || status === 304
+  })
+
+  if (response?.status === 304 && cached) {
+    return { ...response, data: cached.data, notModified: true }
+  }
+
+  const etag = response?.headers?.etag
+  if (etag) {
+    etagCache.set(url, { etag, data: response.data })
+  }
+  return response
+}
+
+// テストやログアウト時用にキャッシュを破棄する
+export const clearConditionalCache = () => {
+  etagCache.clear()
+}
@@ -6,6 +6,8 @@ import MapView from '../components/MapView.vue'
 import NameCard from '../components/NameCard.vue'
 import AdminPanel from '../components/AdminPanel.vue'
 import App from '../App.vue'
+import { conditionalGet, clearConditionalCache } from '../api/conditionalGet'
+import { computeVisibleRange } from '../utils/virtualList'
 
 // axiosのモック
 vi.mock('axios')
@@ -1554,3 +1556,265 @@ describe('Cloudflare Tunnel Security Tests', () => {
     expect(templateConfig.ingress[0].hostname).not.toContain('actual-domain.com')
   })
 })
+
+describe('conditionalGet', () => {
+  beforeEach(() => {
+    vi.clearAllMocks()
+    clearConditionalCache()
+  })
+
+  it('2回目以降はIf-None-Matchを送り、304なら前回のデータを返す', async () => {
+    axios.get
+      .mockResolvedValueOnce({ status: 200, data: [{ id: 1 }], headers: { etag: '"locations-v1"' } })
+      .mockResolvedValueOnce({ status: 304, data: '', headers: { etag: '"locations-v1"' } })
+
+    const first = await conditionalGet('http://localhost:8000/api/locations')
+    const second = await conditionalGet('http://localhost:8000/api/locations')
+
+    expect(first.data).toEqual([{ id: 1 }])
+    expect(axios.get.mock.calls[1][1].headers['If-None-Match']).toBe('"locations-v1"')
+    expect(second.notModified).toBe(true)
+    expect(second.data).toEqual([{ id: 1 }])
+  })
+
+  it('ETagがないレスポンスはキャッシュしない', async () => {
+    axios.get.mockResolvedValue({ status: 200, data: { enabled: true } })
+
+    await conditionalGet('http://localhost:8000/api/recording-status')
+    await conditionalGet('http://localhost:8000/api/recording-status')
+
+    expect(axios.get.mock.calls[1][1].headers['If-None-Match']).toBeUndefined()
+  })
+})
+
+describe('MapView 差分取得', () => {
+  beforeEach(() => {
+    vi.clearAllMocks()
+  })
+
+  it('初回はsince=0で取得し、以降は受け取ったカーソルを送る', async () => {
+    axios.get.mockImplementation((url) => {
+      if (url.includes('/api/locations')) {
+        return Promise.resolve({
+          data: {
+            cursor: 5,
+            reset: true,
+            locations: [
+              { id: 1, latitude: 35.0, longitude: 139.0, timestamp: '2024-01-01T12:00:00+09:00', session_id: 'other' }
+            ],
+            deleted: []
+          }
+        })
+      }
+      return Promise.resolve({ data: { enabled: true, expires_at: null, description: null } })
+    })
+
+    const wrapper = mount(MapView, {
+      props: { viewOnly: true }
+    })
+    await flushPromises()
+
+    const locationCalls = () => axios.get.mock.calls.filter(([url]) => url.includes('/api/locations'))
+    expect(locationCalls()[0][1].params.since).toBe(0)
+
+    wrapper.vm.currentLocation = { latitude: 35.1, longitude: 139.1 }
+    await wrapper.vm.confirmLocation()
+    await flushPromises()
+
+    expect(locationCalls()[1][1].params.since).toBe(5)
+    wrapper.unmount()
+  })
+})
+
+describe('computeVisibleRange', () => {
+  it('表示範囲と前後の余白を計算する', () => {
+    const range = computeVisibleRange({ scrollTop: 400, rowHeight: 40, viewportHeight: 200, count: 100, overscan: 2 })
+    expect(range).toEqual({ start: 8, end: 17, paddingTop: 320, paddingBottom: 3320 })
+  })
+
+  it('件数を超えて描画しない', () => {
+    const range = computeVisibleRange({ scrollTop: 0, rowHeight: 40, viewportHeight: 400, count: 3, overscan: 5 })
+    expect(range).toEqual({ start: 0, end: 3, paddingTop: 0, paddingBottom: 0 })
+  })
+})
+
+describe('AdminPanel 位置記録のページ読み込み', () => {
+  beforeEach(() => {
+    vi.clearAllMocks()
+    axios.get = vi.fn()
+  })
+
+  it('カーソルを使って次のページを追加で読み込む', async () => {
+    axios.get.mockImplementation((url, config) => {
+      if (url.includes('/api/locations/count')) {
+        return Promise.resolve({ data: { count: 3 } })
+      }
+      if (url.includes('/api/admin/locations')) {
+        const page = config.params.cursor
+          ? { locations: [{ id: 1, latitude: 35.0, longitude: 139.0, timestamp: '2024-01-01T12:00:00+09:00' }], next_cursor: null }
+          : { locations: [
+              { id: 3, latitude: 35.2, longitude: 139.2, timestamp: '2024-01-01T12:02:00+09:00' },
+              { id: 2, latitude: 35.1, longitude: 139.1, timestamp: '2024-01-01T12:01:00+09:00' }
+            ], next_cursor: 'abc' }
+        return Promise.resolve({ data: page })
+      }
+      return Promise.resolve({ data: {} })
+    })
+
+    const wrapper = mount(AdminPanel)
+    await wrapper.vm.loadLocations()
+    await flushPromises()
+    expect(wrapper.vm.locations.map(loc => loc.id)).toEqual([3, 2])
+    expect(wrapper.vm.locationCount).toBe(3)
+
+    await wrapper.vm.loadMoreLocations()
+    await flushPromises()
+    const pageCalls = axios.get.mock.calls.filter(([url]) => url.includes('/api/admin/locations'))
+    expect(pageCalls[1][1].params.cursor).toBe('abc')
+    expect(wrapper.vm.locations.map(loc => loc.id)).toEqual([3, 2, 1])
+
+    // 最後のページを読んだ後は取得しない
+    await wrapper.vm.loadMoreLocations()
+    expect(axios.get.mock.calls.filter(([url]) => url.includes('/api/admin/locations'))).toHaveLength(2)
+  })
+})
+
+describe('AdminPanel 記録のサマリー', () => {
+  beforeEach(() => {
+    vi.clearAllMocks()
+    axios.get = vi.fn()
+  })
+
+  it('ダッシュボードAPIの集計値を表示する', async () => {
+    axios.get.mockImplementation((url) => {
+      if (url.includes('/api/admin/dashboard')) {
+        return Promise.resolve({ data: {
+          total: 12,
+          today: 3,
+          this_hour: 1,
+          last_24h: 5,
+          days: [
+            { date: '2024-01-01', start_ms: 0, count: 2 },
+            { date: '2024-01-02', start_ms: 86400000, count: 4 }
+          ],
+          hours: [],
+          top_cells: [{ latitude: 35.68, longitude: 139.76, count: 9 }]
+        } })
+      }
+      return Promise.resolve({ data: {} })
+    })
+
+    const wrapper = mount(AdminPanel)
+    wrapper.vm.isLoggedIn = true
+    await wrapper.vm.loadDashboard()
+    await flushPromises()
+    const text = wrapper.text()
+    expect(text).toContain('記録のサマリー')
+    expect(text).toContain('12件')
+    expect(text).toContain('35.680, 139.760 付近: 9件')
+    expect(wrapper.vm.dailyBarHeight(2)).toBe(50)
+    expect(wrapper.vm.dailyBarHeight(4)).toBe(100)
+  })
+
+  it('想定外の応答ではサマリーを表示しない', async () => {
+    axios.get.mockResolvedValue({ data: {} })
+    const wrapper = mount(AdminPanel)
+    await wrapper.vm.loadDashboard()
+    expect(wrapper.vm.dashboard).toBeNull()
+  })
+})
+
+describe('MapView クラスタ表示', () => {
+  beforeEach(() => {
+    vi.clearAllMocks()
+  })
+
+  const createFakeMap = (zoom) => {
+    const pointLayer = { setVisible: vi.fn() }
+    const clusterSource = { clear: vi.fn(), addFeatures: vi.fn() }
+    const clusterLayer = { setVisible: vi.fn(), getSource: vi.fn(() => clusterSource) }
+    return {
+      pointLayer,
+      clusterLayer,
+      clusterSource,
+      map: {
+        getLayers: () => ({ getArray: () => [{}, pointLayer, clusterLayer] }),
+        getView: () => ({
+          getZoom: () => zoom,
+          calculateExtent: () => [139.0, 35.0, 140.0, 36.0]
+        }),
+        getSize: () => [800, 600],
+        setTarget: vi.fn()
+      }
+    }
+  }
+
+  it('低ズームではクラスタを取得してピンの代わりに表示する', async () => {
+    axios.get.mockImplementation((url) => {
+      if (url.includes('/api/locations/clusters')) {
+        return Promise.resolve({
+          data: { zoom: 5, level: 7, clusters: [
+            { latitude: 35.69, longitude: 139.73, count: 2 },
+            { latitude: 34.69, longitude: 135.5, count: 1 }
+          ] }
+        })
+      }
+      return Promise.resolve({ data: { cursor: 0, reset: true, locations: [], deleted: [] } })
+    })
+
+    const wrapper = mount(MapView, { props: { viewOnly: true } })
+    await flushPromises()
+    const fake = createFakeMap(5)
+    wrapper.vm.map = fake.map
+
+    await wrapper.vm.refreshClusters()
+
+    const clusterCall = axios.get.mock.calls.find(([url]) => url.includes('/api/locations/clusters'))
+    expect(clusterCall[1].params).toEqual({ zoom: 5, bbox: '139.000000,35.000000,140.000000,36.000000' })
+    expect(fake.pointLayer.setVisible).toHaveBeenCalledWith(false)
+    expect(fake.clusterLayer.setVisible).toHaveBeenCalledWith(true)
+    expect(fake.clusterSource.addFeatures.mock.calls[0][0]).toHaveLength(2)
+    wrapper.unmount()
+  })
+
+  it('高ズームではクラスタを取得せずピンを表示する', async () => {
+    const wrapper = mount(MapView, { props: { viewOnly: true } })
+    await flushPromises()
+    const fake = createFakeMap(16)
+    wrapper.vm.map = fake.map
+    axios.get.mockClear()
+
+    await wrapper.vm.refreshClusters()
+
+    expect(axios.get.mock.calls.some(([url]) => url.includes('/api/locations/clusters'))).toBe(false)
+    expect(fake.pointLayer.setVisible).toHaveBeenCalledWith(true)
+    expect(fake.clusterLayer.setVisible).toHaveBeenCalledWith(false)
+    wrapper.unmount()
+  })
+
+  it('クラスタ表示中は個別の位置情報を取得せず、ピンに戻ると全件を取り直す', async () => {
+    axios.get.mockImplementation((url) => {
+      if (url.includes('/api/locations/clusters')) {
+        return Promise.resolve({ data: { zoom: 5, level: 7, clusters: [] } })
+      }
+      return Promise.resolve({ data: { cursor: 3, reset: true, locations: [], deleted: [] } })
+    })
+    const wrapper = mount(MapView, { props: { viewOnly: true } })
+    await flushPromises()
+    const locationCalls = () => axios.get.mock.calls.filter(([url]) =>
+      url.includes('/api/locations') && !url.includes('/clusters'))
+    expect(locationCalls()[0][1].params.since).toBe(0)
+
+    wrapper.vm.map = createFakeMap(5).map
+    axios.get.mockClear()
+    await wrapper.vm.refreshClusters()
+    await wrapper.vm.refreshLocations()
+    expect(locationCalls()).toHaveLength(0)
+
+    wrapper.vm.map = createFakeMap(16).map
+    await wrapper.vm.refreshClusters()
+    expect(locationCalls()).toHaveLength(1)
+    expect(locationCalls()[0][1].params.since).toBe(0)
+    wrapper.unmount()
+  })
+})
@@ -0,0 +1,16 @@
+/**
+ * 仮想スクロールで描画する行の範囲を求める
+ * 行の高さは固定。表示範囲の前後 overscan 行も描画し、
+ * 描画しない行の分は上下の余白（paddingTop / paddingBottom）で確保する
+ */
+export const computeVisibleRange = ({ scrollTop, rowHeight, viewportHeight, count, overscan = 0 }) => {
+  const first = Math.floor(Math.max(0, scrollTop) / rowHeight)
+  const end = Math.min(count, first + Math.ceil(viewportHeight / rowHeight) + overscan)
+  const start = Math.min(Math.max(0, first - overscan), end)
+  return {
+    start,
+    end,
+    paddingTop: start * rowHeight,
+    paddingBottom: (count - end) * rowHeight
+  }
+}